@@ -0,0 +1,77 @@
+'''
+Benchmark of CalcStatbyGrpDim (one pass over the data, partials only for the groups in each block) against the
+previous loop over groups, on synthetic monthly data chunked one year at a time. Records time and peak
+traced memory, checks that both give the same statistics, and exits with status 1 if the one-pass version is not
+faster or uses more than --tol more memory.
+
+Usage: python Bench_GroupStats.py [--nyear 200] [--nlat 48] [--nlon 72] [--tchunk 12] [--grpdim2 time.season] [--tol 0.25]
+'''
+# Packages
+import os
+import sys
+import argparse
+import warnings
+import numpy as np
+import xarray as xr
+import pandas as pd
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..', 'processing_code'))
+import Processing_functions as PF
+from Bench_InterPlevels import Measure
+
+warnings.filterwarnings('ignore')
+
+def CalcStatbyGrpDim_loop(da: xr.DataArray, grpdim1: str, grpdim2: str, concatdim: str, avgdim: str, avgdim2: str) -> tuple:
+    '''
+    Previous implementation of CalcStatbyGrpDim (one groupby per group), kept for comparison
+    '''
+    if 'lat' in avgdim:
+        da = da.weighted(np.cos(np.deg2rad(da.lat)))
+
+    da_avg_list = []
+    lbl_list = []
+    for sub, dss in da.groupby(grpdim1):
+        if grpdim2 != '':
+            dss_avg = dss.groupby(grpdim2).mean(avgdim, skipna=True)
+        else:
+            dss_avg = dss.mean(avgdim, skipna=True)
+        da_avg_list.append(dss_avg)
+        lbl_list.append(sub)
+
+    da_avg_grp = xr.concat(da_avg_list, pd.Index(lbl_list, name=concatdim)).compute()
+
+    return (da_avg_grp.mean(avgdim2, skipna=True).compute(), da_avg_grp.std(avgdim2, skipna=True, ddof=1).compute(),
+            da_avg_grp.count(avgdim2).compute())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nyear', type=int, default=200)
+    parser.add_argument('--nlat', type=int, default=48)
+    parser.add_argument('--nlon', type=int, default=72)
+    parser.add_argument('--tchunk', type=int, default=12)
+    parser.add_argument('--grpdim2', default='time.season')
+    parser.add_argument('--tol', type=float, default=0.25, help='allowed relative increase of peak memory')
+    args = parser.parse_args()
+
+    # Monthly float32 temperature, one year per chunk as read from yearly files
+    rng = np.random.default_rng(0)
+    time = xr.date_range('1850-01-01', periods=12*args.nyear, freq='MS', calendar='noleap', use_cftime=True)
+    vals = (250.+10.*rng.standard_normal((len(time), args.nlat, args.nlon))).astype(np.float32)
+    da = xr.DataArray(vals, dims=('time','lat','lon'), name='TREFHT',
+                      coords={'time': time, 'lat': np.linspace(-90, 90, args.nlat),
+                              'lon': np.linspace(0, 360, args.nlon, endpoint=False)})
+    da = da.chunk({'time': args.tchunk})
+    call = ('time.year', args.grpdim2, 'year', 'time', 'year')
+
+    new, t_new, m_new = Measure(lambda: [o.compute() for o in PF.CalcStatbyGrpDim(da, *call)])
+    print('one pass   : %8.2f s  peak %8.1f MiB' % (t_new, m_new))
+    old, t_old, m_old = Measure(lambda: CalcStatbyGrpDim_loop(da, *call))
+    print('group loop : %8.2f s  peak %8.1f MiB' % (t_old, m_old))
+    print('speedup %.1fx, peak memory ratio %.2f' % (t_old/t_new, m_new/m_old))
+
+    # Same statistics (the loop keeps the season order of groupby, so align by label)
+    diff = max(float(abs(a-b.transpose(*a.dims)).max()) for a, b in zip(new, old))
+    print('max |one pass - loop| %.2e' % diff)
+
+    sys.exit(0 if t_new < t_old and m_new <= (1+args.tol)*m_old and diff < 1e-3 else 1)
@@ -0,0 +1,90 @@
+'''
+Import time of the processing and plotting modules, as paid by every dask worker that unpickles a task using them.
+Each module is imported in a fresh interpreter, timed against the floor of importing numpy & xarray alone, and checked
+for heavy dependencies that should only load when the functions needing them are called (cartopy, matplotlib,
+scipy.stats, dask.array, pop_tools, xgcm). Exits with status 1 if a module loads one of them or its own import
+time (above the floor) exceeds --max-ms.
+
+Usage:
+python Bench_Import.py [--repeat 5] [--max-ms 100] [--save results.json]
+'''
+# Packages
+import os
+import sys
+import json
+import argparse
+import platform
+import datetime
+import subprocess
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+PATHS = [os.path.join(bench_dir, '..', 'processing_code'), os.path.join(bench_dir, '..', 'plotting_code')]
+
+# Modules a dask worker imports to run processing or statistics tasks
+MODULES = ['Processing_functions', 'Plotting_functions', 'Stats_functions', 'Trend_functions', 'Grid_functions',
+           'Interp_functions', 'Region_functions', 'Resample_functions', 'Pipeline_functions']
+
+# Dependencies loaded lazily by the functions that need them
+HEAVY = ['cartopy', 'matplotlib', 'scipy.stats', 'dask.array', 'pop_tools', 'xgcm']
+
+# Run in a fresh interpreter: wall time of the import, and which heavy modules it loaded
+PROBE = '''
+import sys, time, json
+import numpy, xarray
+t0 = time.perf_counter()
+{imports}
+elapsed = time.perf_counter()-t0
+print(json.dumps(dict(ms=1e3*elapsed, heavy=[m for m in {heavy!r} if m in sys.modules])))
+'''
+
+def Probe(module: str|None) -> dict:
+    '''
+    Imports a module in a fresh interpreter after numpy & xarray, None times the floor (nothing more)
+    '''
+    code = PROBE.format(imports='' if module is None else 'import '+module, heavy=HEAVY)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(PATHS+[os.environ.get('PYTHONPATH', '')]))
+    env.pop('ARCTIC_PROFILE', None)
+    out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def Floor(repeat: int) -> float:
+    '''
+    Time (ms) of starting an interpreter & importing numpy & xarray, which every worker pays regardless
+    '''
+    code = 'import time; t0 = time.perf_counter(); import numpy, xarray; print(1e3*(time.perf_counter()-t0))'
+    return min(float(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout)
+               for _ in range(repeat))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', default=','.join(MODULES), help='comma separated modules')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-ms', type=float, default=100., help='largest allowed import time above numpy & xarray')
+    parser.add_argument('--save', default='', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    floor = Floor(args.repeat)
+    print('%-22s %9.1f ms' % ('numpy + xarray', floor))
+
+    records = []
+    nfail = 0
+    for module in args.modules.split(','):
+        runs = [Probe(module) for _ in range(args.repeat)]
+        record = dict(module=module, ms=min(r['ms'] for r in runs), heavy=runs[0]['heavy'])
+        fail = record['ms'] > args.max_ms or len(record['heavy']) > 0
+        nfail += int(fail)
+        records.append(record)
+        print('%-22s %9.1f ms  %-30s %s' % (module, record['ms'], ','.join(record['heavy']), 'FAIL' if fail else ''))
+    print(str(nfail)+' module(s) over '+str(args.max_ms)+' ms or loading heavy dependencies')
+
+    results = dict(meta=dict(date=datetime.datetime.now().isoformat(timespec='seconds'), host=platform.node(),
+                             python=platform.python_version(), repeat=args.repeat, floor_ms=floor),
+                   results=records)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('wrote '+args.save)
+
+    sys.exit(1 if nfail > 0 else 0)
@@ -0,0 +1,113 @@
+'''
+Benchmark of InterPlevels (native bracket/weight interpolation) against the previous xgcm path.
+Runs on synthetic CAM-shaped data (hybrid-sigma levels, f09 grid by default), no input files needed.
+
+Usage: python Bench_InterPlevels.py [--ntime 12] [--nlat 192] [--nlon 288] [--nlev 32] [--tchunk 12]
+'''
+# Packages
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import xarray as xr
+import dask
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing_code'))
+from Interp_functions import InterpHybridToPlev, PLEV_TARGET
+
+def SyntheticCAM(ntime: int, nlat: int, nlon: int, nlev: int, var_list: list) -> xr.Dataset:
+    '''
+    Creates a synthetic CAM history dataset on hybrid-sigma levels
+    INPUT:
+    ntime, nlat, nlon, nlev: dimension sizes
+    var_list: list of 3D variable names
+
+    OUTPUT:
+    ds: xarray Dataset with var_list, PS, hyam, hybm, P0
+    '''
+    rng = np.random.default_rng(0)
+    P0 = 100000.
+
+    # Hybrid coefficients from ~3.6 hPa at the top to ~993 hPa at the bottom
+    eta = np.geomspace(0.0036, 0.993, nlev)
+    hybm = np.clip((eta-0.1)/0.9, 0, None)**1.5
+    hyam = eta-hybm
+
+    ps = P0 + 2000.*rng.standard_normal((ntime, nlat, nlon))
+    ps[:, :nlat//4, :nlon//4] -= 30000. # Topography
+
+    ds = xr.Dataset({'PS': (('time','lat','lon'), ps),
+                     'hyam': (('lev',), hyam), 'hybm': (('lev',), hybm), 'P0': P0},
+                    coords={'time': np.arange(ntime), 'lev': 1000.*eta,
+                            'lat': np.linspace(-90, 90, nlat), 'lon': np.linspace(0, 358.75, nlon)})
+    for v in var_list:
+        ds[v] = (('time','lev','lat','lon'), rng.standard_normal((ntime, nlev, nlat, nlon)).astype(np.float32))
+
+    return ds
+
+def InterPlevels_xgcm(ds: xr.Dataset, var: str) -> xr.DataArray:
+    '''
+    Previous xgcm implementation of InterPlevels, kept for comparison
+    '''
+    from xgcm import Grid
+
+    p = (ds['hyam']*ds['P0'] + ds['hybm']*ds['PS'])/100
+    ds = ds.assign({'p': np.log(p)})
+    try:
+        grid = Grid(ds, coords={'Z': {'center': 'lev'}}, periodic=False)
+    except ValueError:
+        # Newer xgcm replaced periodic with padding and autoparses metadata
+        grid = Grid(ds, coords={'Z': {'center': 'lev'}}, padding='fill', autoparse_metadata=False)
+    varout = grid.transform(ds[var], 'Z', np.log(PLEV_TARGET), target_data=ds.p)
+    varout = varout.rename({'p': 'plev'})
+    varout = varout.assign_coords({'plev': PLEV_TARGET})
+
+    return varout.squeeze()
+
+def Measure(func) -> tuple:
+    '''
+    Times func() and records peak traced memory (MiB)
+    '''
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = func()
+    elapsed = time.perf_counter()-t0
+    peak = tracemalloc.get_traced_memory()[1]/2**20
+    tracemalloc.stop()
+
+    return out, elapsed, peak
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ntime', type=int, default=12)
+    parser.add_argument('--nlat', type=int, default=192)
+    parser.add_argument('--nlon', type=int, default=288)
+    parser.add_argument('--nlev', type=int, default=32)
+    parser.add_argument('--tchunk', type=int, default=12)
+    args = parser.parse_args()
+
+    var_list = ['U','V','T','Z3']
+    ds = SyntheticCAM(args.ntime, args.nlat, args.nlon, args.nlev, var_list)
+    ds = ds.chunk({'time': args.tchunk, 'lev': -1})
+
+    dask.config.set(scheduler='synchronous')
+
+    # Native engine, all variables in one pass
+    native, t_native, m_native = Measure(lambda: InterpHybridToPlev(ds, var_list).compute())
+    print('native  (U,V,T,Z3 one pass): %8.2f s  peak %8.1f MiB' % (t_native, m_native))
+
+    # xgcm, one variable at a time as in the processing notebooks
+    try:
+        legacy, t_xgcm, m_xgcm = Measure(lambda: [InterPlevels_xgcm(ds, v).compute() for v in var_list])
+    except ImportError:
+        print('xgcm not installed, skipping comparison')
+        sys.exit(0)
+    print('xgcm    (U,V,T,Z3 separate): %8.2f s  peak %8.1f MiB' % (t_xgcm, m_xgcm))
+    print('speedup %.1fx, peak memory ratio %.2f' % (t_xgcm/t_native, m_native/m_xgcm))
+
+    # Agreement with previous implementation
+    for v, da in zip(var_list, legacy):
+        diff = np.nanmax(np.abs(native[v].values-da.transpose(*native[v].dims).values))
+        print('max |native - xgcm| %-3s %.2e' % (v, diff))
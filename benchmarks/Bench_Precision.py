@@ -0,0 +1,262 @@
+'''
+Accuracy & memory of the 'float32' precision policy (Precision_functions) against the current float64 results.
+Every function is run on the same synthetic float64 inputs under both policies, and the largest difference is
+checked against a bound: float32 rounding of the inputs & outputs (accumulation stays float64), or half an int16
+step for fields packed on disk (including the p-values of an actual CalcStatSig output). Also checks that float32
+inputs give float32 statistics under the default 'float64' policy, and that Wilks_pcrit & Wilks_pcrit_batch give
+the same p-critical value (with NaN points and all p-values significant). Exits with status 1 if any bound is
+exceeded or a float32 input is widened.
+
+Usage:
+python Bench_Precision.py [--nlat 96] [--nlon 144] [--nyear 40] [--nmember 10] [--save results.json]
+'''
+# Packages
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import datetime
+import tempfile
+import warnings
+import numpy as np
+import xarray as xr
+import pandas as pd
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..', 'processing_code'))
+sys.path.insert(0, os.path.join(bench_dir, '..', 'plotting_code'))
+import Processing_functions as PF
+import Plotting_functions as PL
+from Precision_functions import Precision, Compact, PackedRanges, PackEncoding, INT16_STEPS
+from Storage_functions import WriteStore
+from Bench_InterPlevels import SyntheticCAM
+from Bench_Suite import StatDatasets
+
+warnings.filterwarnings('ignore')
+
+# float32 unit roundoff
+EPS32 = float(np.finfo(np.float32).eps)/2
+
+def TimeCoord(nyear: int) -> pd.DatetimeIndex:
+    '''
+    Monthly time coordinate starting 1980
+    '''
+    return pd.date_range('1980-01-01', periods=12*nyear, freq='MS')
+
+def SyntheticTemp(nlat: int, nlon: int, nyear: int, nmember: int, seed: int=0) -> xr.DataArray:
+    '''
+    Synthetic float64 surface temperature ensemble (~250 K, trend & annual cycle), the worst case for float32
+    since the signal is small against the magnitude
+    '''
+    rng = np.random.default_rng(seed)
+    time = TimeCoord(nyear)
+    t = np.arange(len(time))
+    base = 250.+10.*np.cos(2*np.pi*t/12)[:, None, None]+0.003*t[:, None, None]
+    vals = base[None]+rng.standard_normal((nmember, len(time), nlat, nlon))
+
+    return xr.DataArray(vals, dims=('ensemble_member','time','lat','lon'), name='TREFHT',
+                        coords={'ensemble_member': np.arange(1, nmember+1), 'time': time,
+                                'lat': np.linspace(-90, 90, nlat), 'lon': np.linspace(0, 360, nlon, endpoint=False)})
+
+def Run(func, precision: str):
+    '''
+    Runs func under a precision policy, returns its output with numpy data, time (s) & bytes of the output
+    '''
+    with Precision(precision):
+        t0 = time.perf_counter()
+        out = func()
+        out = tuple(o.compute() for o in out) if isinstance(out, tuple) else (out.compute(),)
+        elapsed = time.perf_counter()-t0
+    nbytes = sum(o.nbytes for o in out)
+
+    return out, elapsed, nbytes
+
+def MaxDiff(a: xr.DataArray|xr.Dataset, b: xr.DataArray|xr.Dataset) -> float:
+    '''
+    Largest absolute difference over all data variables, NaN in both counts as equal
+    '''
+    a = a.to_dataset(name='v') if isinstance(a, xr.DataArray) else a
+    b = b.to_dataset(name='v') if isinstance(b, xr.DataArray) else b
+    diff = 0.
+    for v in a.data_vars:
+        x, y = a[v].values.astype(np.float64), b[v].values.astype(np.float64)
+        if not np.array_equal(np.isnan(x), np.isnan(y)):
+            return np.inf
+        diff = max(diff, float(np.nanmax(np.abs(x-y))))
+
+    return diff
+
+def Checks(da: xr.DataArray, ds_cam: xr.Dataset, obs: xr.DataArray) -> list:
+    '''
+    (name, function run under both policies, function of the float64 output giving the error bound) for every check.
+    Bounds allow a few float32 roundings of the largest value (inputs are rounded once, accumulation is float64)
+    '''
+    da_em = da.isel(ensemble_member=0)
+    mag = float(abs(da).max())
+    return [
+        ('CalcStatforDim (month)', lambda: PF.CalcStatforDim(Compact(da_em), 'time.month', 'time'),
+         lambda out: 4*EPS32*mag),
+        ('CalcStatbyGrpDim', lambda: PF.CalcStatbyGrpDim(Compact(da_em), 'time.year', 'time.month', 'year', 'time', 'year'),
+         lambda out: 4*EPS32*mag),
+        ('Ensemble mean', lambda: PF.Ensemble([da.sel(ensemble_member=m) for m in da.ensemble_member.values],
+                                              pd.Index(da.ensemble_member.values, name='ensemble_member'), True),
+         lambda out: 4*EPS32*mag),
+        ('Ensemble (stacked)', lambda: PF.Ensemble([da.sel(ensemble_member=m) for m in da.ensemble_member.values],
+                                                   pd.Index(da.ensemble_member.values, name='ensemble_member')),
+         lambda out: EPS32*mag),
+        ('InterPlevels', lambda: PF.InterPlevels(ds_cam, ['U','T']), lambda out: 4*EPS32*float(abs(ds_cam['T']).max())),
+        # Slopes of a ~250 K series: input rounding is amplified by sum(x^2) ~ n^3, bound on the trend itself
+        ('CalcTrendforDim (trend)', lambda: PF.CalcTrendforDim(Compact(da_em), 'month', scale=1.)['trend'],
+         lambda out: 1e-4*float(abs(out[0]).max())),
+        ('CalcTrendforDim (pvalue)', lambda: PF.CalcTrendforDim(Compact(da_em), 'month', scale=1.)['pvalue'],
+         lambda out: 1e-4),
+        ('CalcSkillforDim (r, r_dtrd)', lambda: PF.CalcSkillforDim(Compact(da), Compact(obs))[['r', 'r_dtrd']], lambda out: 1e-4),
+    ]
+
+def PackCheck(pvals: xr.DataArray, aice: xr.DataArray, tmp_dir: str) -> list:
+    '''
+    Round trip of p-values & sea ice fraction through scaled int16 zarr & NetCDF, with Wilks critical p-value.
+    Sizes are float64 in memory against int16 before compression
+    '''
+    records = []
+    ds = xr.Dataset({'pvalue': pvals, 'aice': aice})
+    bound = 1.01/INT16_STEPS/2
+    for engine in ('zarr', 'netcdf'):
+        path = os.path.join(tmp_dir, 'packed.'+('zarr' if engine == 'zarr' else 'nc'))
+        if engine == 'zarr':
+            WriteStore(ds, path, pack=True)
+            back = xr.open_zarr(path).load()
+        else:
+            # Packed as NetCDF4 with zlib level 1, as the notebooks write
+            ds.to_netcdf(path, encoding={v: dict(PackEncoding(0., 1.), zlib=True, complevel=1) for v in ds.data_vars})
+            back = xr.open_dataset(path).load()
+        for v in ('pvalue', 'aice'):
+            diff = MaxDiff(ds[v], back[v])
+            records.append(dict(check='int16 '+v+' ('+engine+')', diff=diff, bound=bound, ok=diff <= bound,
+                                bytes64=int(ds[v].nbytes), bytes32=int(ds[v].size*2)))
+
+    # Wilks critical p-value from packed p-values
+    pc64 = PF.Wilks_pcrit(pvals.values, 0.05)
+    pc16 = PF.Wilks_pcrit(back['pvalue'].values, 0.05)
+    records.append(dict(check='Wilks_pcrit (int16 p-values)', diff=abs(pc64-pc16), bound=bound, ok=abs(pc64-pc16) <= bound,
+                        bytes64=0, bytes32=0))
+
+    return records
+
+def WilksCheck(nlat: int, nlon: int) -> list:
+    '''
+    Wilks_pcrit (Processing_functions & Plotting_functions) & Wilks_pcrit_batch must agree, including fields where
+    every finite p-value is significant & some points are NaN (masked), which must give the largest finite p-value
+    '''
+    rng = np.random.default_rng(1)
+    mixed = rng.uniform(0, 1, (nlat, nlon))
+    mixed[:nlat//4] *= 1e-4
+    all_sig = np.full((nlat, nlon), 1e-4)
+    cases = [('mixed', mixed, None), ('all sig.', all_sig, 1e-4), ('none sig.', all_sig+0.5, 0.),
+             ('all sig. + NaN', np.where(np.arange(nlon) == 0, np.nan, all_sig), 1e-4),
+             ('mixed + NaN', np.where(np.arange(nlat)[:, None] >= nlat-2, np.nan, mixed), None)]
+
+    batch = PL.Wilks_pcrit_batch(xr.DataArray(np.stack([c[1] for c in cases]), dims=('case','lat','lon')), 0.05).values
+    records = []
+    for (name, pvals, expected), pc_batch in zip(cases, batch):
+        pc = np.array([PF.Wilks_pcrit(pvals, 0.05), PL.Wilks_pcrit(pvals, 0.05), pc_batch])
+        diff = float(np.max(np.abs(pc-(pc[0] if expected is None else expected))))
+        records.append(dict(check='Wilks_pcrit '+name, diff=diff, bound=0., ok=diff == 0., bytes64=0, bytes32=0))
+
+    return records
+
+def DtypeCheck(da: xr.DataArray) -> list:
+    '''
+    Statistics of float32 inputs under the default 'float64' policy must stay float32 (accumulation is float64
+    inside), as the xarray means they replace did
+    '''
+    da32 = da.astype(np.float32)
+    da_em = da32.isel(ensemble_member=0)
+    funcs = [('CalcStatforDim', lambda: PF.CalcStatforDim(da_em, 'time.month', 'time')[:2]),
+             ('CalcStatbyGrpDim', lambda: PF.CalcStatbyGrpDim(da_em, 'time.year', 'time.month', 'year', 'time', 'year')[:2]),
+             ('Ensemble mean', lambda: PF.Ensemble([da32.sel(ensemble_member=m) for m in da32.ensemble_member.values],
+                                                   pd.Index(da32.ensemble_member.values, name='ensemble_member'), True))]
+    records = []
+    for name, func in funcs:
+        out, _, nbytes = Run(func, 'float64')
+        ok = all(o.dtype == np.float32 for o in out)
+        records.append(dict(check='float32 '+name, diff=0. if ok else np.inf, bound=0., ok=ok,
+                            bytes64=0, bytes32=int(nbytes)))
+
+    return records
+
+def StatSigPackCheck(nlat: int, nlon: int, nmember: int, tmp_dir: str) -> list:
+    '''
+    Packing of an actual CalcStatSig output written with pack=True: its p-values ('pvals_'+var) must be stored as
+    int16 within half a step, the statistic itself must be left unpacked
+    '''
+    datasets = StatDatasets(dict(nlat=nlat, nlon=nlon), nmember, None)
+    ds_sig = PL.CalcStatSig(*[ds.copy() for ds in datasets], 'TREFHT', 'Wilks', 'All_members', 0)
+    path = os.path.join(tmp_dir, 'statsig.zarr')
+    WriteStore(ds_sig, path, pack=True)
+    back = xr.open_zarr(path)
+
+    bound = 1.01/INT16_STEPS/2
+    diff = MaxDiff(ds_sig['pvals_TREFHT'], back['pvals_TREFHT'].load())
+    packed = set(PackedRanges(ds_sig, True)) == {'pvals_TREFHT'}
+    int16 = back['pvals_TREFHT'].encoding.get('dtype') == np.int16 and back['TREFHT'].encoding.get('dtype') != np.int16
+
+    return [dict(check='int16 CalcStatSig p-values', diff=diff, bound=bound, ok=packed and int16 and diff <= bound,
+                 bytes64=int(ds_sig['pvals_TREFHT'].nbytes), bytes32=int(ds_sig['pvals_TREFHT'].size*2))]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nlat', type=int, default=96)
+    parser.add_argument('--nlon', type=int, default=144)
+    parser.add_argument('--nyear', type=int, default=40)
+    parser.add_argument('--nmember', type=int, default=10)
+    parser.add_argument('--save', default='', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    # Inputs: float64 ensemble & observations, CAM 3D fields (float64 so the policy has something to cast)
+    da = SyntheticTemp(args.nlat, args.nlon, args.nyear, args.nmember)
+    obs = SyntheticTemp(args.nlat, args.nlon, args.nyear, 1, seed=1).isel(ensemble_member=0, drop=True)
+    obs = obs+0.5*(da.mean('ensemble_member')-250.)
+    ds_cam = SyntheticCAM(12, args.nlat, args.nlon, 32, ['U','T'])
+    ds_cam = ds_cam.assign({v: ds_cam[v].astype(np.float64)+(250. if v == 'T' else 0.) for v in ('U','T')})
+    rng = np.random.default_rng(0)
+    pvals = xr.DataArray(rng.uniform(0, 1, (12, args.nlat, args.nlon)), dims=('month','lat','lon'))
+    pvals[:, :args.nlat//8] *= 1e-3
+    aice = xr.DataArray(np.clip(rng.uniform(-0.2, 1.2, (12, args.nlat, args.nlon)), 0, 1), dims=('month','lat','lon'))
+    aice[:, :args.nlat//4] = np.nan
+
+    records = []
+    print('%-30s %10s %10s %8s %8s %10s %11s' % ('check', 'max diff', 'bound', 's f64', 's f32', 'MiB f64', 'MiB f32/i16'))
+    for name, func, bound_func in Checks(da, ds_cam, obs):
+        out64, t64, b64 = Run(func, 'float64')
+        out32, t32, b32 = Run(func, 'float32')
+        diff = max(MaxDiff(a, b) for a, b in zip(out64, out32))
+        bound = bound_func(out64)
+        records.append(dict(check=name, diff=diff, bound=bound, ok=diff <= bound, s64=t64, s32=t32,
+                            bytes64=int(b64), bytes32=int(b32)))
+        print('%-30s %10.2e %10.2e %8.2f %8.2f %10.1f %10.1f %s' % (name, diff, bound, t64, t32, b64/2**20, b32/2**20,
+                                                                  '' if diff <= bound else 'FAIL'))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for r in (PackCheck(pvals, aice, tmp_dir)+StatSigPackCheck(args.nlat, args.nlon, args.nmember, tmp_dir)
+                  +WilksCheck(args.nlat, args.nlon)+DtypeCheck(da)):
+            records.append(r)
+            print('%-30s %10.2e %10.2e %8s %8s %10.1f %10.1f %s' % (r['check'], r['diff'], r['bound'], '', '',
+                                                                    r['bytes64']/2**20, r['bytes32']/2**20,
+                                                                    '' if r['ok'] else 'FAIL'))
+
+    nfail = sum(not r['ok'] for r in records)
+    print(str(nfail)+' check(s) over their bound')
+
+    if args.save:
+        results = dict(meta=dict(date=datetime.datetime.now().isoformat(timespec='seconds'), host=platform.node(),
+                                 python=platform.python_version(), nlat=args.nlat, nlon=args.nlon, nyear=args.nyear,
+                                 nmember=args.nmember),
+                       results=records)
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('wrote '+args.save)
+
+    sys.exit(1 if nfail > 0 else 0)
@@ -0,0 +1,172 @@
+'''
+Read/write throughput of output store layouts on synthetic CESM2-shaped data: the notebook layouts (NetCDF4 zlib
+level 1 with time chunks, zarr read back with time 12 chunks) against planned layouts from Storage_functions
+(chunks for time series, map or balanced access, Blosc zstd + shuffle). Every layout is written once and then read
+the ways the analysis reads it: a full map at one time, the full time series at one point, the Arctic (70-90N)
+regional time series, and everything. Reports MiB/s of uncompressed data, store size & compression ratio.
+Reads are from the page cache after the first repeat, so times are a lower bound for cold reads on GLADE.
+
+Usage:
+python Bench_Storage.py [--preset small|f09|daily] [--layouts notebook_zarr,timeseries] [--repeat 3] [--save results.json]
+'''
+# Packages
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import datetime
+import tempfile
+import warnings
+import numpy as np
+import xarray as xr
+import dask
+warnings.filterwarnings('ignore')
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..', 'processing_code'))
+from Storage_functions import WriteStore, PlanEncoding
+
+# Sizes: ntime in units of freq
+PRESETS = {
+    'small': dict(nlat=96, nlon=144, nyear=50, freq='monthly'),
+    'f09':   dict(nlat=192, nlon=288, nyear=100, freq='monthly'),
+    'daily': dict(nlat=192, nlon=288, nyear=10, freq='daily'),
+}
+
+# Layouts: notebook ones as written/read by the processing notebooks, the rest planned by Storage_functions
+LAYOUTS = ['notebook_netcdf', 'notebook_zarr', 'timeseries', 'maps', 'balanced', 'balanced_nocomp']
+
+READS = ['map', 'point_series', 'region_series', 'full']
+
+def SyntheticField(p: dict) -> xr.Dataset:
+    '''
+    Smooth float32 temperature-like field (meridional gradient, seasonal cycle, weather noise) so compression
+    ratios are closer to model output than pure noise
+    '''
+    rng = np.random.default_rng(0)
+    nper = 12 if p['freq'] == 'monthly' else 365
+    time = xr.date_range('1950-01-01', periods=nper*p['nyear'], freq='MS' if nper == 12 else 'D', calendar='noleap',
+                         use_cftime=True)
+    lat = np.linspace(-90, 90, p['nlat'])
+    lon = np.linspace(0, 360, p['nlon'], endpoint=False)
+    clim = 250.+40.*np.cos(np.deg2rad(lat))[:, np.newaxis]*np.ones(len(lon))
+    vals = np.empty((len(time), len(lat), len(lon)), dtype=np.float32)
+    for t in range(len(time)):
+        vals[t] = clim+10.*np.sin(2*np.pi*t/nper)*np.sin(np.deg2rad(lat))[:, np.newaxis]+rng.standard_normal(clim.shape)
+
+    return xr.Dataset({'TREFHT': (('time', 'lat', 'lon'), vals, {'units': 'K'})},
+                      coords={'time': time, 'lat': lat, 'lon': lon})
+
+def StoreSize(path: str) -> int:
+    '''
+    Bytes on disk of a file or directory store
+    '''
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(path) for f in fs)
+
+def Write(ds: xr.Dataset, layout: str, out_dir: str) -> tuple:
+    '''
+    Writes ds in a layout, returns store path & a function opening it as the analysis would
+    '''
+    if layout == 'notebook_netcdf':
+        path = os.path.join(out_dir, layout+'.nc')
+        ds.to_netcdf(path, format='NETCDF4', encoding={'TREFHT': {'zlib': True, 'complevel': 1}})
+        return path, lambda: xr.open_dataset(path, chunks={'time': 12})
+
+    path = os.path.join(out_dir, layout+'.zarr')
+    if layout == 'notebook_zarr':
+        ds.chunk({'time': 12}).to_zarr(path, mode='w')
+        return path, lambda: xr.open_zarr(path, chunks={'time': 12})
+
+    if layout == 'balanced_nocomp':
+        encoding = PlanEncoding(ds, 'balanced')
+        encoding['TREFHT']['compressors'] = None
+        ds.chunk(dict(zip(ds['TREFHT'].dims, encoding['TREFHT']['chunks']))).to_zarr(path, mode='w', encoding=encoding,
+                                                                                    consolidated=True)
+    else:
+        WriteStore(ds, path, layout)
+
+    return path, lambda: xr.open_zarr(path)
+
+def Read(ds: xr.Dataset, kind: str) -> int:
+    '''
+    Reads ds the way the analysis does, returns uncompressed bytes read
+    '''
+    da = ds['TREFHT']
+    if kind == 'map':
+        sub = da.isel(time=da.sizes['time']//2)
+    elif kind == 'point_series':
+        sub = da.isel(lat=int(0.9*da.sizes['lat']), lon=da.sizes['lon']//3)
+    elif kind == 'region_series':
+        sub = da.sel(lat=slice(70, 90)).mean(('lat', 'lon'))
+        nbytes = da.sel(lat=slice(70, 90)).nbytes
+        sub.compute()
+        return nbytes
+    else:
+        sub = da
+    sub.compute()
+
+    return sub.nbytes
+
+def RunLayout(ds: xr.Dataset, layout: str, preset: str, repeat: int, out_dir: str) -> list:
+    '''
+    Writes & reads one layout, times are the fastest of repeat runs
+    '''
+    write_times = []
+    for _ in range(repeat):
+        shutil.rmtree(os.path.join(out_dir, layout+'.zarr'), ignore_errors=True)
+        t0 = time.perf_counter()
+        path, opener = Write(ds, layout, out_dir)
+        write_times.append(time.perf_counter()-t0)
+    size = StoreSize(path)
+    chunks = opener()['TREFHT'].encoding.get('chunks', opener()['TREFHT'].encoding.get('chunksizes'))
+
+    records = [dict(preset=preset, layout=layout, op='write', chunks=str(chunks), time_s=min(write_times),
+                    mib_s=ds['TREFHT'].nbytes/2**20/min(write_times), size_mib=size/2**20, ratio=ds['TREFHT'].nbytes/size)]
+    for kind in READS:
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            nbytes = Read(opener(), kind)
+            times.append(time.perf_counter()-t0)
+        records.append(dict(records[0], op='read_'+kind, time_s=min(times), mib_s=nbytes/2**20/min(times)))
+
+    for r in records:
+        print('%-16s %-19s %-22s %9.4f s %9.1f MiB/s %8.1f MiB %6.2fx' % (layout, r['op'], r['chunks'], r['time_s'],
+                                                                        r['mib_s'], r['size_mib'], r['ratio']))
+
+    return records
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--preset', default='small', choices=list(PRESETS))
+    parser.add_argument('--layouts', default=','.join(LAYOUTS), help='comma separated layouts ('+', '.join(LAYOUTS)+')')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dir', default='', help='directory for the stores (default a temporary directory)')
+    parser.add_argument('--save', default='', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    ds = SyntheticField(PRESETS[args.preset])
+    print('TREFHT '+str(dict(ds.sizes))+', '+str(round(ds['TREFHT'].nbytes/2**20, 1))+' MiB')
+
+    out_dir = tempfile.mkdtemp(prefix='bench_storage_', dir=args.dir if args.dir else None)
+    records = []
+    try:
+        for layout in args.layouts.split(','):
+            records += RunLayout(ds, layout, args.preset, args.repeat, out_dir)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    results = dict(meta=dict(date=datetime.datetime.now().isoformat(timespec='seconds'), host=platform.node(),
+                             machine=platform.machine(), cpus=os.cpu_count(), python=platform.python_version(),
+                             numpy=np.__version__, xarray=xr.__version__, dask=dask.__version__, repeat=args.repeat),
+                   results=records)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('wrote '+args.save)
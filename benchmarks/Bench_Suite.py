@@ -0,0 +1,342 @@
+'''
+Benchmark suite for the processing and statistics functions. Times every function and records peak memory on
+synthetic CESM2-shaped data (f09 atmosphere, gx1v7 sea ice, monthly and daily, 1-50 ensemble members) at several
+sizes and chunkings. Results are saved as JSON so a change can be compared against a saved baseline.
+Runs offline: the gx1v7 grid is replaced by a synthetic grid written to a temporary grid cache (no pop_tools).
+
+Usage:
+python Bench_Suite.py [--preset small|f09] [--cases FixGrid,InterPlevels] [--repeat 3] [--save results.json]
+python Bench_Suite.py --preset f09 --save new.json --baseline baseline.json [--tol 0.25]
+'''
+# Packages
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import datetime
+import tempfile
+import numpy as np
+import xarray as xr
+import pandas as pd
+import dask
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..', 'processing_code'))
+sys.path.insert(0, os.path.join(bench_dir, '..', 'plotting_code'))
+import Processing_functions as PF
+import Plotting_functions as PL
+from Resample_functions import ResampleTest
+from Bench_InterPlevels import SyntheticCAM, Measure
+
+# Sizes: nyear, nmember & freq lists are the values benchmarked, the rest are grid sizes
+PRESETS = {
+    'small': dict(nlat=48, nlon=72, nlev=8, nj=96, ni=80, nyear=[2], nmember=[1, 5], freq=['monthly', 'daily']),
+    'f09':   dict(nlat=192, nlon=288, nlev=32, nj=384, ni=320, nyear=[1, 10], nmember=[1, 10, 50], freq=['monthly', 'daily']),
+}
+
+# Chunkings: None keeps data in memory as numpy, -1 is one chunk along the dimension
+# 'tiles' is 2x2 spatial tiles (lat 96/lon 144, nj 192/ni 160 on the full grids, as in the processing notebooks)
+CHUNKINGS = ['numpy', 'time12', 'tiles']
+
+FREQ_NTIME = {'monthly': 12, 'daily': 365}
+
+def Chunks(name: str, p: dict) -> dict|None:
+    '''
+    Dask chunks for a named chunking and preset
+    '''
+    if name == 'numpy':
+        return None
+    if name == 'time12':
+        return {'time': 12, 'ensemble_member': 1}
+    return {'time': -1, 'ensemble_member': 1, 'lat': p['nlat']//2, 'lon': p['nlon']//2, 'nj': p['nj']//2, 'ni': p['ni']//2}
+
+def ApplyChunks(data: xr.DataArray|xr.Dataset, chunks: dict|None) -> xr.DataArray|xr.Dataset:
+    '''
+    Chunks data along the dimensions it has, or leaves numpy data as is
+    '''
+    if chunks is None:
+        return data
+    return data.chunk({d: c for d, c in chunks.items() if d in data.dims})
+
+def TimeCoord(freq: str, nyear: int) -> xr.CFTimeIndex:
+    '''
+    CESM time coordinate: monthly stamps at the end of each averaging period, daily on a noleap calendar
+    '''
+    if freq == 'monthly':
+        return xr.date_range('1950-02-01', periods=12*nyear, freq='MS', calendar='noleap', use_cftime=True)
+    return xr.date_range('1950-01-01', periods=365*nyear, freq='D', calendar='noleap', use_cftime=True)
+
+def SyntheticAtm(p: dict, freq: str, nyear: int, seed: int=0) -> xr.DataArray:
+    '''
+    Synthetic 2D CAM field (float32, like TREFHT) on the f09-shaped grid
+    '''
+    rng = np.random.default_rng(seed)
+    time = TimeCoord(freq, nyear)
+    vals = (250.+10.*rng.standard_normal((len(time), p['nlat'], p['nlon']))).astype(np.float32)
+
+    return xr.DataArray(vals, dims=('time','lat','lon'), name='TREFHT',
+                        coords={'time': time, 'lat': np.linspace(-90, 90, p['nlat']),
+                                'lon': np.linspace(0, 360, p['nlon'], endpoint=False)})
+
+def SyntheticIce(p: dict, freq: str, nyear: int) -> xr.DataArray:
+    '''
+    Synthetic CICE field (float32 aice, NaN over land) on the gx1v7-shaped grid
+    '''
+    rng = np.random.default_rng(0)
+    time = TimeCoord(freq, nyear)
+    vals = rng.uniform(0, 1, (len(time), p['nj'], p['ni'])).astype(np.float32)
+    vals[:, :p['nj']//8, :] = np.nan
+
+    return xr.DataArray(vals, dims=('time','nj','ni'), coords={'time': time}, name='aice')
+
+def SyntheticGrid(p: dict, cache_dir: str) -> None:
+    '''
+    Writes a synthetic gx1v7-shaped grid to the grid cache, so FixGrid never needs pop_tools
+    '''
+    tlat, tlong = np.meshgrid(np.linspace(-79, 89.5, p['nj']), np.linspace(0, 360, p['ni'], endpoint=False), indexing='ij')
+    tarea = 1e10*np.cos(np.deg2rad(tlat))
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(os.path.join(cache_dir, 'POP_gx1v7.npz'), TLAT=tlat, TLONG=tlong, TAREA=tarea)
+
+def SyntheticPvals(p: dict, nmember: int) -> xr.DataArray:
+    '''
+    Synthetic p-values by ensemble member & month on the f09-shaped grid, with a small significant region
+    '''
+    rng = np.random.default_rng(0)
+    pvals = rng.uniform(0, 1, (nmember, 12, p['nlat'], p['nlon']))
+    pvals[..., :p['nlat']//8, :] *= 1e-4
+
+    return xr.DataArray(pvals, dims=('ensemble_member','month','lat','lon'),
+                        coords={'ensemble_member': np.arange(1, nmember+1), 'month': np.arange(1, 13)})
+
+def StatDatasets(p: dict, nmember: int, chunks: dict|None) -> tuple:
+    '''
+    Synthetic monthly mean/std/n Datasets for a control run and an ensemble, as passed to CalcStatSig
+    '''
+    rng = np.random.default_rng(0)
+    coords = {'month': np.arange(1, 13), 'lat': np.linspace(-90, 90, p['nlat']), 'lon': np.linspace(0, 360, p['nlon'], endpoint=False)}
+    ens_coords = dict(coords, ensemble_member=np.arange(1, nmember+1))
+    shape = (12, p['nlat'], p['nlon'])
+    dims = ('month','lat','lon')
+
+    ctrl = [xr.Dataset({'TREFHT': (dims, v)}, coords=coords)
+            for v in (250.+rng.standard_normal(shape), 1.+rng.uniform(0, 1, shape), np.full(shape, 300.))]
+    ens = [xr.Dataset({'TREFHT': (('ensemble_member',)+dims, v)}, coords=ens_coords)
+           for v in (250.5+rng.standard_normal((nmember,)+shape), 1.+rng.uniform(0, 1, (nmember,)+shape), np.full((nmember,)+shape, 30.))]
+
+    return tuple(ApplyChunks(ds, chunks) for ds in ctrl+ens)
+
+# Cases: each takes (preset, freq, nyear, nmember, chunks, grid_dir) & returns the function to time
+# axes lists the benchmark axes the case is run over, other axes take their first value
+def Case_FixTime(p, freq, nyear, nmember, chunks, grid_dir):
+    da = ApplyChunks(SyntheticAtm(p, freq, nyear), chunks)
+    return lambda: PF.FixTime(da)
+
+def Case_FixLongitude(p, freq, nyear, nmember, chunks, grid_dir):
+    da = ApplyChunks(SyntheticAtm(p, freq, nyear), chunks)
+    return lambda: PF.FixLongitude(da, False).compute()
+
+def Case_AddCyclic(p, freq, nyear, nmember, chunks, grid_dir):
+    da = ApplyChunks(SyntheticAtm(p, freq, nyear), chunks)
+    return lambda: PF.FixLongitude(da, True).compute()
+
+def Case_FixGrid(p, freq, nyear, nmember, chunks, grid_dir):
+    da = ApplyChunks(SyntheticIce(p, freq, nyear), chunks)
+    return lambda: PF.FixGrid(da, 'gx1v7', cache_dir=grid_dir).compute()
+
+def Case_FixGrid_arctic(p, freq, nyear, nmember, chunks, grid_dir):
+    da = ApplyChunks(SyntheticIce(p, freq, nyear), chunks)
+    return lambda: PF.FixGrid(da, 'gx1v7', arctic=True, cache_dir=grid_dir).compute()
+
+def Case_InterPlevels(p, freq, nyear, nmember, chunks, grid_dir):
+    # 3D fields, one year of monthly data is the unit the processing notebooks interpolate
+    ds = SyntheticCAM(12, p['nlat'], p['nlon'], p['nlev'], ['U','V','T'])
+    ds = ds.assign_coords(time=TimeCoord('monthly', 1))
+    ds = ApplyChunks(ds, None if chunks is None else dict(chunks, lev=-1))
+    return lambda: PF.InterPlevels(ds, ['U','V','T']).compute()
+
+def Case_CalcStatforDim_month(p, freq, nyear, nmember, chunks, grid_dir):
+    da = ApplyChunks(SyntheticAtm(p, freq, nyear), chunks)
+    return lambda: PF.CalcStatforDim(da, 'time.month', 'time')
+
+def Case_CalcStatforDim_area(p, freq, nyear, nmember, chunks, grid_dir):
+    da = ApplyChunks(SyntheticAtm(p, freq, nyear), chunks)
+    return lambda: PF.CalcStatforDim(da, '', ['lat','lon'])
+
+def Case_CalcStatbyGrpDim(p, freq, nyear, nmember, chunks, grid_dir):
+    da = ApplyChunks(SyntheticAtm(p, freq, nyear), chunks)
+    return lambda: PF.CalcStatbyGrpDim(da, 'time.year', 'time.month', 'year', 'time', 'year')
+
+def Case_Ensemble(p, freq, nyear, nmember, chunks, grid_dir):
+    da_list = [ApplyChunks(SyntheticAtm(p, freq, nyear, seed=m), chunks) for m in range(nmember)]
+    ens_index = pd.Index(np.arange(1, nmember+1), name='ensemble_member')
+    return lambda: PF.Ensemble(da_list, ens_index).compute()
+
+def Case_Ensemble_mean(p, freq, nyear, nmember, chunks, grid_dir):
+    da_list = [ApplyChunks(SyntheticAtm(p, freq, nyear, seed=m), chunks) for m in range(nmember)]
+    ens_index = pd.Index(np.arange(1, nmember+1), name='ensemble_member')
+    return lambda: PF.Ensemble(da_list, ens_index, True, 'avg')
+
+def Case_Wilks_pcrit(p, freq, nyear, nmember, chunks, grid_dir):
+    # One map at a time, as in the previous CalcStatSig loop
+    pvals = SyntheticPvals(p, nmember).values
+    return lambda: [PF.Wilks_pcrit(pvals[e, m], 0.05) for e in range(nmember) for m in range(12)]
+
+def Case_Wilks_pcrit_batch(p, freq, nyear, nmember, chunks, grid_dir):
+    pvals = ApplyChunks(SyntheticPvals(p, nmember), chunks)
+    return lambda: PL.Wilks_pcrit_batch(pvals, 0.05).compute()
+
+def Case_t_test_two_means(p, freq, nyear, nmember, chunks, grid_dir):
+    c_avg, c_std, c_n, e_avg, e_std, e_n = [ds['TREFHT'] for ds in StatDatasets(p, nmember, chunks)]
+    return lambda: PL.t_test_two_means(e_avg, c_avg, e_std, c_std, e_n, c_n, 2, 0.)
+
+def Case_CalcStatSig(p, freq, nyear, nmember, chunks, grid_dir):
+    datasets = StatDatasets(p, nmember, chunks)
+    return lambda: PL.CalcStatSig(*[ds.copy() for ds in datasets], 'TREFHT', 'Wilks', 'All_members', 0).compute()
+
+def Case_ResampleTest(p, freq, nyear, nmember, chunks, grid_dir):
+    # Ensemble members against 30 control slices
+    rng = np.random.default_rng(0)
+    shape = (p['nlat'], p['nlon'])
+    data1 = ApplyChunks(xr.DataArray(rng.standard_normal((nmember,)+shape), dims=('ensemble_member','lat','lon')), chunks)
+    data2 = ApplyChunks(xr.DataArray(rng.standard_normal((30,)+shape), dims=('slice','lat','lon')), chunks)
+    return lambda: ResampleTest(data1, data2, ('ensemble_member','slice'), nresample=200).compute()
+
+CASES = {
+    'FixTime':                (Case_FixTime,              ['freq','nyear','chunks']),
+    'FixLongitude':           (Case_FixLongitude,         ['freq','nyear','chunks']),
+    'AddCyclic':              (Case_AddCyclic,            ['freq','nyear','chunks']),
+    'FixGrid':                (Case_FixGrid,              ['freq','nyear','chunks']),
+    'FixGrid_arctic':         (Case_FixGrid_arctic,       ['freq','nyear','chunks']),
+    'InterPlevels':           (Case_InterPlevels,         ['chunks']),
+    'CalcStatforDim_month':   (Case_CalcStatforDim_month, ['freq','nyear','chunks']),
+    'CalcStatforDim_area':    (Case_CalcStatforDim_area,  ['freq','nyear','chunks']),
+    'CalcStatbyGrpDim':       (Case_CalcStatbyGrpDim,     ['freq','nyear','chunks']),
+    'Ensemble':               (Case_Ensemble,             ['nmember','chunks']),
+    'Ensemble_mean':          (Case_Ensemble_mean,        ['nmember','chunks']),
+    'Wilks_pcrit':            (Case_Wilks_pcrit,          ['nmember']),
+    'Wilks_pcrit_batch':      (Case_Wilks_pcrit_batch,    ['nmember','chunks']),
+    't_test_two_means':       (Case_t_test_two_means,     ['nmember','chunks']),
+    'CalcStatSig':            (Case_CalcStatSig,          ['nmember','chunks']),
+    'ResampleTest':           (Case_ResampleTest,         ['nmember','chunks']),
+}
+
+def RunCase(name: str, preset: str, repeat: int, grid_dir: str, chunkings: list) -> list:
+    '''
+    Runs one case over its benchmark axes. Time is the fastest of repeat runs, peak memory is the largest
+    INPUT:
+    name: case name in CASES
+    preset: preset name in PRESETS
+    repeat: number of runs per configuration
+    grid_dir: synthetic grid cache directory
+    chunkings: list of chunking names to run
+
+    OUTPUT:
+    records: list of result dictionaries
+    '''
+    p = PRESETS[preset]
+    func, axes = CASES[name]
+    values = {'freq': p['freq'], 'nyear': p['nyear'], 'nmember': p['nmember'], 'chunks': chunkings}
+    values = {k: (v if k in axes else v[:1]) for k, v in values.items()}
+
+    records = []
+    for freq in values['freq']:
+        for nyear in values['nyear']:
+            for nmember in values['nmember']:
+                for chunk_name in values['chunks']:
+                    bench = func(p, freq, nyear, nmember, Chunks(chunk_name, p), grid_dir)
+                    times = []
+                    peaks = []
+                    for _ in range(repeat):
+                        _, elapsed, peak = Measure(bench)
+                        times.append(elapsed)
+                        peaks.append(peak)
+                    record = dict(case=name, preset=preset, freq=freq if 'freq' in axes else '',
+                                  nyear=nyear if 'nyear' in axes else 0, nmember=nmember if 'nmember' in axes else 0,
+                                  chunks=chunk_name, time_s=min(times), peak_mib=max(peaks))
+                    records.append(record)
+                    print('%-22s %-7s %-8s %3s yr %3s mem %-7s %9.3f s %9.1f MiB' %
+                          (name, preset, record['freq'], record['nyear'], record['nmember'], chunk_name,
+                           record['time_s'], record['peak_mib']))
+                    del bench
+
+    return records
+
+def RecordKey(record: dict) -> tuple:
+    '''
+    Configuration of a result, used to match results against a baseline
+    '''
+    return tuple(record[k] for k in ('case','preset','freq','nyear','nmember','chunks'))
+
+def CompareBaseline(records: list, baseline: dict, tol: float) -> int:
+    '''
+    Prints time & peak memory ratios against a baseline and counts regressions beyond tol (i.e. 0.25 = 25% slower)
+    '''
+    base = {RecordKey(r): r for r in baseline['results']}
+    nregress = 0
+    print('\n%-22s %-8s %3s %3s %-7s %8s %8s' % ('case','freq','yr','mem','chunks','time x','mem x'))
+    for r in records:
+        b = base.get(RecordKey(r))
+        if b is None:
+            continue
+        t_ratio = r['time_s']/b['time_s'] if b['time_s'] > 0 else np.nan
+        m_ratio = r['peak_mib']/b['peak_mib'] if b['peak_mib'] > 0 else np.nan
+        regress = (t_ratio > 1+tol) or (m_ratio > 1+tol)
+        nregress += int(regress)
+        print('%-22s %-8s %3s %3s %-7s %8.2f %8.2f %s' % (r['case'], r['freq'], r['nyear'], r['nmember'], r['chunks'],
+                                                        t_ratio, m_ratio, 'REGRESSION' if regress else ''))
+    print(str(nregress)+' regression(s) beyond '+str(int(100*tol))+'%')
+
+    return nregress
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--preset', default='small', choices=list(PRESETS))
+    parser.add_argument('--cases', default='', help='comma separated case names (default all)')
+    parser.add_argument('--chunks', default=','.join(CHUNKINGS), help='comma separated chunkings ('+', '.join(CHUNKINGS)+')')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scheduler', default='threads', choices=['threads','synchronous','processes'])
+    parser.add_argument('--save', default='', help='write results to this JSON file')
+    parser.add_argument('--baseline', default='', help='compare against results in this JSON file')
+    parser.add_argument('--tol', type=float, default=0.25, help='time/memory ratio above 1+tol counts as regression')
+    parser.add_argument('--list', action='store_true', help='list cases and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, (_, axes) in CASES.items():
+            print('%-22s %s' % (name, ', '.join(axes)))
+        sys.exit(0)
+
+    case_list = args.cases.split(',') if args.cases else list(CASES)
+    chunkings = args.chunks.split(',')
+    dask.config.set(scheduler=args.scheduler)
+
+    # Synthetic grid in a throwaway cache, so no pop_tools or network access is needed
+    grid_dir = tempfile.mkdtemp(prefix='bench_grid_')
+    SyntheticGrid(PRESETS[args.preset], grid_dir)
+
+    records = []
+    try:
+        for name in case_list:
+            records += RunCase(name, args.preset, args.repeat, grid_dir, chunkings)
+    finally:
+        shutil.rmtree(grid_dir, ignore_errors=True)
+
+    results = dict(meta=dict(date=datetime.datetime.now().isoformat(timespec='seconds'), host=platform.node(),
+                             machine=platform.machine(), cpus=os.cpu_count(), python=platform.python_version(),
+                             numpy=np.__version__, xarray=xr.__version__, dask=dask.__version__,
+                             scheduler=args.scheduler, repeat=args.repeat),
+                   results=records)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('wrote '+args.save)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        sys.exit(1 if CompareBaseline(records, baseline, args.tol) > 0 else 0)
@@ -1,16 +1,21 @@
+from __future__ import annotations
 import numpy as np
-import cartopy
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-import matplotlib.colors as colors
-from cartopy.mpl.gridliner import Gridliner
-from scipy import stats
-import matplotlib.path as mpath
 import xarray as xr
-from typing import List, Tuple
-from matplotlib.colors import Colormap, BoundaryNorm, ListedColormap
-from matplotlib.colorbar import Colorbar
-from matplotlib.axes import Axes
+from typing import List, Tuple, TYPE_CHECKING
+
+# cartopy, matplotlib & scipy load on first use (map helpers, colormaps, t-test), so the statistics functions
+# import quickly, i.e. on dask workers
+if TYPE_CHECKING:
+    from cartopy.mpl.gridliner import Gridliner
+    from matplotlib.colors import Colormap, BoundaryNorm
+    from matplotlib.axes import Axes
+
+# Stage profiling lives in processing_code/Profile_functions.py, functions run unprofiled if it is not on the path
+try:
+    from Profile_functions import profile_stage
+except ImportError:
+    def profile_stage(func):
+        return func
 
 ## Functions for plotting secondary axis with wavenumber/wavelength
 def wvn2wvl(x):
@@ -28,6 +33,7 @@ def p2z(x):
 def z2p(x):
     return p0*np.exp(-1*x/H)
 
+@profile_stage
 def t_test_two_means(m1: float|np.ndarray|xr.DataArray, m2: float|np.ndarray|xr.DataArray,
                      std1: float|np.ndarray|xr.DataArray, std2: float|np.ndarray|xr.DataArray,
                      n1: float|np.ndarray|xr.DataArray, n2: float|np.ndarray|xr.DataArray,
@@ -64,9 +70,11 @@ def t_test_two_means(m1: float|np.ndarray|xr.DataArray, m2: float|np.ndarray|xr.
     df = np.floor(df)
 
     # Calculate & return p-value
+    from scipy import stats
     pvalue = stats.t.sf(abs(tstat),df=df)*test_type
     return pvalue
 
+@profile_stage
 def Wilks_pcrit(pvalues: np.ndarray, siglevel: float) -> float:
     '''
     This function calcules the p-critical level for the Wilks significance test
@@ -78,29 +86,81 @@ def Wilks_pcrit(pvalues: np.ndarray, siglevel: float) -> float:
     OUTPUT:
     pcrit: Wilks p-critical value (i.e. any p-value less than this is significant)
     '''
+    # Same calculation as every slice of Wilks_pcrit_batch
+    return float(_wilks_pcrit_gufunc(np.ravel(pvalues), siglevel))
 
+def _wilks_pcrit_gufunc(pvalues: np.ndarray, siglevel: float) -> np.ndarray:
+    '''
+    Vectorized core of Wilks_pcrit_batch. Calculates the Wilks p-critical value over the last axis
+    of pvalues for every index of the leading axes at once
+
+    INPUT:
+    pvalues: array of p-values, spatial points flattened into the last axis
+    siglevel: significance level (i.e. 0.01 or 1%, 0.05 or 5%, ...)
+
+    OUTPUT:
+    pcrit: array of Wilks p-critical values with the shape of the leading axes
+    '''
     # Calculate false detection rate
     alpha_fdr = 2*siglevel
 
-    # Flatten p-values into 1D array & sort
-    pvalues_fl = pvalues.flatten()
-    pvalues_fl = np.sort(pvalues_fl)
+    # Sort p-values along spatial axis (NaNs sort to the end, like np.sort in Wilks_pcrit)
+    pvalues_fl = np.sort(pvalues, axis=-1)
+    npts = pvalues_fl.shape[-1]
+
+    # Generate array to calculate differences, broadcast over all leading axes
+    y = (np.arange(1,npts+1,1,dtype=float)/npts)*alpha_fdr
+
+    # Calculate differences & find first p-value where p-value > y
+    exceed = (pvalues_fl-y) > 0.0
+    any_exceed = exceed.any(axis=-1)
+    k = np.argmax(exceed, axis=-1)
+
+    # p-value just below the first exceedance (clip keeps k == 0 in bounds, it is masked below)
+    below = np.take_along_axis(pvalues_fl, np.clip(k-1,0,None)[...,np.newaxis], axis=-1)[...,0]
+
+    # Largest finite p-value (NaNs are sorted after it), NaN only if the whole slice is NaN
+    nvalid = np.count_nonzero(~np.isnan(pvalues_fl), axis=-1)
+    largest = np.take_along_axis(pvalues_fl, np.clip(nvalid-1,0,None)[...,np.newaxis], axis=-1)[...,0]
+
+    # None of the p-values are significant: 0, all are significant: largest p-value, else p-value below k
+    pcrit = np.where(k == 0, 0.0, below)
+    pcrit = np.where(any_exceed, pcrit, largest)
+
+    return pcrit
+
+@profile_stage
+def Wilks_pcrit_batch(pvalues: xr.DataArray, siglevel: float, core_dims: List[str]|Tuple[str,...]=('lat','lon')) -> xr.DataArray:
+    '''
+    Calculates the Wilks p-critical value for every non-spatial index of a p-value DataArray at once
+    (i.e. every ensemble member and month/season/year). Equivalent to calling Wilks_pcrit on each 2D
+    slice, but sorts all slices in one vectorized call and works chunk by chunk on dask arrays. NaN p-values
+    (i.e. masked points) are never significant
+
+    INPUT:
+    pvalues: DataArray of p-values
+    siglevel: significance level (i.e. 0.01 or 1%, 0.05 or 5%, ...)
+    core_dims: (optional) spatial dimension(s) the p-critical value is calculated over. defaults to ('lat','lon')
 
-    # Generate arrays to calculate differences
-    x = np.arange(1,len(pvalues_fl)+1,1)
-    x = x.astype(float)
-    y = (x/len(x))*alpha_fdr
+    OUTPUT:
+    pcrit: DataArray of Wilks p-critical values with the non-spatial dimensions and coordinates of pvalues
+    '''
+    core_dims = list(core_dims)
 
-    # Calculate differences
-    d = pvalues_fl-y
+    # Stack spatial dimension(s) into a single dimension so each slice is sorted as a flattened field
+    pvalues_st = pvalues.stack(_wilks_pts=core_dims)
 
-    # Grab index of first p-value where p-value > y
-    k = np.where(d>0)[0][0]
+    # Apply vectorized p-critical along the stacked spatial dimension
+    pcrit = xr.apply_ufunc(_wilks_pcrit_gufunc, pvalues_st,
+                           input_core_dims=[['_wilks_pts']],
+                           kwargs={'siglevel': siglevel},
+                           dask='parallelized',
+                           output_dtypes=[float],
+                           dask_gufunc_kwargs=dict(allow_rechunk=True))
 
-    # Find p-critical value & return it
-    pcrit = 0.0 if k == 0 else pvalues_fl[k-1]
     return pcrit
 
+@profile_stage
 def CustomCmap(levels: List[float]|np.ndarray, colorlist: List|Colormap, extremes: List, list: bool=True) -> Tuple[Colormap, BoundaryNorm]:
     '''
     Creates a custom colormap and normalization from a list of colors or a cmap
@@ -117,6 +177,8 @@ def CustomCmap(levels: List[float]|np.ndarray, colorlist: List|Colormap, extreme
     norm: custom normalization
     '''
 
+    from matplotlib.colors import ListedColormap, BoundaryNorm
+
     # Create custom cmap from list of colors
     if list:
         cmap = (ListedColormap(colorlist).with_extremes(under=extremes[0], over=extremes[-1]))
@@ -131,6 +193,7 @@ def CustomCmap(levels: List[float]|np.ndarray, colorlist: List|Colormap, extreme
 
     return cmap, norm
 
+@profile_stage
 def draw_circle(ax: Axes, grdln_x_maj: List[float]|np.ndarray=np.arange(-180,181,30), grdln_y_maj: List[float]|np.ndarray=np.arange(-90,91,10),
                 draw_circ: bool=True, draw_major: bool=True, draw_major_labels: bool=True, draw_minor: bool=False,
                 grdln_x_min: List[float]|np.ndarray=np.arange(-180,181,15), grdln_y_min: List[float]|np.ndarray=np.arange(-90,91,5),
@@ -154,7 +217,9 @@ def draw_circle(ax: Axes, grdln_x_maj: List[float]|np.ndarray=np.arange(-180,181
     maj_gl: major gridlines object
     min_gl: (optional) minor gridlines object
     '''
-    
+    import cartopy.crs as ccrs
+    import matplotlib.path as mpath
+
     if draw_circ:
         # Get unit circle
         circle_path = mpath.Path.unit_circle()
@@ -189,11 +254,11 @@ def draw_circle(ax: Axes, grdln_x_maj: List[float]|np.ndarray=np.arange(-180,181
     
 
 # Variables for this function
-ens_dict1 = {'Mean': '', 'All_members': 'ensemble_member'}
 ens_dict2 = {'Mean': (), 'All_members': ('ensemble_member',)}
 time_dict = {0: 'month', 1: 'year', 2: 'season', 3: ''}
 
 
+@profile_stage
 def CalcStatSig(control_data_avg: xr.Dataset, control_data_std: xr.Dataset, control_data_n: xr.Dataset, 
                 optics_data_avg: xr.Dataset, optics_data_std: xr.Dataset, optics_data_n: xr.Dataset,
                 var: str, sig: str, ens_type: str, time_avg: int) -> xr.Dataset:
@@ -217,21 +282,11 @@ def CalcStatSig(control_data_avg: xr.Dataset, control_data_std: xr.Dataset, cont
     optics_data_avg: variable average for the optics run with the p-values and p-critical values added as variables
     '''
     # Get appropriate values from ens_dict and time_dict
-    e_dim = ens_dict1[ens_type]
     t_dim = time_dict[time_avg]
 
-    # Set up dimensions list for p-critical values
-    pcdims = (e_dim,t_dim)
-
     # Set up dimensions list for p-values
     pdims = ens_dict2[ens_type]+(t_dim,'lat','lon') if time_avg != 3 else ens_dict2[ens_type]+('lat','lon')
 
-    # Set up index list based on ensemble type
-    ens_list = np.arange(1) if ens_type == 'Mean' else np.arange(control_data_avg.sizes['ensemble_member'])
-
-    # Set up index list based on time averaging
-    time_list = np.arange(1) if time_avg == 3 else np.arange(control_data_avg.sizes[t_dim])
-
     # If variable is FLUT or FLDS do 1-sided t-test, otherwise 2-sided t-test
     if np.logical_or(var == 'FLDS',var == 'FLUT'):
         alt = 1
@@ -246,21 +301,9 @@ def CalcStatSig(control_data_avg: xr.Dataset, control_data_std: xr.Dataset, cont
     optics_data_avg['pvals_'+var] = (pdims,pvals)
 
     if sig == 'Wilks':
-        # Calculate Wilks p-critical
+        # Calculate Wilks p-critical for all months/years & ensemble members at once
+        # Output keeps the ensemble_member and time dimensions of the p-values (none if averaged away)
         siglevel = 0.05
-        pcrit = np.zeros([len(ens_list),len(time_list)])
-
-        # Loop through all months/years & ensemble members
-        for i in time_list:
-            # Set time part of index
-            index = dict() if time_avg == 3 else {t_dim: i}
-            for j in ens_list:
-                # Set time/ensemble index
-                index = index.update({e_dim: j}) if ens_type == 'All_members' else index
-
-                # Calculate p-critical
-                pcrit[j,i] = Wilks_pcrit(optics_data_avg['pvals_'+var][index].values,siglevel)
-
-        optics_data_avg['pcrit_'+var] = (pcdims,pcrit)
+        optics_data_avg['pcrit_'+var] = Wilks_pcrit_batch(optics_data_avg['pvals_'+var],siglevel,('lat','lon'))
 
     return optics_data_avg
\ No newline at end of file
@@ -0,0 +1,377 @@
+# Packages
+import os
+import math
+import time
+import hashlib
+import collections
+import numpy as np
+import xarray as xr
+from typing import Dict, List, Tuple
+from Plotting_functions import CustomCmap, profile_stage
+
+# Cache hits show up in stage profiles when processing_code/Profile_functions.py is on the path
+try:
+    from Profile_functions import RegisterCache
+except ImportError:
+    def RegisterCache(name, info):
+        return None
+
+# Per-process caches: projected map backgrounds by projection, extent & features, projected mesh coordinates
+# by grid & projection, and CustomCmap outputs by levels & colors. Workers of RenderBatch fill their own
+_BACKGROUNDS = {}
+_MESHES = {}
+_CMAPS = {}
+_CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'currsize'])
+_COUNTS = {'hits': 0, 'misses': 0}
+
+def RenderCacheInfo():
+    '''
+    Hits & misses of the background, mesh, and colormap caches in this process
+    '''
+    return _CacheInfo(_COUNTS['hits'], _COUNTS['misses'], len(_BACKGROUNDS)+len(_MESHES)+len(_CMAPS))
+
+RegisterCache('render', RenderCacheInfo)
+
+def _cached(cache: Dict, key: str, build):
+    '''
+    Looks up key in cache, building & storing the value on a miss
+    '''
+    if key in cache:
+        _COUNTS['hits'] += 1
+    else:
+        _COUNTS['misses'] += 1
+        cache[key] = build()
+
+    return cache[key]
+
+def _hash(*parts) -> str:
+    '''
+    sha1 of arrays (by dtype, shape & bytes) and other values (by repr)
+    '''
+    h = hashlib.sha1()
+    for p in parts:
+        if isinstance(p, np.ndarray):
+            h.update(str((p.dtype, p.shape)).encode())
+            h.update(np.ascontiguousarray(p).tobytes())
+        else:
+            h.update(repr(p).encode())
+
+    return h.hexdigest()
+
+def Projection(proj):
+    '''
+    cartopy CRS from a name (i.e. 'NorthPolarStereo'), (name, keyword arguments), or a CRS
+    '''
+    import cartopy.crs as ccrs
+
+    if isinstance(proj, str):
+        return getattr(ccrs, proj)()
+    if isinstance(proj, tuple):
+        return getattr(ccrs, proj[0])(**proj[1])
+
+    return proj
+
+def _proj_key(proj) -> str:
+    return Projection(proj).proj4_init
+
+def CachedCmap(levels: List[float]|np.ndarray, colorlist, extremes: List, list: bool=True) -> Tuple:
+    '''
+    CustomCmap, computed once per levels, colors & extremes and reused for every panel using them
+    (same inputs & outputs as Plotting_functions.CustomCmap)
+    '''
+    from matplotlib.colors import to_rgba_array
+
+    levels = np.asarray(levels, dtype=np.float64)
+    colors = to_rgba_array(colorlist) if list else colorlist(np.linspace(0, 1, len(levels)-1))
+    ext = to_rgba_array([colorlist.get_under(), colorlist.get_over()] if not list else extremes)
+    key = _hash(levels, colors, ext, list)
+
+    return _cached(_CMAPS, key, lambda: CustomCmap(levels, colorlist, extremes, list))
+
+def _default_features(land: bool, resolution: str) -> List[Tuple]:
+    '''
+    Natural Earth land (as AxisLabels in the plotting notebooks) & coastlines (as ax.coastlines) with their styles
+    '''
+    import cartopy.feature as cfeature
+
+    features = []
+    if land:
+        features.append((cfeature.NaturalEarthFeature('physical', 'land', resolution),
+                         dict(facecolor=cfeature.COLORS['land'], edgecolor='none', zorder=3)))
+    features.append((cfeature.NaturalEarthFeature('physical', 'coastline', resolution),
+                     dict(facecolor='none', edgecolor='black', zorder=4)))
+
+    return features
+
+def _feature_key(features: List[Tuple]) -> str:
+    '''
+    Cache key of background features, Natural Earth features by name, others by object identity
+    '''
+    parts = []
+    for feature, style in features:
+        name = (getattr(feature, 'category', None), getattr(feature, 'name', None), getattr(feature, 'scale', None))
+        parts.append((name if name[1] is not None else id(feature), sorted(style.items())))
+
+    return repr(parts)
+
+def _build_background(proj, extent: List[float], features: List[Tuple], circle: bool, gridlines: Dict|None) -> Dict:
+    '''
+    Projects the map extent, circular boundary, features & gridlines once into projection coordinates
+    '''
+    import shapely.geometry as sgeom
+    import cartopy.crs as ccrs
+    from matplotlib.figure import Figure
+    from matplotlib.path import Path
+    from cartopy.mpl.path import shapely_to_path
+
+    crs = Projection(proj)
+    pc = ccrs.PlateCarree()
+
+    # Axis limits from set_extent on a throwaway axis
+    ax = Figure().add_subplot(projection=crs)
+    ax.set_extent(extent, pc)
+    xlim, ylim = ax.get_xlim(), ax.get_ylim()
+    domain = sgeom.box(xlim[0], ylim[0], xlim[1], ylim[1])
+
+    # Circle as in draw_circle
+    boundary = None
+    if circle:
+        unit = Path.unit_circle()
+        boundary = Path(unit.vertices.copy()*ylim[1]*0.9, unit.codes.copy())
+
+    # Feature geometries projected & clipped to the map, merged into one path per feature
+    feature_paths = []
+    for feature, style in features:
+        paths = []
+        for geom in feature.geometries():
+            geom = crs.project_geometry(geom, feature.crs)
+            if not geom.intersects(domain):
+                continue
+            geom = geom.intersection(domain)
+            if not geom.is_empty:
+                paths.append(shapely_to_path(geom))
+        if len(paths) > 0:
+            feature_paths.append((Path.make_compound_path(*paths), style))
+
+    # Gridlines as densely sampled meridians & parallels (no labels, use draw_circle for labelled gridlines)
+    grid_path = None
+    if gridlines is not None:
+        lons = np.asarray(gridlines.get('lons', np.arange(-180, 181, 30)), dtype=np.float64)
+        lats = np.asarray(gridlines.get('lats', np.arange(-90, 91, 10)), dtype=np.float64)
+        lat_lo, lat_hi = max(extent[2], -89.99), min(extent[3], 89.99)
+        lines = [np.column_stack([np.full(100, lon), np.linspace(lat_lo, lat_hi, 100)]) for lon in lons]
+        lines += [np.column_stack([np.linspace(-180, 180, 361), np.full(361, lat)]) for lat in lats if lat_lo <= lat <= lat_hi]
+        verts = []
+        codes = []
+        for line in lines:
+            xy = crs.transform_points(pc, line[:, 0], line[:, 1])[:, :2]
+            verts.append(xy)
+            codes.append(np.r_[Path.MOVETO, np.full(len(xy)-1, Path.LINETO)])
+        grid_path = Path(np.concatenate(verts), np.concatenate(codes).astype(Path.code_type))
+
+    return dict(xlim=xlim, ylim=ylim, boundary=boundary, features=feature_paths, gridlines=grid_path)
+
+def PolarBackground(proj='NorthPolarStereo', extent: List[float]=[-180, 180, 50, 90], land: bool=False,
+                    circle: bool=True, gridlines: Dict|None=None, features: List[Tuple]|None=None,
+                    resolution: str='110m') -> Dict:
+    '''
+    Projected map background (limits, circular boundary, land, coastlines, gridlines), built once per projection,
+    extent & features in each process and reused for every panel
+    INPUT:
+    proj: (optional) projection name, (name, keyword arguments), or cartopy CRS. default is 'NorthPolarStereo'
+    extent: (optional) [lon min, lon max, lat min, lat max]. default is [-180, 180, 50, 90]
+    land: (optional) boolean for filling land (i.e. for aice). default is False
+    circle: (optional) boolean for the circular boundary of draw_circle. default is True
+    gridlines: (optional) dictionary of 'lons' & 'lats' for unlabelled gridlines. default is None (no gridlines)
+    features: (optional) list of (cartopy Feature, PathPatch style) replacing land & coastlines
+    resolution: (optional) Natural Earth resolution. default is '110m'
+
+    OUTPUT:
+    bg: dictionary of xlim, ylim, boundary, features, gridlines in projection coordinates
+    '''
+    features = _default_features(land, resolution) if features is None else features
+    key = _hash(_proj_key(proj), list(extent), _feature_key(features), circle,
+                None if gridlines is None else {k: list(v) for k, v in gridlines.items()})
+
+    return _cached(_BACKGROUNDS, key, lambda: _build_background(proj, extent, features, circle, gridlines))
+
+def ApplyBackground(ax, bg: Dict) -> None:
+    '''
+    Draws a PolarBackground on a GeoAxes of the same projection (replaces set_extent, coastlines, add_feature &
+    draw_circle without labels)
+    '''
+    from matplotlib.patches import PathPatch
+
+    ax.set_xlim(bg['xlim'])
+    ax.set_ylim(bg['ylim'])
+    if bg['boundary'] is not None:
+        ax.set_boundary(bg['boundary'])
+    for path, style in bg['features']:
+        ax.add_patch(PathPatch(path, transform=ax.transData, **style))
+    if bg['gridlines'] is not None:
+        ax.add_patch(PathPatch(bg['gridlines'], transform=ax.transData, facecolor='none', zorder=10,
+                               linewidth=0.5, edgecolor='#d8dcd6', linestyle='--'))
+
+def ProjectedMesh(lon: np.ndarray, lat: np.ndarray, proj='NorthPolarStereo') -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Grid coordinates projected once per grid & projection, so panels are contoured directly in projection
+    coordinates instead of transforming every field (as contourf with transform=PlateCarree does)
+    INPUT:
+    lon, lat: 1D coordinates (meshed) or 2D coordinates (i.e. CICE TLON/TLAT)
+    proj: (optional) projection name, (name, keyword arguments), or cartopy CRS. default is 'NorthPolarStereo'
+
+    OUTPUT:
+    x, y: 2D projected coordinates (lat, lon)
+    '''
+    import cartopy.crs as ccrs
+
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+
+    def build():
+        lon2, lat2 = np.meshgrid(lon, lat) if lon.ndim == 1 else (lon, lat)
+        xy = Projection(proj).transform_points(ccrs.PlateCarree(), lon2, lat2)
+        x, y = xy[..., 0].copy(), xy[..., 1].copy()
+        x.setflags(write=False)
+        y.setflags(write=False)
+        return x, y
+
+    return _cached(_MESHES, _hash(lon, lat, _proj_key(proj)), build)
+
+def DrawPanel(ax, panel: Dict, proj='NorthPolarStereo', bg: Dict|None=None):
+    '''
+    Draws one map panel: background, filled contours, p-value hatching & title
+    INPUT:
+    ax: GeoAxes with projection proj
+    panel: dictionary of
+           data: 2D DataArray
+           levels: contour levels
+           cmap: Colormap, or (colorlist, extremes, list) for CachedCmap
+           x, y: (optional) coordinate names. default is 'lon', 'lat'
+           pvals, pcrit: (optional) 2D p-value DataArray & critical p-value, significant points are hatched
+           hatch: (optional) hatch pattern. default is '...'
+           title: (optional) title
+    proj: (optional) projection of ax. default is 'NorthPolarStereo'
+    bg: (optional) PolarBackground. default is None (no background)
+
+    OUTPUT:
+    cs: filled contour set (for the colorbar)
+    '''
+    if bg is not None:
+        ApplyBackground(ax, bg)
+
+    x, y = panel.get('x', 'lon'), panel.get('y', 'lat')
+    da = panel['data'].transpose(y, x)
+    xx, yy = ProjectedMesh(da[x].values, da[y].values, proj)
+
+    cmap = panel['cmap']
+    norm = None
+    if isinstance(cmap, tuple):
+        cmap, norm = CachedCmap(panel['levels'], *cmap)
+    cs = ax.contourf(xx, yy, da.values, levels=panel['levels'], cmap=cmap, norm=norm, extend='both', zorder=1)
+
+    if panel.get('pvals') is not None:
+        pv = panel['pvals'].transpose(y, x)
+        px, py = ProjectedMesh(pv[x].values, pv[y].values, proj)
+        ax.contourf(px, py, pv.values, levels=[-0.01, panel['pcrit'], 1], hatches=[panel.get('hatch', '...'), None],
+                    colors='none', zorder=2)
+
+    if panel.get('title') is not None:
+        ax.set_title(panel['title'], fontsize=10)
+
+    return cs
+
+@profile_stage
+def RenderFigure(spec: Dict) -> Dict:
+    '''
+    Renders one figure of map panels to a file, without pyplot (safe in worker processes & threads). Output is
+    deterministic: no creation dates or random ids are written, so unchanged figures are byte identical
+    INPUT:
+    spec: dictionary of
+          path: output file (format from extension)
+          panels: list of panel dictionaries (see DrawPanel) filling shape row by row, None leaves a panel empty
+          shape: (rows, columns)
+          figsize: (optional) figure size in inches. default is (2*columns, 2*rows) as in the plotting notebooks
+          proj: (optional) projection. default is 'NorthPolarStereo'
+          background: (optional) PolarBackground keyword arguments. default is {} (coastlines, circle, 50-90N)
+          colorbar: (optional) dictionary of label, ticks & fig.colorbar keyword arguments. default is None
+          dpi: (optional) resolution for raster formats. default is 150
+
+    OUTPUT:
+    timing: dictionary of path, setup_s, draw_s, save_s, total_s & pid
+    '''
+    import matplotlib
+    from matplotlib.figure import Figure
+
+    t0 = time.perf_counter()
+    proj = spec.get('proj', 'NorthPolarStereo')
+    bg = PolarBackground(proj, **spec.get('background', {}))
+    nrow, ncol = spec['shape']
+    fig = Figure(figsize=spec.get('figsize', (2*ncol, 2*nrow)), layout='constrained')
+    axes = fig.subplots(nrow, ncol, squeeze=False, subplot_kw=dict(projection=Projection(proj)))
+    t1 = time.perf_counter()
+
+    cs = None
+    for ax, panel in zip(axes.ravel(), spec['panels']+[None]*(nrow*ncol-len(spec['panels']))):
+        if panel is None:
+            ax.set_visible(False)
+            continue
+        cs = DrawPanel(ax, panel, proj, bg)
+
+    cbar = spec.get('colorbar')
+    if cbar is not None and cs is not None:
+        kwargs = dict(pad=0.1, shrink=0.75, fraction=0.1, extend='both')
+        kwargs.update(cbar.get('kwargs', {}))
+        cb = fig.colorbar(cs, ax=axes, **kwargs)
+        cb.set_label(label=cbar.get('label', ''), fontsize=12)
+        cb.ax.tick_params(labelsize=12)
+        if cbar.get('ticks') is not None:
+            cb.set_ticks(ticks=cbar['ticks'])
+    t2 = time.perf_counter()
+
+    # No timestamps or random ids in the output
+    fmt = os.path.splitext(spec['path'])[1].lstrip('.').lower()
+    metadata = {'pdf': {'CreationDate': None, 'ModDate': None}, 'svg': {'Date': None}, 'png': {'Software': None}}.get(fmt)
+    with matplotlib.rc_context({'svg.hashsalt': 'arctic-wind-contribution', 'pdf.compression': 6}):
+        fig.savefig(spec['path'], dpi=spec.get('dpi', 150), bbox_inches='tight', metadata=metadata)
+    t3 = time.perf_counter()
+
+    return dict(path=spec['path'], setup_s=t1-t0, draw_s=t2-t1, save_s=t3-t2, total_s=t3-t0, pid=os.getpid())
+
+def RenderBatch(specs: List[Dict], processes: int|None=None, verbose: bool=True) -> List[Dict]:
+    '''
+    Renders figures in a process pool. Figures go to workers in contiguous blocks, so figures sharing a
+    background, grid & colormap (i.e. the months of one variable) reuse each worker's caches. Output files do not
+    depend on the number of processes
+    INPUT:
+    specs: list of figure specifications (see RenderFigure)
+    processes: (optional) number of worker processes, 1 renders in this process. defaults to the cores available
+    verbose: (optional) boolean for printing timing of every figure. default is True
+
+    OUTPUT:
+    timings: list of RenderFigure timings, in the order of specs
+    '''
+    if processes is None:
+        try:
+            processes = len(os.sched_getaffinity(0))
+        except AttributeError:
+            processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(specs)))
+
+    t0 = time.perf_counter()
+    if processes == 1:
+        timings = [RenderFigure(spec) for spec in specs]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(processes) as pool:
+            timings = list(pool.map(RenderFigure, specs, chunksize=max(1, math.ceil(len(specs)/processes))))
+    wall = time.perf_counter()-t0
+
+    if verbose:
+        for t in timings:
+            print('%-60s %7.2f s (setup %.2f, draw %.2f, save %.2f) pid %d' %
+                  (os.path.basename(t['path']), t['total_s'], t['setup_s'], t['draw_s'], t['save_s'], t['pid']))
+        print(str(len(timings))+' figures in %.2f s on %d process(es)' % (wall, processes))
+
+    return timings
@@ -0,0 +1,163 @@
+import numpy as np
+import xarray as xr
+from typing import Tuple
+
+def PermutationWeights(n1: int, n2: int, nresample: int, seed: int=0) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Generates permutation resamples of two pooled samples as indicator matrices, so group means for every
+    resample and grid point are a single matrix multiply
+
+    INPUT:
+    n1: sample 1 size
+    n2: sample 2 size
+    nresample: number of permutations
+    seed: (optional) random seed. defaults to 0
+
+    OUTPUT:
+    w1: (nresample, n1+n2) indicator of pooled values assigned to sample 1
+    w2: (nresample, n1+n2) indicator of pooled values assigned to sample 2
+    '''
+    rng = np.random.default_rng(seed)
+
+    # Random permutation of pooled sample positions for each resample
+    perms = rng.permuted(np.tile(np.arange(n1+n2), (nresample, 1)), axis=1)
+
+    # First n1 permuted positions go to sample 1, the rest to sample 2
+    w1 = np.zeros((nresample, n1+n2))
+    np.put_along_axis(w1, perms[:, :n1], 1.0, axis=1)
+    w2 = 1.0-w1
+
+    return w1, w2
+
+def BlockBootstrapWeights(n: int, nresample: int, block_len: int=1, seed: int=0) -> np.ndarray:
+    '''
+    Generates circular block bootstrap resamples of one sample (i.e. years) as count matrices. Blocks of
+    block_len consecutive values keep autocorrelation within each resample
+
+    INPUT:
+    n: sample size
+    nresample: number of resamples
+    block_len: (optional) block length. defaults to 1 (ordinary bootstrap)
+    seed: (optional) random seed. defaults to 0
+
+    OUTPUT:
+    counts: (nresample, n) number of times each value is drawn in each resample
+    '''
+    rng = np.random.default_rng(seed)
+    nblock = int(np.ceil(n/block_len))
+
+    # Random block starts, wrapping around the end of the sample, truncated to n values
+    starts = rng.integers(0, n, size=(nresample, nblock))
+    idx = ((starts[:, :, np.newaxis]+np.arange(block_len)).reshape(nresample, -1)[:, :n]) % n
+
+    # Count draws of each value
+    counts = np.zeros((nresample, n))
+    np.add.at(counts, (np.arange(nresample)[:, np.newaxis], idx), 1.0)
+
+    return counts
+
+def _resample_pvalues(x1: np.ndarray, x2: np.ndarray, w1: np.ndarray, w2: np.ndarray, center: bool,
+                      test_type: int, batch_size: int) -> np.ndarray:
+    '''
+    Vectorized core of ResampleTest. Calculates p-values of the difference in means for every grid point,
+    processing resamples in batches to bound memory
+
+    INPUT:
+    x1: sample 1 values, sample along the last axis
+    x2: sample 2 values, sample along the last axis
+    w1: (nresample, n1+n2) resample weights of pooled values for sample 1
+    w2: (nresample, n1+n2) resample weights of pooled values for sample 2
+    center: subtract the observed difference from resampled differences (bootstrap) or not (permutation)
+    test_type: whether the test is one (1) or two tailed (2)
+    batch_size: number of resamples per batch
+
+    OUTPUT:
+    pvalue: p values with the shape of the leading axes
+    '''
+    n1 = x1.shape[-1]
+    shape = np.broadcast_shapes(x1.shape[:-1], x2.shape[:-1])
+
+    # Pool samples & flatten grid points, missing values get zero weight
+    x = np.concatenate([np.broadcast_to(x1, shape+x1.shape[-1:]), np.broadcast_to(x2, shape+x2.shape[-1:])], axis=-1)
+    x = x.reshape(-1, x.shape[-1]).astype(np.float64)
+    valid = (~np.isnan(x)).astype(np.float64)
+    x = np.nan_to_num(x)
+
+    # Observed difference between means
+    with np.errstate(invalid='ignore', divide='ignore'):
+        diff_obs = x[:, :n1].sum(-1)/valid[:, :n1].sum(-1) - x[:, n1:].sum(-1)/valid[:, n1:].sum(-1)
+    diff_abs = np.abs(diff_obs)[:, np.newaxis]
+    diff_sign = np.sign(diff_obs)[:, np.newaxis]
+
+    # Count resamples at least as extreme as observed, one batch at a time
+    count = np.zeros(x.shape[0])
+    for start in range(0, w1.shape[0], batch_size):
+        b1 = w1[start:start+batch_size].T
+        b2 = w2[start:start+batch_size].T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            diff = (x @ b1)/(valid @ b1) - (x @ b2)/(valid @ b2)
+        if center:
+            diff = diff-diff_obs[:, np.newaxis]
+
+        if test_type == 2:
+            count += (np.abs(diff) >= diff_abs).sum(-1)
+        else:
+            count += (diff_sign*diff >= diff_abs).sum(-1)
+
+    # Calculate p-value, including observed sample
+    pvalue = (1.0+count)/(1.0+w1.shape[0])
+    pvalue = np.where(np.isnan(diff_obs), np.nan, pvalue)
+
+    return pvalue.reshape(shape)
+
+def ResampleTest(data1: xr.DataArray|xr.Dataset, data2: xr.DataArray|xr.Dataset, dim: str|Tuple[str, str],
+                 method: str='permutation', test_type: int=2, nresample: int=1000, block_len: int=1,
+                 seed: int=0, batch_size: int=100) -> xr.DataArray|xr.Dataset:
+    '''
+    This function calculates the p-values for the difference between two means with a resampling test, as an
+    alternative to t_test_two_means that does not assume normality. Resamples are generated once and reused for
+    every grid point and variable. Works chunk by chunk on dask arrays, so grid points are tested in parallel.
+    Output p-values can go straight into Wilks_pcrit_batch
+
+    INPUT:
+    data1: sample 1 (i.e. nudged ensemble members), DataArray or Dataset
+    data2: sample 2 (i.e. piControl slices), DataArray or Dataset with the same variables as data1
+    dim: sample dimension, or (sample 1 dimension, sample 2 dimension) if they differ
+    method: (optional) 'permutation' of pooled samples or 'bootstrap' (block bootstrap of each sample). defaults to 'permutation'
+    test_type: (optional) whether the test is one (1) or two tailed (2). defaults to 2
+    nresample: (optional) number of resamples. defaults to 1000
+    block_len: (optional) block length for 'bootstrap' (i.e. years). defaults to 1
+    seed: (optional) random seed. defaults to 0
+    batch_size: (optional) number of resamples held in memory at once per chunk. defaults to 100
+
+    OUTPUT:
+    pvalue: p values with the non-sample dimensions of data1 and data2
+    '''
+    if (test_type != 1) and (test_type != 2):
+        raise ValueError('\'test_type\' value  must be 1 or 2')
+
+    dim1, dim2 = (dim, dim) if isinstance(dim, str) else dim
+    n1 = data1.sizes[dim1]
+    n2 = data2.sizes[dim2]
+
+    # Generate resample weights once for all grid points & variables
+    if method == 'permutation':
+        w1, w2 = PermutationWeights(n1, n2, nresample, seed)
+    elif method == 'bootstrap':
+        w1 = np.concatenate([BlockBootstrapWeights(n1, nresample, block_len, seed), np.zeros((nresample, n2))], axis=1)
+        w2 = np.concatenate([np.zeros((nresample, n1)), BlockBootstrapWeights(n2, nresample, block_len, seed+1)], axis=1)
+    else:
+        raise ValueError('\'method\' value  must be \'permutation\' or \'bootstrap\'')
+
+    # Sample dimensions can differ in size, so give sample 2 its own core dimension name
+    data2 = data2.rename({dim2: '_sample2'})
+
+    pvalue = xr.apply_ufunc(_resample_pvalues, data1, data2,
+                            input_core_dims=[[dim1], ['_sample2']],
+                            kwargs=dict(w1=w1, w2=w2, center=(method == 'bootstrap'),
+                                        test_type=test_type, batch_size=batch_size),
+                            dask='parallelized',
+                            output_dtypes=[float],
+                            dask_gufunc_kwargs=dict(allow_rechunk=True))
+
+    return pvalue
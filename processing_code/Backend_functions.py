@@ -0,0 +1,299 @@
+# Packages
+import os
+import math
+import collections
+import contextlib
+import numpy as np
+from typing import Callable, Dict, Iterable, Iterator, List
+
+# Execution backends: dask on PBS batch jobs (as in the notebooks), a dask LocalCluster, a concurrent.futures
+# process pool (dask's multiprocessing scheduler), or serial (single-threaded dask, easiest to debug)
+BACKENDS = ('pbs', 'local', 'processes', 'serial')
+
+# Worker memory needed per chunk held, covering input, output and temporaries of the processing kernels
+CHUNK_MEMORY_FACTOR = 6
+
+# Memory kept back for the operating system & the client process
+MEMORY_HEADROOM = 0.85
+
+# Fractions of the worker memory limit at which dask.distributed workers start spilling to disk
+# (target, spill), stop accepting new tasks (pause, i.e. backpressure), and are restarted (terminate)
+SPILL_DEFAULTS = dict(target=0.6, spill=0.7, pause=0.8, terminate=0.95)
+
+# PBS settings of the processing notebooks
+PBS_DEFAULTS = dict(cores=1, memory='25GiB', queue='casper', walltime='02:00:00')
+PBS_WORKERS = 4*9
+
+def MachineResources() -> Dict[str, int]:
+    '''
+    Cores & memory (bytes) available to this process, respecting CPU affinity and cgroup (container/batch job)
+    memory limits
+    '''
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+
+    memory = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            memory = min(memory, int(limit))
+
+    return dict(cores=cores, memory=memory)
+
+def ChunkBytes(obj) -> int:
+    '''
+    Size in bytes of the largest dask chunk of a DataArray, Dataset or dask array (whole array if not chunked)
+    '''
+    arrays = [v.data for v in obj.variables.values()] if hasattr(obj, 'data_vars') else [getattr(obj, 'data', obj)]
+
+    nbytes = 0
+    for a in arrays:
+        chunks = getattr(a, 'chunks', None)
+        if chunks:
+            nbytes = max(nbytes, int(np.prod([max(c) for c in chunks]))*a.dtype.itemsize)
+        else:
+            nbytes = max(nbytes, int(a.nbytes))
+
+    return nbytes
+
+def AutoSize(chunk_bytes: int=0, cores: int|None=None, memory: int|None=None, threads_per_worker: int=1) -> Dict[str, int]:
+    '''
+    Number of workers & memory limit per worker for a machine, so every worker can hold the chunks it works on
+    INPUT:
+    chunk_bytes: (optional) largest chunk size in bytes (see ChunkBytes). default is 0 (one worker per core)
+    cores: (optional) cores to use. defaults to MachineResources
+    memory: (optional) memory (bytes) to use. defaults to MachineResources
+    threads_per_worker: (optional) threads per worker. default is 1 (processing kernels hold the GIL in places)
+
+    OUTPUT:
+    sizes: dictionary of n_workers, threads_per_worker, memory_limit (bytes per worker)
+    '''
+    machine = MachineResources()
+    cores = machine['cores'] if cores is None else cores
+    memory = int((machine['memory'] if memory is None else memory)*MEMORY_HEADROOM)
+
+    # Memory bound: every thread works on one chunk at a time
+    per_worker = CHUNK_MEMORY_FACTOR*chunk_bytes*threads_per_worker
+    n_workers = max(1, cores//threads_per_worker)
+    if per_worker > 0:
+        n_workers = max(1, min(n_workers, memory//per_worker))
+
+    return dict(n_workers=int(n_workers), threads_per_worker=threads_per_worker, memory_limit=int(memory//n_workers))
+
+def _spill_config(spill: Dict|None) -> Dict[str, float]:
+    '''
+    dask config keys for worker memory fractions
+    '''
+    spill = dict(SPILL_DEFAULTS, **({} if spill is None else spill))
+    for k in spill:
+        if k not in SPILL_DEFAULTS:
+            raise ValueError('\'spill\' keys must be among '+str(tuple(SPILL_DEFAULTS)))
+
+    return {'distributed.worker.memory.'+k: v for k, v in spill.items()}
+
+def _gib(nbytes: int) -> str:
+    return str(max(1, math.ceil(nbytes/2**30)))+'GiB'
+
+class Backend:
+    '''
+    Execution backend for the processing helpers, i.e.
+    with Backend('local', chunk_bytes=ChunkBytes(ds)) as backend:
+        ds_out = RunPipeline(..., backend=backend)
+    Inside the with block every dask compute runs on the backend
+    INPUT:
+    kind: (optional) one of BACKENDS, or 'auto' (serial on one core, else LocalCluster if dask.distributed is
+          installed, else process pool). default is 'auto'
+    n_workers: (optional) number of workers. defaults to AutoSize for local backends, PBS_WORKERS for pbs
+    memory_limit: (optional) memory limit per worker in bytes. defaults to AutoSize for local backends, or
+                  CHUNK_MEMORY_FACTOR chunks (at least PBS_DEFAULTS['memory']) for pbs
+    chunk_bytes: (optional) largest chunk size in bytes, for sizing workers. default is 0
+    threads_per_worker: (optional) threads per worker. default is 1
+    spill: (optional) dictionary overriding SPILL_DEFAULTS (dask.distributed backends only)
+    spill_dir: (optional) directory for spilled data. default is the dask default (temporary directory)
+    max_pending: (optional) most tasks submitted by map at once, so producers cannot run ahead of workers.
+                 defaults to 2 per worker
+    **cluster_kwargs: other arguments of PBSCluster (i.e. account, name) or LocalCluster
+    '''
+    def __init__(self, kind: str='auto', n_workers: int|None=None, memory_limit: int|None=None, chunk_bytes: int=0,
+                 threads_per_worker: int=1, spill: Dict|None=None, spill_dir: str|None=None,
+                 max_pending: int|None=None, **cluster_kwargs):
+        if kind == 'auto':
+            kind = _auto_kind()
+        if kind not in BACKENDS:
+            raise ValueError('\'kind\' value  must be \'auto\' or one of '+str(BACKENDS))
+        self.kind = kind
+
+        if kind == 'pbs':
+            n_workers = PBS_WORKERS if n_workers is None else n_workers
+            if memory_limit is None:
+                memory_limit = max(CHUNK_MEMORY_FACTOR*chunk_bytes*threads_per_worker, 25*2**30)
+            sizes = dict(n_workers=n_workers, threads_per_worker=threads_per_worker, memory_limit=memory_limit)
+        else:
+            sizes = AutoSize(chunk_bytes, threads_per_worker=threads_per_worker)
+            if n_workers is not None:
+                sizes['n_workers'] = n_workers
+            if kind == 'serial':
+                sizes['n_workers'] = 1
+            if memory_limit is not None:
+                sizes['memory_limit'] = memory_limit
+
+        self.n_workers = sizes['n_workers']
+        self.threads_per_worker = sizes['threads_per_worker']
+        self.memory_limit = sizes['memory_limit']
+        self.spill = _spill_config(spill)
+        self.spill_dir = spill_dir
+        self.max_pending = 2*self.n_workers if max_pending is None else max_pending
+        self.cluster_kwargs = cluster_kwargs
+
+        self.cluster = None
+        self.client = None
+        self.pool = None
+        self._config = None
+
+    def __repr__(self):
+        return ('Backend('+self.kind+', n_workers='+str(self.n_workers)+', threads_per_worker='+str(self.threads_per_worker)+
+                ', memory_limit='+_gib(self.memory_limit)+')')
+
+    def start(self) -> 'Backend':
+        '''
+        Starts the workers & makes the backend the default dask scheduler
+        '''
+        import dask
+
+        if self.kind in ('pbs', 'local'):
+            self._config = dask.config.set(self.spill)
+            self._config.__enter__()
+            from dask.distributed import Client
+            self.cluster = self._pbs_cluster() if self.kind == 'pbs' else self._local_cluster()
+            self.client = Client(self.cluster)
+        elif self.kind == 'processes':
+            from concurrent.futures import ProcessPoolExecutor
+            self.pool = ProcessPoolExecutor(self.n_workers)
+            self._config = dask.config.set(scheduler='processes', pool=self.pool, num_workers=self.n_workers)
+            self._config.__enter__()
+        else:
+            self._config = dask.config.set(scheduler='synchronous')
+            self._config.__enter__()
+
+        return self
+
+    def _pbs_cluster(self):
+        from dask_jobqueue import PBSCluster
+
+        # Spill & backpressure settings reach the batch workers through their environment
+        prologue = ['export DASK_'+k.upper().replace('.', '__')+'='+str(v) for k, v in self.spill.items()]
+        kwargs = dict(PBS_DEFAULTS, memory=_gib(self.memory_limit), cores=self.threads_per_worker,
+                      job_script_prologue=prologue)
+        if self.spill_dir is not None:
+            kwargs['local_directory'] = self.spill_dir
+        kwargs.update(self.cluster_kwargs)
+        cluster = PBSCluster(**kwargs)
+        cluster.scale(self.n_workers)
+
+        return cluster
+
+    def _local_cluster(self):
+        from dask.distributed import LocalCluster
+
+        kwargs = dict(n_workers=self.n_workers, threads_per_worker=self.threads_per_worker, memory_limit=self.memory_limit,
+                      processes=True)
+        if self.spill_dir is not None:
+            kwargs['local_directory'] = self.spill_dir
+        kwargs.update(self.cluster_kwargs)
+
+        return LocalCluster(**kwargs)
+
+    def close(self) -> None:
+        '''
+        Shuts down workers & restores the previous dask scheduler
+        '''
+        if self.client is not None:
+            self.client.close()
+            self.cluster.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self._config is not None:
+            self._config.__exit__(None, None, None)
+        self.cluster = self.client = self.pool = self._config = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def compute(self, *collections):
+        '''
+        Computes dask collections (i.e. DataArrays, Datasets) on the backend, as dask.compute
+        '''
+        import dask
+
+        with self._scheduler():
+            out = dask.compute(*collections)
+
+        return out[0] if len(collections) == 1 else out
+
+    @contextlib.contextmanager
+    def _scheduler(self):
+        '''
+        Uses this backend for dask computes inside the block, whether or not it was started with a with block
+        '''
+        import dask
+
+        if self.client is not None:
+            with dask.config.set(scheduler=self.client.get):
+                yield
+        elif self.pool is not None:
+            with dask.config.set(scheduler='processes', pool=self.pool, num_workers=self.n_workers):
+                yield
+        elif self.kind == 'serial':
+            with dask.config.set(scheduler='synchronous'):
+                yield
+        else:
+            raise RuntimeError('Backend is not started, use Backend.start() or a with block')
+
+    def map(self, func: Callable, items: Iterable, *args, **kwargs) -> Iterator:
+        '''
+        Applies func(item, *args, **kwargs) to every item on the workers, yielding results in order. At most
+        max_pending calls are in flight, so a generator of items (i.e. opened ensemble members) is consumed only
+        as fast as workers finish
+        '''
+        if self.kind == 'serial':
+            for item in items:
+                yield func(item, *args, **kwargs)
+            return
+
+        if self.client is not None:
+            submit = lambda item: self.client.submit(func, item, *args, pure=False, **kwargs)
+        elif self.pool is not None:
+            submit = lambda item: self.pool.submit(func, item, *args, **kwargs)
+        else:
+            raise RuntimeError('Backend is not started, use Backend.start() or a with block')
+
+        pending = collections.deque()
+        for item in items:
+            if len(pending) >= self.max_pending:
+                yield pending.popleft().result()
+            pending.append(submit(item))
+        while pending:
+            yield pending.popleft().result()
+
+def _auto_kind() -> str:
+    '''
+    Backend for 'auto': serial on one core, else LocalCluster if dask.distributed is installed, else process pool
+    '''
+    if MachineResources()['cores'] == 1:
+        return 'serial'
+    try:
+        import distributed
+    except ImportError:
+        return 'processes'
+
+    return 'local'
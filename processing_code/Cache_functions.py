@@ -0,0 +1,293 @@
+# Packages
+import os
+import json
+import time
+import glob
+import shutil
+import hashlib
+import collections
+import functools
+import xarray as xr
+from typing import Callable, Dict, List
+from Profile_functions import RegisterCache
+
+# Default result cache & its size limit, override with the ARCTIC_RESULT_CACHE & ARCTIC_RESULT_CACHE_GB environment variables
+RESULT_CACHE_DIR = os.environ.get('ARCTIC_RESULT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'arctic-wind-contribution', 'results'))
+RESULT_CACHE_MAX_BYTES = int(float(os.environ.get('ARCTIC_RESULT_CACHE_GB', 50))*2**30)
+
+META_FILE = 'meta.json'
+
+# Hit/miss counts of this process
+_CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'currsize'])
+_COUNTS = {'hits': 0, 'misses': 0}
+
+def ResultCacheInfo():
+    '''
+    Hits & misses of the result cache in this process
+    '''
+    return _CacheInfo(_COUNTS['hits'], _COUNTS['misses'], None)
+
+RegisterCache('result', ResultCacheInfo)
+
+def _path_size_mtime(path: str) -> tuple:
+    '''
+    Total size & latest modification time of a file or directory (i.e. zarr store)
+    '''
+    if os.path.isfile(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    size = 0
+    mtime = os.stat(path).st_mtime_ns
+    for root, _, files in os.walk(path):
+        for f in files:
+            st = os.stat(os.path.join(root, f))
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime_ns)
+
+    return size, mtime
+
+def _checksum(path: str) -> str:
+    '''
+    sha1 of the contents of a file or directory
+    '''
+    h = hashlib.sha1()
+    paths = [path] if os.path.isfile(path) else sorted(os.path.join(r, f) for r, _, fs in os.walk(path) for f in fs)
+    for p in paths:
+        h.update(os.path.relpath(p, path).encode())
+        with open(p, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                h.update(block)
+
+    return h.hexdigest()
+
+def FileIdentity(paths: str|List[str], checksum: bool=False) -> List[list]:
+    '''
+    Identity of input files: absolute path with size & modification time, or with a content checksum
+    INPUT:
+    paths: file/zarr path, glob pattern, or list of these
+    checksum: (optional) boolean for hashing file contents instead of size & modification time (slower, but
+              survives copies & touches). default is False
+
+    OUTPUT:
+    identity: sorted list of [path, size, mtime] or [path, checksum]
+    '''
+    paths = [paths] if isinstance(paths, str) else list(paths)
+    files = sorted(set(os.path.abspath(f) for p in paths for f in (glob.glob(p) if any(c in p for c in '*?[') else [p])))
+
+    identity = []
+    for f in files:
+        if not os.path.exists(f):
+            raise FileNotFoundError(f)
+        identity.append([f, _checksum(f)] if checksum else [f, *_path_size_mtime(f)])
+
+    return identity
+
+def CacheKey(func: Callable|str, args: tuple=(), kwargs: Dict|None=None, inputs: str|List[str]|None=None,
+             params: Dict|None=None, checksum: bool=False) -> str:
+    '''
+    Content address of a result: hash of the function name, input file identities, arguments and parameters
+    '''
+    from dask.base import tokenize
+
+    name = func if isinstance(func, str) else func.__module__+'.'+func.__qualname__
+    ident = [] if inputs is None else FileIdentity(inputs, checksum)
+    token = tokenize(args, {} if kwargs is None else kwargs, {} if params is None else params)
+
+    return hashlib.sha1(json.dumps([name, ident, token]).encode()).hexdigest()
+
+def _entry_path(key: str, cache_dir: str|None) -> str:
+    return os.path.join(RESULT_CACHE_DIR if cache_dir is None else cache_dir, key)
+
+def _read_meta(path: str) -> Dict:
+    with open(os.path.join(path, META_FILE)) as f:
+        return json.load(f)
+
+def _write_meta(path: str, meta: Dict) -> None:
+    tmp_path = os.path.join(path, META_FILE+'.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, META_FILE))
+
+def _write_result(result, path: str) -> str:
+    '''
+    Writes a Dataset, DataArray, or tuple/list of these to zarr groups in path, returns kind of result
+    '''
+    items = list(result) if isinstance(result, (tuple, list)) else [result]
+    kinds = []
+    for i, item in enumerate(items):
+        if isinstance(item, xr.DataArray):
+            kinds.append(['DataArray', item.name])
+            item = item.to_dataset(name=item.name if item.name is not None else '_da')
+        elif isinstance(item, xr.Dataset):
+            kinds.append(['Dataset', None])
+        else:
+            raise TypeError('Cached results must be xarray Datasets/DataArrays or tuples of them, got '+str(type(item)))
+
+        # Chunk encodings from the source stores need not fit the result
+        item = item.copy()
+        for v in item.variables:
+            item[v].encoding = {}
+        item.to_zarr(path, group='out'+str(i), mode='w' if i == 0 else 'a')
+
+    return json.dumps(dict(items=kinds, sequence=type(result).__name__ if isinstance(result, (tuple, list)) else None))
+
+def _open_result(path: str, kind: str, chunks: Dict|None):
+    '''
+    Opens a cached result lazily in the form it was stored
+    '''
+    kind = json.loads(kind)
+    items = []
+    for i, (k, name) in enumerate(kind['items']):
+        ds = xr.open_zarr(path, group='out'+str(i), chunks=chunks)
+        items.append(ds[name if name is not None else '_da'].rename(name) if k == 'DataArray' else ds)
+
+    if kind['sequence'] is None:
+        return items[0]
+
+    return tuple(items) if kind['sequence'] == 'tuple' else items
+
+def _entries(cache_dir: str) -> List[Dict]:
+    '''
+    Metadata of every complete cache entry
+    '''
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for key in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, key)
+        if os.path.isfile(os.path.join(path, META_FILE)):
+            entries.append(dict(_read_meta(path), key=key, path=path))
+
+    return entries
+
+def CacheSize(cache_dir: str|None=None) -> int:
+    '''
+    Total size of cached results in bytes
+    '''
+    cache_dir = RESULT_CACHE_DIR if cache_dir is None else cache_dir
+    total = 0
+    for entry in _entries(cache_dir):
+        total += entry['size']
+
+    return total
+
+def EvictCache(max_bytes: int|None=None, cache_dir: str|None=None, keep: str|None=None) -> List[str]:
+    '''
+    Removes least recently used results until the cache fits in max_bytes
+    INPUT:
+    max_bytes: (optional) size limit in bytes. defaults to RESULT_CACHE_MAX_BYTES
+    cache_dir: (optional) cache directory. defaults to RESULT_CACHE_DIR
+    keep: (optional) key never evicted (i.e. the result just written). default is None
+
+    OUTPUT:
+    evicted: list of removed keys
+    '''
+    max_bytes = RESULT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = sorted(_entries(RESULT_CACHE_DIR if cache_dir is None else cache_dir), key=lambda e: e['last_access'])
+    total = sum(e['size'] for e in entries)
+
+    evicted = []
+    for e in entries:
+        if total <= max_bytes:
+            break
+        if e['key'] == keep:
+            continue
+        shutil.rmtree(e['path'], ignore_errors=True)
+        total -= e['size']
+        evicted.append(e['key'])
+
+    return evicted
+
+def InvalidateCache(func: Callable|str|None=None, key: str|None=None, cache_dir: str|None=None) -> List[str]:
+    '''
+    Removes cached results of a function, a single result by key, or every result if neither is given
+    INPUT:
+    func: (optional) function or its name (module.qualname, or just qualname)
+    key: (optional) result key
+    cache_dir: (optional) cache directory. defaults to RESULT_CACHE_DIR
+
+    OUTPUT:
+    removed: list of removed keys
+    '''
+    name = func if (func is None or isinstance(func, str)) else func.__module__+'.'+func.__qualname__
+
+    removed = []
+    for e in _entries(RESULT_CACHE_DIR if cache_dir is None else cache_dir):
+        if key is not None and e['key'] != key:
+            continue
+        if name is not None and name not in (e['func'], e['func'].split('.')[-1]):
+            continue
+        shutil.rmtree(e['path'], ignore_errors=True)
+        removed.append(e['key'])
+
+    return removed
+
+def CachedResult(func: Callable, *args, inputs: str|List[str]|None=None, params: Dict|None=None,
+                 cache_dir: str|None=None, max_bytes: int|None=None, checksum: bool=False,
+                 chunks: Dict|None=None, refresh: bool=False, **kwargs):
+    '''
+    Returns func(*args, **kwargs) from the result cache if its inputs, arguments and parameters have not changed,
+    otherwise computes it, stores it as zarr and evicts least recently used results over the size limit.
+    Results are returned lazily from the store either way
+    INPUT:
+    func: function returning a Dataset, DataArray, or tuple/list of these
+    *args, **kwargs: arguments of func
+    inputs: (optional) files/zarr stores/globs func reads. changing any of them changes the key
+    params: (optional) other settings func depends on (i.e. notebook globals such as ds_names, time_avg)
+    cache_dir: (optional) cache directory. defaults to RESULT_CACHE_DIR
+    max_bytes: (optional) cache size limit in bytes. defaults to RESULT_CACHE_MAX_BYTES
+    checksum: (optional) boolean for identifying inputs by content instead of size & mtime. default is False
+    chunks: (optional) dask chunks for opening the result. defaults to store chunks
+    refresh: (optional) boolean for recomputing even if cached. default is False
+
+    OUTPUT:
+    result: cached result of func
+    '''
+    key = CacheKey(func, args, kwargs, inputs, params, checksum)
+    path = _entry_path(key, cache_dir)
+
+    if not refresh and os.path.isfile(os.path.join(path, META_FILE)):
+        _COUNTS['hits'] += 1
+        meta = _read_meta(path)
+        meta['last_access'] = time.time()
+        _write_meta(path, meta)
+        return _open_result(path, meta['kind'], chunks)
+    _COUNTS['misses'] += 1
+
+    # Write to temporary store & rename, so a killed job never leaves a partial result behind
+    result = func(*args, **kwargs)
+    tmp_path = path+'.tmp-'+str(os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    kind = _write_result(result, tmp_path)
+    now = time.time()
+    _write_meta(tmp_path, dict(func=func.__module__+'.'+func.__qualname__, kind=kind, created=now, last_access=now,
+                               size=_path_size_mtime(tmp_path)[0], inputs=FileIdentity(inputs) if inputs else [],
+                               params=repr(params)))
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+    EvictCache(max_bytes, cache_dir, keep=key)
+
+    return _open_result(path, kind, chunks)
+
+def cached(inputs: Callable|None=None, params: Callable|Dict|None=None, **cache_kwargs) -> Callable:
+    '''
+    Decorator form of CachedResult, i.e.
+    @cached(inputs=lambda varname: glob.glob(path_to_expdata+'*'+varname+'*'), params=lambda varname: dict(time_avg=time_avg))
+    def CreateMasterDS(varname): ...
+    INPUT:
+    inputs: (optional) function of the call arguments returning the input files
+    params: (optional) dictionary, or function of the call arguments returning one, of other settings to key on
+    **cache_kwargs: other CachedResult options (cache_dir, max_bytes, checksum, chunks)
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            call_inputs = inputs(*args, **kwargs) if callable(inputs) else inputs
+            call_params = params(*args, **kwargs) if callable(params) else params
+            return CachedResult(func, *args, inputs=call_inputs, params=call_params, **cache_kwargs, **kwargs)
+        return wrapper
+
+    return decorator
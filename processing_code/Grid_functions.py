@@ -0,0 +1,126 @@
+# Packages
+import os
+import numpy as np
+import xarray as xr
+from functools import lru_cache
+from typing import Dict, Tuple
+
+# Default on-disk grid cache, override with the ARCTIC_GRID_CACHE environment variable
+GRID_CACHE_DIR = os.environ.get('ARCTIC_GRID_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'arctic-wind-contribution', 'grids'))
+
+# Arctic subdomain of the CICE gx1v7 grid used for sea ice analysis
+ARCTIC_SUBDOMAIN = dict(nj=slice(250,385))
+
+# Grid variables attached by FixGrid
+GRID_VARS = ('TLAT', 'TLONG', 'TAREA')
+
+def GridCachePath(grid: str, cache_dir: str|None=None) -> str:
+    '''
+    Path of the on-disk cache file for a POP/CICE grid
+    INPUT:
+    grid: grid name (i.e. 'gx1v7')
+    cache_dir: (optional) cache directory. defaults to GRID_CACHE_DIR
+
+    OUTPUT:
+    path: path to npz cache file
+    '''
+    cache_dir = GRID_CACHE_DIR if cache_dir is None else cache_dir
+    return os.path.join(cache_dir, 'POP_'+grid+'.npz')
+
+def BuildGrid(grid: str) -> Dict[str, np.ndarray]:
+    '''
+    Builds POP/CICE grid arrays from pop_tools (needs pop_tools and, on first use, its data download)
+    INPUT:
+    grid: grid name (i.e. 'gx1v7')
+
+    OUTPUT:
+    grid_arrs: dictionary of TLAT, TLONG (degrees) and TAREA (m^2) numpy arrays
+    '''
+    import pop_tools
+
+    # Get CICE grid from pop_tools
+    ds_grid = pop_tools.get_grid('POP_'+grid)
+
+    # Change tarea to m2 instead of cm2
+    grid_arrs = {v: ds_grid[v].values for v in GRID_VARS}
+    grid_arrs['TAREA'] = grid_arrs['TAREA']/(1e4)
+
+    return grid_arrs
+
+def SaveGrid(grid: str, cache_dir: str|None=None) -> str:
+    '''
+    Builds a grid with pop_tools and writes it to the on-disk cache. Run once on a machine with pop_tools
+    data available, workers then load the cache with no network access
+    INPUT:
+    grid: grid name (i.e. 'gx1v7')
+    cache_dir: (optional) cache directory. defaults to GRID_CACHE_DIR
+
+    OUTPUT:
+    path: path to npz cache file
+    '''
+    path = GridCachePath(grid, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write to temporary file & rename so concurrent workers never read a partial file
+    tmp_path = path+'.'+str(os.getpid())+'.tmp.npz'
+    np.savez(tmp_path, **BuildGrid(grid))
+    os.replace(tmp_path, path)
+
+    return path
+
+@lru_cache(maxsize=8)
+def _load_grid_cached(grid: str, cache_dir: str|None, nj: Tuple|None, ni: Tuple|None) -> Dict[str, np.ndarray]:
+    '''
+    In-process LRU cache behind LoadGrid, keyed by grid name, cache directory and subdomain
+    '''
+    path = GridCachePath(grid, cache_dir)
+
+    # Load from disk cache, or build & populate it on first use
+    if not os.path.isfile(path):
+        SaveGrid(grid, cache_dir)
+    with np.load(path) as npz:
+        grid_arrs = {v: npz[v] for v in GRID_VARS}
+
+    # Cut subdomain once so every call reuses the smaller arrays
+    index = (slice(*nj) if nj is not None else slice(None), slice(*ni) if ni is not None else slice(None))
+    for v in GRID_VARS:
+        arr = np.ascontiguousarray(grid_arrs[v][index])
+
+        # Arrays are shared by reference between calls, so make them read only
+        arr.setflags(write=False)
+        grid_arrs[v] = arr
+
+    return grid_arrs
+
+def LoadGrid(grid: str, cache_dir: str|None=None, subdomain: Dict[str, slice]|None=None) -> Dict[str, np.ndarray]:
+    '''
+    Loads POP/CICE grid arrays from the in-process cache, then the on-disk cache, then pop_tools
+    INPUT:
+    grid: grid name (i.e. 'gx1v7')
+    cache_dir: (optional) cache directory. defaults to GRID_CACHE_DIR
+    subdomain: (optional) dictionary of nj/ni index slices (i.e. ARCTIC_SUBDOMAIN). defaults to full grid
+
+    OUTPUT:
+    grid_arrs: dictionary of read-only TLAT, TLONG (degrees) and TAREA (m^2) numpy arrays
+    '''
+    subdomain = dict() if subdomain is None else subdomain
+
+    # Slices are not hashable, key the cache on their start/stop/step
+    nj = subdomain.get('nj')
+    ni = subdomain.get('ni')
+    nj = None if nj is None else (nj.start, nj.stop, nj.step)
+    ni = None if ni is None else (ni.start, ni.stop, ni.step)
+
+    return _load_grid_cached(grid, cache_dir, nj, ni)
+
+def GridCacheInfo():
+    '''
+    Hits, misses and size of the in-process grid cache
+    '''
+    return _load_grid_cached.cache_info()
+
+def ClearGridCache() -> None:
+    '''
+    Clears the in-process grid cache (the on-disk cache is left alone)
+    '''
+    _load_grid_cached.cache_clear()
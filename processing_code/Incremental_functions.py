@@ -0,0 +1,252 @@
+# Packages
+import os
+import json
+import shutil
+import numpy as np
+import xarray as xr
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from Stats_functions import CalcMomentPartials, MergeMomentPartials, MomentsFromPartials
+from Trend_functions import CalcOLSPartials, MergeOLSPartials, OLSFromPartials, SplitYearMonth
+from Region_functions import LatWeights
+from Precision_functions import Compact, PackedRanges, PackEncoding, ClipPacked
+from Backend_functions import Backend
+
+def StoredTimes(store: str, group: str|None=None, dim: str='time') -> np.ndarray:
+    '''
+    Time coordinate already in a zarr store, empty if the store (or group) does not exist yet
+    '''
+    if not os.path.exists(store):
+        return np.array([])
+    try:
+        return xr.open_zarr(store, group=group)[dim].values
+    except (FileNotFoundError, KeyError):
+        return np.array([])
+
+def NewSlices(data: xr.DataArray|xr.Dataset, store: str, group: str|None=None, dim: str='time') -> xr.DataArray|xr.Dataset:
+    '''
+    Part of data after the last time in a zarr store (all of it if the store does not exist). Times already stored
+    are skipped, so running an update twice appends nothing the second time
+    INPUT:
+    data: DataArray or Dataset
+    store: zarr store path
+    group: (optional) zarr group. default is None
+    dim: (optional) time dimension. defaults to 'time'
+
+    OUTPUT:
+    data_new: data after the end of the store
+    '''
+    stored = StoredTimes(store, group, dim)
+    if stored.size == 0:
+        return data
+
+    times = data[dim].values
+    new = ~np.isin(times, stored)
+    if np.any(new & (times <= stored[-1])):
+        raise ValueError('New times before the end of '+store+' can not be appended, rewrite the store instead')
+
+    return data.isel({dim: new})
+
+def AppendStore(ds: xr.Dataset|xr.DataArray, store: str, group: str|None=None, dim: str='time',
+                pack: bool|Dict[str, Tuple[float, float]]=False, backend: Backend|None=None, verbose: bool=False) -> int:
+    '''
+    Appends the time steps of ds after the end of a zarr store, one year at a time: the next year is computed
+    while the previous one is written. Creates the store if it does not exist. Chunks, compression & packing of
+    an existing store are kept
+    INPUT:
+    ds: Dataset or named DataArray (lazy), i.e. the full 1950-2024 processed timeseries
+    store: zarr store path
+    group: (optional) zarr group. default is None
+    dim: (optional) time dimension. defaults to 'time'
+    pack: (optional) variables stored as scaled int16 when the store is created (see PlanEncoding). default is False
+    backend: (optional) started Backend computing every year. default is None (current dask scheduler)
+    verbose: (optional) boolean for printing progress. default is False
+
+    OUTPUT:
+    ntime: number of time steps appended
+    '''
+    if isinstance(ds, xr.DataArray):
+        ds = ds.to_dataset()
+    created = StoredTimes(store, group, dim).size > 0
+    ds = NewSlices(ds, store, group, dim)
+    if ds.sizes[dim] == 0:
+        return 0
+
+    ranges = PackedRanges(ds, pack)
+    ds = ClipPacked(ds, ranges)
+
+    # Encodings carried over from the source files would clash with the store's
+    ds = ds.copy()
+    for v in ds.variables:
+        ds[v].encoding = {}
+
+    years = ds[dim].dt.year.values
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        pending = None
+        for yr in np.unique(years):
+            ds_unit = ds.isel({dim: years == yr})
+            ds_unit = ds_unit.compute() if backend is None else backend.compute(ds_unit)
+
+            # Writes stay in time order
+            if pending is not None:
+                pending.result()
+            if verbose:
+                print('   appending '+str(yr))
+            if not created:
+                encoding = {v: PackEncoding(*r) for v, r in ranges.items()}
+                pending = writer.submit(ds_unit.to_zarr, store, group=group, mode='w', encoding=encoding)
+                created = True
+            else:
+                # Variables without dim (i.e. grid coordinates) are already in the store
+                ds_unit = ds_unit.drop_vars([v for v in ds_unit.variables if dim not in ds_unit[v].dims])
+                pending = writer.submit(ds_unit.to_zarr, store, group=group, append_dim=dim)
+        if pending is not None:
+            pending.result()
+
+    return int(ds.sizes[dim])
+
+def AccumPath(store: str, name: str, group: str|None=None) -> str:
+    '''
+    Path of the accumulators of a statistic next to a store (as the RunPipeline checkpoint)
+    '''
+    return store.rstrip('/')+('' if group is None else '.'+group)+'.'+name+'.accum.zarr'
+
+def _read_accum(path: str, config: dict) -> xr.Dataset|None:
+    '''
+    Stored accumulators, None if there are none yet. Accumulators of another statistic raise ValueError
+    '''
+    if not os.path.exists(path):
+        return None
+    ds_acc = xr.open_zarr(path).load()
+    if json.loads(ds_acc.attrs['config']) != config:
+        raise ValueError('Accumulators at '+path+' were made with '+ds_acc.attrs['config']+', not '+json.dumps(config))
+
+    return ds_acc
+
+def _write_accum(path: str, ds_acc: xr.Dataset) -> None:
+    '''
+    Writes accumulators to a temporary store then swaps it in, so a killed job never leaves them half written
+    '''
+    tmp_path = path+'.tmp-'+str(os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    ds_acc.to_zarr(tmp_path, mode='w')
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+def _new_times(da: xr.DataArray, ds_acc: xr.Dataset|None, dim: str) -> xr.DataArray:
+    '''
+    Part of da after the last time already accumulated
+    '''
+    if ds_acc is None:
+        return da
+    return da.isel({dim: da[dim].values > ds_acc['last_time'].values[0]})
+
+def UpdateMoments(da_new: xr.DataArray, store: str, name: str, grpdim: str|List[str], dims: str|List[str],
+                  weights: xr.DataArray|None=None, group: str|None=None, dim: str='time') -> Tuple[xr.DataArray, xr.DataArray, xr.DataArray]:
+    '''
+    Updates stored mean/std/count accumulators (moment partials) with new time steps & returns the statistics of
+    all data so far, as CalcStatforDim on the whole record. Time steps already accumulated are skipped. Grouping
+    by ['time.year', 'time.month'] keeps yearly partials, so CalcStatbyGrpDim style statistics follow from the
+    small stored means. grpdim & dims are in the order of CalcStatforDim
+    INPUT:
+    da_new: DataArray with new time steps (earlier ones are skipped, so the whole record can be passed)
+    store: zarr store the statistic belongs to (accumulators are kept at AccumPath(store, name, group))
+    name: name of the statistic (i.e. 'TREFHT.month')
+    grpdim: variable or list of variables to group by (i.e. 'time.month'), '' for no grouping
+    dims: dimension(s) to calculate statistics over, including dim
+    weights: (optional) DataArray of weights. defaults to cos(lat) if lat is one of dims, else equal weights
+    group: (optional) zarr group of store. default is None
+    dim: (optional) time dimension. defaults to 'time'
+
+    OUTPUT:
+    da_avg: DataArray mean over dimension(s)
+    da_std: DataArray standard deviation over dimension(s)
+    da_n: DataArray count over dimension(s)
+    '''
+    dims = [dims] if isinstance(dims, str) else list(dims)
+    if dim not in dims:
+        raise ValueError('\'dims\' must include \''+dim+'\'')
+    if weights is None and 'lat' in dims:
+        weights = LatWeights(da_new.lat)
+
+    path = AccumPath(store, name, group)
+    config = dict(kind='moments', dims=dims, grpdim=grpdim)
+    ds_acc = _read_accum(path, config)
+    da_new = _new_times(da_new, ds_acc, dim)
+
+    # Merge partials of new time steps into stored ones
+    if da_new.sizes[dim] > 0:
+        parts = CalcMomentPartials(da_new, dims, grpdim, weights)
+        if ds_acc is not None:
+            parts = MergeMomentPartials(ds_acc['parts'], parts)
+        ds_acc = xr.Dataset({'parts': parts.rename(None), 'last_time': ('last', da_new[dim].values[-1:])},
+                            attrs=dict(config=json.dumps(config)))
+        _write_accum(path, ds_acc)
+    elif ds_acc is None:
+        raise ValueError('No data to accumulate for '+name)
+
+    return MomentsFromPartials(ds_acc['parts'].rename(da_new.name))
+
+def UpdateTrend(da_new: xr.DataArray, store: str, name: str, by: str='', dim: str='time', scale: float=10.,
+                group: str|None=None) -> xr.Dataset:
+    '''
+    Updates stored trend sufficient statistics with new time steps & returns the trend of all data so far, as
+    CalcTrendforDim on the whole record (x = 1, 2, ..., n continues across updates). Time steps already
+    accumulated are skipped. Wilks significance follows from the returned p-values (Wilks_pcrit_batch)
+    INPUT:
+    da_new: DataArray with new time steps (earlier ones are skipped, so the whole record can be passed)
+    store: zarr store the statistic belongs to (accumulators are kept at AccumPath(store, name, group))
+    name: name of the statistic (i.e. 'TREFHT.trend.month')
+    by: (optional) '' for the trend along dim, 'month' for the trend of every month along year, or 'year' for the
+        trend of annual means (every update must then start with a new year). defaults to ''
+    dim: (optional) time dimension. defaults to 'time'
+    scale: (optional) multiplier for trend & standard error (10 gives per decade for yearly steps). defaults to 10
+    group: (optional) zarr group of store. default is None
+
+    OUTPUT:
+    ds_trd: Dataset of trend (slope*scale), intercept, stderr (slope standard error*scale), pvalue, n
+    '''
+    if by not in ('', 'month', 'year'):
+        raise ValueError('\'by\' value  must be one of \'\', \'month\', \'year\'')
+
+    path = AccumPath(store, name, group)
+    config = dict(kind='trend', by=by, dim=dim)
+    ds_acc = _read_accum(path, config)
+    da_new = _new_times(da_new, ds_acc, dim)
+
+    if da_new.sizes[dim] > 0:
+        ntime = 0 if ds_acc is None else int(ds_acc.attrs['ntime'])
+        first_year = int(da_new[dim].dt.year.values[0]) if ds_acc is None else int(ds_acc.attrs['first_year'])
+        last_year = None if ds_acc is None else int(ds_acc['last_time'].dt.year.values[0])
+
+        # x continues from the stored record: time step number, or year number for 'month' & 'year'
+        if by == '':
+            da_fit, fitdim = da_new, dim
+            x = ntime+np.arange(1, da_new.sizes[dim]+1)
+        else:
+            if by == 'year':
+                if last_year is not None and int(da_new[dim].dt.year.values[0]) == last_year:
+                    raise ValueError('Year '+str(last_year)+' is already in the annual mean trend of '+name)
+                da_fit = da_new.groupby(dim+'.year').mean(dim)
+            else:
+                da_fit = SplitYearMonth(da_new, dim)
+            fitdim = 'year'
+            x = da_fit['year'].values-first_year+1
+
+        parts = CalcOLSPartials(da_fit, fitdim, x).compute()
+        if ds_acc is not None:
+            parts = MergeOLSPartials(ds_acc['parts'], parts)
+        attrs = dict(config=json.dumps(config), ntime=ntime+da_new.sizes[dim], first_year=first_year)
+        ds_acc = xr.Dataset({'parts': parts.rename(None), 'last_time': ('last', da_new[dim].values[-1:])}, attrs=attrs)
+        _write_accum(path, ds_acc)
+    elif ds_acc is None:
+        raise ValueError('No data to accumulate for '+name)
+
+    ds_trd = OLSFromPartials(ds_acc['parts'])
+    ds_trd['slope'] = ds_trd['slope']*scale
+    ds_trd['stderr'] = ds_trd['stderr']*scale
+    ds_trd = ds_trd.rename({'slope': 'trend'})
+    if by == 'month':
+        ds_trd = ds_trd.transpose('month', ...)
+
+    return Compact(ds_trd)
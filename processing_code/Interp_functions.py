@@ -0,0 +1,131 @@
+# Packages
+import numpy as np
+import xarray as xr
+from typing import List, Tuple
+
+# Standard pressure levels (hPa) CAM output is interpolated to
+PLEV_TARGET = np.array([10., 20., 30., 50., 70., 100., 150., 200., 250.,
+                        300., 400., 500., 600., 650., 700., 750., 800., 850.,
+                        900., 925., 950., 1000.])
+
+# Extrapolation policies for target levels outside the model column
+EXTRAP_TYPES = ('nan', 'nearest', 'linear')
+
+def PlevBrackets(ps: np.ndarray, hyam: np.ndarray, hybm: np.ndarray, P0: float,
+                 p_target: np.ndarray, extrap: str='nan') -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Calculates the bracketing model level and interpolation weight in log-pressure for every column
+    and target pressure level. Model pressure is built one level at a time from PS, so the full
+    time, lev, lat, lon pressure array is never allocated
+    INPUT:
+    ps: numpy array of surface pressure (Pa), any shape
+    hyam: numpy array of hybrid A coefficients at level midpoints (top to bottom)
+    hybm: numpy array of hybrid B coefficients at level midpoints (top to bottom)
+    P0: reference pressure (Pa)
+    p_target: numpy array of target pressure levels (hPa)
+    extrap: (optional) how to treat target levels outside the model column. defaults to 'nan'
+            'nan': set to NaN, 'nearest': use the closest model level, 'linear': extrapolate linearly in log-pressure
+
+    OUTPUT:
+    kl: numpy array of upper bracketing level index with shape ps.shape + (len(p_target),)
+    w: numpy array of weights on level kl+1 with shape ps.shape + (len(p_target),)
+    '''
+    if extrap not in EXTRAP_TYPES:
+        raise ValueError('\'extrap\' value  must be one of \'nan\', \'nearest\', \'linear\'')
+
+    nlev = hyam.size
+    lnp_target = np.log(np.asarray(p_target, dtype=float))
+    ps = np.asarray(ps, dtype=float)[..., np.newaxis]
+
+    # Count model levels with pressure at or below each target pressure (levels ordered top to bottom)
+    count = np.zeros(ps.shape[:-1]+lnp_target.shape, dtype=np.intp)
+    for l in range(nlev):
+        lnp_l = np.log((hyam[l]*P0 + hybm[l]*ps)/100)
+        count += (lnp_l <= lnp_target)
+
+    # Upper bracketing level, kept inside the column so edge columns extrapolate from the end pair
+    kl = np.clip(count-1, 0, nlev-2)
+
+    # Log-pressure at both bracketing levels
+    lnp_lo = np.log((hyam[kl]*P0 + hybm[kl]*ps)/100)
+    lnp_hi = np.log((hyam[kl+1]*P0 + hybm[kl+1]*ps)/100)
+
+    # Linear weight in log-pressure
+    w = (lnp_target-lnp_lo)/(lnp_hi-lnp_lo)
+
+    # Apply extrapolation policy outside the column
+    if extrap == 'nan':
+        w = np.where((w < 0.0) | (w > 1.0), np.nan, w)
+    elif extrap == 'nearest':
+        w = np.clip(w, 0.0, 1.0)
+
+    return kl, w
+
+def ApplyPlevBrackets(data: np.ndarray, kl: np.ndarray, w: np.ndarray) -> np.ndarray:
+    '''
+    Interpolates data to target pressure levels using precomputed brackets from PlevBrackets
+    INPUT:
+    data: numpy array with model level as the last axis
+    kl: numpy array of upper bracketing level index from PlevBrackets
+    w: numpy array of weights from PlevBrackets
+
+    OUTPUT:
+    data_out: numpy array with target pressure level as the last axis
+    '''
+    # Gather data at both bracketing levels
+    d_lo = np.take_along_axis(data, kl, axis=-1)
+    d_hi = np.take_along_axis(data, kl+1, axis=-1)
+
+    return d_lo + w*(d_hi-d_lo)
+
+def _interp_plev_columns(ps: np.ndarray, *data: np.ndarray, hyam: np.ndarray, hybm: np.ndarray,
+                         P0: float, p_target: np.ndarray, extrap: str) -> np.ndarray|Tuple[np.ndarray, ...]:
+    '''
+    Chunk kernel for InterpHybridToPlev. Calculates brackets once from the PS chunk and reuses them
+    for every variable in the chunk
+    '''
+    kl, w = PlevBrackets(ps, hyam, hybm, P0, p_target, extrap)
+
+    data_out = tuple(ApplyPlevBrackets(d, kl, w.astype(np.result_type(d.dtype, np.float32))) for d in data)
+
+    return data_out if len(data_out) > 1 else data_out[0]
+
+def InterpHybridToPlev(ds: xr.Dataset, var: str|List[str], p_target: np.ndarray=PLEV_TARGET, extrap: str='nan') -> xr.Dataset:
+    '''
+    Interpolates 3D variable(s) on hybrid-sigma model levels to pressure levels. Works chunk by chunk on dask
+    arrays (lev must be a single chunk) and calculates interpolation weights once for all variables
+    INPUT:
+    ds: xarray Dataset containing var(s), PS, hyam, hybm, and P0
+    var: variable name or list of variable names
+    p_target: (optional) numpy array of target pressure levels (hPa). defaults to PLEV_TARGET
+    extrap: (optional) extrapolation policy, one of 'nan', 'nearest', 'linear'. defaults to 'nan'
+
+    OUTPUT:
+    ds_out: xarray Dataset of variable(s) with dimension 'plev' in place of 'lev'
+    '''
+    var_list = [var] if isinstance(var, str) else list(var)
+    p_target = np.asarray(p_target, dtype=float)
+
+    # Hybrid coefficients are small, load them once
+    kwargs = dict(hyam=ds['hyam'].values, hybm=ds['hybm'].values, P0=float(ds['P0']),
+                  p_target=p_target, extrap=extrap)
+
+    # Interpolate all variables in one pass over PS
+    out = xr.apply_ufunc(_interp_plev_columns, ds['PS'], *[ds[v] for v in var_list],
+                         kwargs=kwargs,
+                         input_core_dims=[[]]+[['lev']]*len(var_list),
+                         output_core_dims=[['plev']]*len(var_list),
+                         dask='parallelized',
+                         output_dtypes=[np.result_type(ds[v].dtype, np.float32) for v in var_list],
+                         dask_gufunc_kwargs=dict(output_sizes={'plev': p_target.size}))
+    out = out if len(var_list) > 1 else (out,)
+
+    # Put plev where lev was & add target pressures as coordinate
+    da_list = []
+    for v, da in zip(var_list, out):
+        da = da.transpose(*['plev' if d == 'lev' else d for d in ds[v].dims])
+        da = da.assign_coords({'plev': p_target})
+        da.attrs = ds[v].attrs
+        da_list.append(da.rename(v))
+
+    return xr.merge(da_list)
@@ -0,0 +1,268 @@
+# Packages
+import os
+import json
+import hashlib
+import numpy as np
+import xarray as xr
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+import Processing_functions
+from Profile_functions import profile_stage
+from Backend_functions import Backend
+from Storage_functions import PlanEncoding
+from Incremental_functions import StoredTimes, AppendStore
+from Precision_functions import Compact, GetPrecision, PackedRanges, PackEncoding, ClipPacked
+from Cache_functions import FileIdentity
+
+def DefaultSteps(comp: str, freq: int, vertical: bool=False, var: str|None=None) -> List[Tuple[str, dict]]:
+    '''
+    Processing steps used by the processing notebooks for a component and output frequency
+    INPUT:
+    comp: component ('atm', 'ice', 'ocn')
+    freq: output frequency (0: monthly, 1: daily)
+    vertical: (optional) boolean for 3D atmosphere variable interpolated to pressure levels. default is False
+    var: (optional) variable name, required if vertical
+
+    OUTPUT:
+    steps: list of (Processing_functions function name, keyword arguments)
+    '''
+    # Monthly timestamps are at the end of the averaging period
+    steps = [('FixTime', {})] if freq == 0 else []
+
+    if comp == 'atm':
+        steps.append(('FixLongitude', {'add_cyclic': False}))
+        if vertical:
+            steps.append(('InterPlevels', {'var': var}))
+    elif comp == 'ice':
+        steps.append(('FixGrid', {'grid': 'gx1v7'}))
+
+    return steps
+
+def _apply_steps(data: xr.DataArray|xr.Dataset, steps: List[Tuple[str|Callable, dict]]) -> xr.DataArray:
+    '''
+    Applies processing steps lazily, step names are looked up in Processing_functions
+    '''
+    for func, kwargs in steps:
+        func = getattr(Processing_functions, func) if isinstance(func, str) else func
+        data = func(data, **kwargs)
+
+    return data
+
+def _open_input(inp: str|List[str]|xr.Dataset|Callable, chunks: dict|None) -> xr.Dataset:
+    '''
+    Opens one pipeline input lazily from a file path, glob or list of paths, zarr store, Dataset, or loader function
+    '''
+    if callable(inp):
+        inp = inp()
+    if isinstance(inp, xr.Dataset):
+        return inp if chunks is None else inp.chunk(chunks)
+
+    chunks = {} if chunks is None else chunks
+    if isinstance(inp, str) and inp.rstrip('/').endswith('.zarr'):
+        return xr.open_zarr(inp, chunks=chunks)
+    if isinstance(inp, str) and not any(c in inp for c in '*?['):
+        return xr.open_dataset(inp, chunks=chunks)
+
+    return xr.open_mfdataset(inp, chunks=chunks, parallel=True)
+
+def _input_identity(inp: str|List[str]|xr.Dataset|Callable) -> list|str|None:
+    '''
+    Identity of one pipeline input: paths with size & modification time (see Cache_functions.FileIdentity), the
+    source file of an opened Dataset, or the name of a loader function (its files are not known before calling it)
+    '''
+    if callable(inp):
+        return getattr(inp, '__module__', '')+'.'+getattr(inp, '__qualname__', repr(inp))
+    if isinstance(inp, xr.Dataset):
+        source = inp.encoding.get('source')
+        return FileIdentity(source) if source is not None and os.path.exists(source) else None
+
+    return FileIdentity(inp)
+
+def _fingerprint(config: dict) -> str:
+    '''
+    Hash of the pipeline configuration & input identities, so a checkpoint is only resumed by the same pipeline
+    on unchanged inputs
+    '''
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=repr).encode()).hexdigest()
+
+def _read_checkpoint(ckpt_path: str) -> dict:
+    '''
+    Reads checkpoint file, empty if it does not exist
+    '''
+    if not os.path.isfile(ckpt_path):
+        return {}
+    with open(ckpt_path) as f:
+        return json.load(f)
+
+def _write_checkpoint(ckpt_path: str, ckpt: dict) -> None:
+    '''
+    Writes checkpoint file atomically
+    '''
+    tmp_path = ckpt_path+'.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(ckpt, f)
+    os.replace(tmp_path, ckpt_path)
+
+@profile_stage
+def _write_unit(ds_unit: xr.Dataset, store: str, group: str|None, region: dict, key: str, ckpt_path: str, ckpt: dict) -> None:
+    '''
+    Writes one computed unit (member/year) to its region of the store, then records it in the checkpoint
+    '''
+    # Variables without a region dimension were written when the store was set up
+    ds_unit = ds_unit.drop_vars([v for v in ds_unit.variables if not set(ds_unit[v].dims) & set(region)])
+    ds_unit.to_zarr(store, group=group, region=region)
+
+    ckpt['done'].append(key)
+    _write_checkpoint(ckpt_path, ckpt)
+
+def _open_output(store: str, group: str|None, var: str, netcdf_path: str|None, verbose: bool) -> xr.Dataset:
+    '''
+    Opens the finished store lazily, optionally converting it to NetCDF
+    '''
+    ds_out = xr.open_zarr(store, group=group)
+
+    # Optionally convert to NetCDF, streamed chunk by chunk from the store
+    if netcdf_path is not None:
+        ds_out.to_netcdf(netcdf_path, format='NETCDF4', encoding={var: {'zlib': True, 'complevel': 1}})
+        if verbose:
+            print('wrote '+netcdf_path)
+
+    return ds_out
+
+@profile_stage
+def RunPipeline(inputs: str|List[str]|xr.Dataset|Callable|Dict, var: str, steps: List[Tuple[str|Callable, dict]], store: str,
+                group: str|None=None, vertical: bool=False, chunks: dict|None=None, years: List[int]|None=None,
+                netcdf_path: str|None=None, restart: bool=False, verbose: bool=True,
+                backend: Backend|None=None, access: str|None=None, pack: bool|Dict[str, Tuple[float, float]]=False,
+                append: bool=False) -> xr.Dataset:
+    '''
+    Streams raw CESM timeseries through processing steps into a zarr store one member/year at a time.
+    The store is set up once with the full output layout and every member/year is written to its own region,
+    so a killed job resumes from the checkpoint file (store+'.progress.json') and rewriting a partly written
+    year is safe. The checkpoint is only resumed if the steps and input files (paths, sizes & modification times)
+    are unchanged. The next member/year is read and transformed while the previous one is being written
+    INPUT:
+    inputs: input file path/glob/zarr store, Dataset, or loader function. a dictionary of these
+            {ensemble member label: input} adds an 'ensemble_member' dimension
+    var: variable name
+    steps: list of (function or Processing_functions function name, keyword arguments), i.e. DefaultSteps('atm', 0)
+    store: output zarr store
+    group: (optional) zarr group. default is None
+    vertical: (optional) boolean for passing whole Dataset to steps (needed by InterPlevels). default is False
+    chunks: (optional) dask chunks used to open inputs. default is None (file chunks)
+    years: (optional) list of years to process. default is all years in the input
+    netcdf_path: (optional) also write finished store to NetCDF4 (zlib level 1) at this path. default is None
+    restart: (optional) boolean for ignoring existing checkpoint and starting over. default is False
+    verbose: (optional) boolean for printing progress. default is True
+    backend: (optional) Backend computing every member/year (i.e. Backend('local') or Backend('pbs', account=...)).
+             default is None (current dask scheduler)
+    access: (optional) access pattern ('timeseries', 'maps', 'balanced') for planning spatial chunks & Blosc zstd
+            compression of the store (see Storage_functions). time & ensemble_member chunks stay one member/year.
+            default is None (input spatial chunks, zarr default compression)
+    pack: (optional) store var as scaled int16 if it is named in PACKED_RANGES or PACKED_PREFIXES (True) or in a
+          dictionary of variable: (min, max), clipped to that range (see Precision_functions). default is False
+    append: (optional) boolean for only processing time steps after the end of an existing store & appending them
+            one year at a time (see Incremental_functions), i.e. when a new year of ERA5 arrives. the store keeps its
+            layout, & the times in it record progress instead of the checkpoint. default is False
+
+    OUTPUT:
+    ds_out: processed Dataset opened lazily from store
+    '''
+    # Open & process every input lazily, nothing is computed here
+    member_inputs = inputs if isinstance(inputs, dict) else {None: inputs}
+    processed = []
+    for inp in member_inputs.values():
+        ds = _open_input(inp, chunks)
+        data = ds if vertical else ds[var]
+        data = _apply_steps(data, steps)
+        if isinstance(data, xr.Dataset):
+            data = data[var]
+        processed.append(Compact(data.rename(var)))
+
+    if isinstance(inputs, dict):
+        out = xr.concat(processed, pd.Index(list(member_inputs.keys()), name='ensemble_member'))
+    else:
+        out = processed[0]
+
+    # Units of work: every member & year
+    out_years = out['time'].dt.year.values
+    years = np.unique(out_years) if years is None else np.asarray(years)
+    out = out.isel(time=np.isin(out_years, years))
+
+    # Extend an existing store with new years only
+    if append and StoredTimes(store, group).size > 0:
+        if verbose:
+            print('Appending to '+store)
+        AppendStore(out.to_dataset(), store, group, pack=pack, backend=backend, verbose=verbose)
+        return _open_output(store, group, var, netcdf_path, verbose)
+
+    out_years = out['time'].dt.year.values
+
+    units = []
+    for m, label in enumerate(member_inputs.keys()):
+        for yr in years:
+            t_ind = np.nonzero(out_years == yr)[0]
+            if t_ind.size == 0:
+                continue
+            region = {'time': slice(int(t_ind[0]), int(t_ind[-1])+1)}
+            if label is not None:
+                region['ensemble_member'] = slice(m, m+1)
+            units.append((str(label)+'/'+str(yr), region))
+
+    # zarr chunks are regular, so time chunks are one unit (member/year) long: units of equal length (monthly, or
+    # daily on a noleap calendar) fill whole chunks, but with leap years a chunk can straddle two units. A write to
+    # part of a chunk reads back the rest of it, which is only safe if units sharing a chunk are never written at
+    # the same time, so all writes go through the single writer below
+    unit_len = max(r['time'].stop-r['time'].start for _, r in units)
+    out_chunks = {'time': unit_len}
+    if isinstance(inputs, dict):
+        out_chunks['ensemble_member'] = 1
+    ds_template = out.chunk(out_chunks).to_dataset()
+    ranges = PackedRanges(ds_template, pack)
+    ds_template = ClipPacked(ds_template, ranges)
+    encoding = None
+    if access is not None:
+        encoding = PlanEncoding(ds_template, access, fixed=out_chunks, pack=pack)
+        ds_template = ds_template.chunk(dict(zip(out.dims, encoding[var]['chunks'])))
+    elif len(ranges) > 0:
+        encoding = {v: PackEncoding(*r) for v, r in ranges.items()}
+
+    # Resume from checkpoint if it belongs to this pipeline
+    ckpt_path = store.rstrip('/')+('' if group is None else '.'+group)+'.progress.json'
+    config = dict(var=var, steps=[(getattr(f, '__name__', f), k) for f, k in steps], members=list(member_inputs.keys()),
+                  years=years.tolist(), vertical=vertical, group=group,
+                  inputs=[_input_identity(inp) for inp in member_inputs.values()])
+    if access is not None:
+        config['access'] = access
+    if len(ranges) > 0:
+        config['pack'] = ranges
+    if GetPrecision() != 'float64':
+        config['precision'] = GetPrecision()
+    ckpt = {} if restart else _read_checkpoint(ckpt_path)
+    if ckpt.get('fingerprint') != _fingerprint(config):
+        if verbose:
+            print('Setting up store '+store)
+        ds_template.to_zarr(store, group=group, mode='w', compute=False, encoding=encoding)
+        ckpt = {'fingerprint': _fingerprint(config), 'done': []}
+        _write_checkpoint(ckpt_path, ckpt)
+    elif verbose:
+        print('Resuming '+store+', '+str(len(ckpt['done']))+' of '+str(len(units))+' member/years done')
+
+    # Compute next unit while the previous one is written. One writer only: units can share a zarr chunk (see above)
+    done = set(ckpt['done'])
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        pending = None
+        for key, region in units:
+            if key in done:
+                continue
+            ds_unit = ds_template.isel(region).compute() if backend is None else backend.compute(ds_template.isel(region))
+            if pending is not None:
+                pending.result()
+            if verbose:
+                print('   writing '+key)
+            pending = writer.submit(_write_unit, ds_unit, store, group, region, key, ckpt_path, ckpt)
+        if pending is not None:
+            pending.result()
+
+    return _open_output(store, group, var, netcdf_path, verbose)
@@ -0,0 +1,122 @@
+# Packages
+import os
+import numpy as np
+import xarray as xr
+from typing import Dict, Tuple
+
+# Precision policies: 'float64' keeps data as it comes (current results), 'float32' keeps floating point data in
+# float32 in memory. Sums, means & variances are accumulated in ACCUM_DTYPE under both
+PRECISIONS = ('float64', 'float32')
+ACCUM_DTYPE = np.float64
+_PRECISION = os.environ.get('ARCTIC_PRECISION', 'float64')
+
+# Variables stored as scaled int16 on disk when packing is asked for, with their (min, max), by name & by name prefix
+# aice/siconc are fractions (0-1) in the processed files, p-values come from CalcTrendforDim ('pvalue') & CalcStatSig
+# ('pvals_'+var)
+PACKED_RANGES = {'aice': (0., 1.), 'siconc': (0., 1.), 'pvalue': (0., 1.)}
+PACKED_PREFIXES = {'pvals_': (0., 1.)}
+
+# int16 fill value, the remaining 65535 values cover (min, max)
+INT16_FILL = np.int16(-32768)
+INT16_STEPS = 65534
+
+def SetPrecision(precision: str) -> str:
+    '''
+    Sets the precision policy of this process ('float64' or 'float32'), returns the previous one
+    '''
+    global _PRECISION
+    if precision not in PRECISIONS:
+        raise ValueError('\'precision\' value  must be one of \'float64\', \'float32\'')
+    previous, _PRECISION = _PRECISION, precision
+
+    return previous
+
+def GetPrecision() -> str:
+    '''
+    Returns the precision policy of this process
+    '''
+    return _PRECISION
+
+class Precision:
+    '''
+    Context manager setting the precision policy, i.e. with Precision('float32'): ...
+    Casts are part of the dask graph, so lazy results built inside keep the policy when computed on workers
+    '''
+    def __init__(self, precision: str):
+        if precision not in PRECISIONS:
+            raise ValueError('\'precision\' value  must be one of \'float64\', \'float32\'')
+        self.precision = precision
+
+    def __enter__(self):
+        self.previous = SetPrecision(self.precision)
+        return self
+
+    def __exit__(self, *exc):
+        SetPrecision(self.previous)
+
+def WorkDtype(dtype: np.dtype|str, precision: str|None=None) -> np.dtype:
+    '''
+    In-memory dtype for data of dtype under the precision policy: floats wider than 32 bits become float32 under
+    'float32', anything else is unchanged
+    '''
+    dtype = np.dtype(dtype)
+    precision = _PRECISION if precision is None else precision
+    if precision == 'float32' and np.issubdtype(dtype, np.floating) and dtype.itemsize > 4:
+        return np.dtype(np.float32)
+
+    return dtype
+
+def Compact(obj: xr.DataArray|xr.Dataset, precision: str|None=None) -> xr.DataArray|xr.Dataset:
+    '''
+    Casts floating point data (not coordinates) to WorkDtype, lazily for dask arrays. Does nothing under 'float64'
+    INPUT:
+    obj: DataArray or Dataset
+    precision: (optional) precision policy. defaults to GetPrecision()
+
+    OUTPUT:
+    obj: DataArray or Dataset in the working precision
+    '''
+    if isinstance(obj, xr.Dataset):
+        return obj.assign({v: Compact(da, precision) for v, da in obj.data_vars.items()})
+
+    dtype = WorkDtype(obj.dtype, precision)
+    if dtype != obj.dtype:
+        obj = obj.astype(dtype)
+
+    return obj
+
+def PackedRanges(ds: xr.Dataset, pack: bool|Dict[str, Tuple[float, float]]) -> Dict[str, Tuple[float, float]]:
+    '''
+    (min, max) of the data variables of ds stored as scaled int16: PACKED_RANGES by name or PACKED_PREFIXES by
+    name prefix if pack is True, the given dictionary of variable: (min, max), or none if pack is False
+    '''
+    if pack is False:
+        return {}
+    if pack is not True:
+        return {v: tuple(pack[v]) for v in ds.data_vars if v in pack}
+
+    ranges = {}
+    for v in ds.data_vars:
+        prefixes = [r for p, r in PACKED_PREFIXES.items() if str(v).startswith(p)]
+        if v in PACKED_RANGES or len(prefixes) > 0:
+            ranges[v] = tuple(PACKED_RANGES[v] if v in PACKED_RANGES else prefixes[0])
+
+    return ranges
+
+def PackEncoding(vmin: float, vmax: float) -> Dict:
+    '''
+    CF encoding storing values in [vmin, vmax] as int16 (scale_factor & add_offset, NaN as INT16_FILL).
+    Decoding error is about (vmax-vmin)/INT16_STEPS/2, i.e. 7.6e-6 for p-values & sea ice fraction. float32
+    scale & offset let NetCDF files decode to float32, which is far more precise than the int16 steps
+    '''
+    scale = (vmax-vmin)/INT16_STEPS
+
+    return dict(dtype='int16', scale_factor=np.float32(scale), add_offset=np.float32(vmin+(INT16_STEPS//2)*scale),
+                _FillValue=INT16_FILL)
+
+def ClipPacked(ds: xr.Dataset, ranges: Dict[str, Tuple[float, float]]) -> xr.Dataset:
+    '''
+    Clips packed variables to their range (NaN kept), so rounding of i.e. regridded sea ice fraction just above 1
+    cannot overflow int16 when encoded
+    '''
+    return ds.assign({v: ds[v].clip(*r) for v, r in ranges.items()})
@@ -2,17 +2,26 @@
 import numpy as np
 import xarray as xr
 import pandas as pd
-from scipy import stats
 import warnings
 warnings.simplefilter('ignore', UserWarning)
 warnings.filterwarnings('ignore')
 import datetime as dt
 from datetime import timedelta
-from cartopy.util import add_cyclic_point
-from typing import List, Tuple
-import pop_tools
-from xgcm import Grid
-
+from typing import Callable, Iterable, List, Tuple
+from Grid_functions import LoadGrid, GridCacheInfo, ARCTIC_SUBDOMAIN
+from Interp_functions import InterpHybridToPlev, PLEV_TARGET
+from Stats_functions import CalcMoments, CalcMomentPartials, MomentDtype
+from Trend_functions import CalcOLS, SplitYearMonth
+from Skill_functions import CalcSkill
+from Region_functions import LatWeights
+from Profile_functions import profile_stage, RegisterCache
+from Backend_functions import Backend
+from Precision_functions import Compact, ACCUM_DTYPE
+
+# Grid cache hits show up in stage profiles
+RegisterCache('grid', GridCacheInfo)
+
+@profile_stage
 def Wilks_pcrit(pvalues: np.ndarray, siglevel: float) -> float:
     '''
     This function calcules the p-critical level for the Wilks significance test
@@ -48,107 +57,151 @@ def Wilks_pcrit(pvalues: np.ndarray, siglevel: float) -> float:
     # None of the p-values are significant
     if k == 0:
         pcrit = 0.0
-    # All p-values are significant
+    # All p-values are significant: largest finite p-value (NaNs are sorted after it)
     elif k == -1:
-        pcrit = pvalues_fl[-1]
+        pcrit = pvalues_fl[np.count_nonzero(~np.isnan(pvalues_fl))-1]
     # Some p-values are significant
     else:
         pcrit = pvalues_fl[k-1]
         
     return pcrit
 
-def InterPlevels(ds, var):
+@profile_stage
+def InterPlevels(ds: xr.Dataset, var: str|List[str], p_target: np.ndarray=PLEV_TARGET, extrap: str='nan') -> xr.DataArray|xr.Dataset:
     '''
     Interpolates 3D from model levels to standard pressure levels
     INPUT:
-    ds: xarray DataArray
-    var: variable name
+    ds: xarray Dataset
+    var: variable name, or list of variable names to interpolate in one pass (i.e. ['U','V','T','Z3'])
+    p_target: (optional) numpy array of target pressure levels (hPa). defaults to PLEV_TARGET
+    extrap: (optional) policy for target levels outside the model column, one of 'nan', 'nearest', 'linear'.
+            defaults to 'nan'
 
     OUTPUT:
-    varout: modified xarray DataArray
+    varout: modified xarray DataArray, or Dataset if var is a list
     '''
-    
-    # Calculate the pressure at every time, lev, lat, lon
-    p = (ds['hyam']*ds['P0'] + ds['hybm']*ds['PS'])/100
-    
-    # Assign it as a variable in the dataset
-    ds = ds.assign({'p': np.log(p)})
-    
-    # Create an xgcm Grid object with a Z coordinate given by 'lev'
-    grid = Grid(ds, coords={'Z': {'center': 'lev'}}, periodic=False)
-    
-    # Give the array of pressures to interpolate to
-    p_target = np.array([10., 20., 30., 50., 70., 100., 150., 200., 250.,
-                         300., 400., 500., 600., 650., 700., 750., 800., 850.,
-                         900., 925., 950., 1000.])
-    
-    # Use the transform method to interpolate to constant pressure given the target pressures above
-    # The target_data parameter tells it what variable to use to base the transformation on. 
-    # In our case, we're using the model pressure at every point calculated above
-    varout = grid.transform(ds[var], 'Z', np.log(p_target), target_data=ds.p)
-    
-    # Rename the new dimension and assign the coordinate as the target pressures above
-    varout = varout.rename({'p': 'plev'})
-    varout = varout.assign_coords({'plev': p_target})
-    
+
+    # Interpolated variables in the working precision, brackets are still found in float64 chunk by chunk
+    var_list = [var] if isinstance(var, str) else list(var)
+    ds = ds.assign({v: Compact(ds[v]) for v in var_list})
+
+    # Interpolate in log-pressure, brackets from PS are shared by all variables
+    varout = InterpHybridToPlev(ds, var, p_target, extrap)
+
+    # Return DataArray for single variable
+    if isinstance(var, str):
+        varout = varout[var]
+
     return varout.squeeze()
 
-def AddCyclic(da: xr.DataArray) -> xr.DataArray:
+@profile_stage
+def AddCyclic(da: xr.DataArray, londim: str='lon') -> xr.DataArray:
+    '''
+    Adds cyclic point, the first longitude repeated one grid spacing after the last one. Lazy for dask arrays
+    (the extra column is a one-column chunk), does nothing if the cyclic point is already there
+    INPUT:
+    da: xarray DataArray
+    londim: (optional) name of longitude dimension. defaults to 'lon'
+
+    OUTPUT:
+    da: modified xarray DataArray
+    '''
+    lon = da[londim].values
+
+    # Already cyclic
+    if np.isclose(lon[-1]-lon[0], 360.):
+        return da
+
     # Add cyclic point
-    cyclic_data, cyclic_lon = add_cyclic_point(da.data, coord=da['lon'])
-    cyclic_coords = {dim: da.coords[dim] for dim in da.dims}
-    cyclic_coords['lon'] = cyclic_lon
+    cyclic_col = da.isel({londim: slice(0,1)})
+    cyclic_col = cyclic_col.assign_coords({londim: (londim, lon[-1:]+(lon[1]-lon[0]), da[londim].attrs)})
+    da = xr.concat([da, cyclic_col], dim=londim, coords='minimal', compat='override', combine_attrs='override')
 
-    da = xr.DataArray(cyclic_data, dims=da.dims, coords=cyclic_coords, attrs=da.attrs, name=da.name)
     return da
 
+def DropCyclic(da: xr.DataArray, londim: str='lon') -> xr.DataArray:
+    '''
+    Removes cyclic point added by AddCyclic with an index slice (no mask or copy)
+    INPUT:
+    da: xarray DataArray
+    londim: (optional) name of longitude dimension. defaults to 'lon'
+
+    OUTPUT:
+    da: modified xarray DataArray
+    '''
+    lon = da[londim].values
+
+    # Only drop last column if it repeats the first
+    if np.isclose(lon[-1]-lon[0], 360.):
+        da = da.isel({londim: slice(0,-1)})
+
+    return da
+
+@profile_stage
 def FixLongitude(da: xr.DataArray, add_cyclic: bool) -> xr.DataArray:
     '''
     Fixes CESM longitude 
     INPUT:
     da: xarray DataArray
+    add_cyclic: boolean for adding cyclic point
 
     OUTPUT:
     da: modified xarray DataArray
     '''
     # Switch longitude from 0-360 to -180-180
-    da = da.assign_coords(dict(lon=(((da.lon+180) % 360)-180)))
-
-    # Sort longitude to fix plotting problems
-    da = da.sortby('lon','ascending')
+    lon = da['lon'].values
+    lon_new = ((lon+180) % 360)-180
+
+    # Ascending 0-360 longitudes become two ascending blocks split at 180, so sorting is a roll of the
+    # two blocks (lazy for dask, keeps chunks apart from the split)
+    shift = int(np.argmin(lon_new))
+    lon_rolled = np.roll(lon_new, -shift)
+    if np.all(np.diff(lon_rolled) > 0):
+        da = da.roll(lon=-shift, roll_coords=True)
+        da = da.assign_coords(lon=('lon', lon_rolled, da['lon'].attrs))
+
+    # Otherwise sort longitude to fix plotting problems
+    else:
+        da = da.assign_coords(lon=('lon', lon_new, da['lon'].attrs))
+        da = da.sortby('lon','ascending')
 
     if add_cyclic:
          da = AddCyclic(da)
     
     return da
 
-def FixGrid(da: xr.DataArray, grid: str) -> xr.DataArray:
+@profile_stage
+def FixGrid(da: xr.DataArray, grid: str, arctic: bool=False, cache_dir: str|None=None) -> xr.DataArray:
     '''
     Transforms CICE grid into lat/lon (0-360)
     INPUT:
     da: xarray DataArray
+    grid: grid name (i.e. 'gx1v7')
+    arctic: (optional) cut da and grid to the Arctic subdomain (nj=slice(250,385)). defaults to False
+    cache_dir: (optional) grid cache directory. defaults to GRID_CACHE_DIR
 
     OUTPUT:
     da: modified xarray DataArray
     '''
 
-    # Get CICE grid from pop_tools
-    grid = pop_tools.get_grid('POP_'+grid)
+    # Get CICE grid from grid cache (tarea already in m2)
+    subdomain = ARCTIC_SUBDOMAIN if arctic else None
+    grid_arrs = LoadGrid(grid, cache_dir, subdomain)
 
-    # Change tarea to m2 instead of km2
-    with xr.set_options(keep_attrs=True):
-        grid['TAREA'] = grid['TAREA']/(1e4)
-    grid['TAREA'].attrs['units'] = 'm^2'
+    # Cut data to Arctic subdomain
+    if arctic:
+        da = da.isel(subdomain)
 
-    # Add lat, lon, and tarea coordinates
-    da.coords['lat'] = (('nj','ni'),grid['TLAT'].values)
-    da.coords['lon'] = (('nj','ni'),grid['TLONG'].values)
-    da.coords['tarea'] = (('nj','ni'),grid['TAREA'].values)
+    # Add lat, lon, and tarea coordinates, cached arrays are shared rather than copied
+    da = da.assign_coords(lat=(('nj','ni'),grid_arrs['TLAT']),
+                          lon=(('nj','ni'),grid_arrs['TLONG']),
+                          tarea=(('nj','ni'),grid_arrs['TAREA']))
 
     return da
 
     
 
+@profile_stage
 def FixTime(da: xr.DataArray) -> xr.DataArray:
     '''
     Fixes CESM time coordinate for monthly data
@@ -164,12 +217,15 @@ def FixTime(da: xr.DataArray) -> xr.DataArray:
 
     return da
 
-def CalcStatforDim(da: xr.DataArray, grpdim: str, dims: str|List[str]) -> Tuple[xr.DataArray, xr.DataArray, xr.DataArray]:
+@profile_stage
+def CalcStatforDim(da: xr.DataArray, grpdim: str, dims: str|List[str], weights: xr.DataArray|None=None) -> Tuple[xr.DataArray, xr.DataArray, xr.DataArray]:
     '''
-    Calculates mean, standard deviation, n for the DataArray over dimension(s)
+    Calculates mean, standard deviation, n for the DataArray over dimension(s) in a single pass over the data
     INPUT: 
     da: xarray DataArray
+    grpdim: variable to group data by (i.e. 'time.month'), '' for no grouping
     dims: list of dimension(s)
+    weights: (optional) DataArray of weights. defaults to cos(lat) if lat is one of dims, else equal weights
 
     OUTPUT:
     da_avg: DataArray mean over dimension(s) 
@@ -177,28 +233,124 @@ def CalcStatforDim(da: xr.DataArray, grpdim: str, dims: str|List[str]) -> Tuple[
     da_n: DataArray count over dimension(s)
     '''
     # Check if lat is one of average dimensions
-    if 'lat' in dims:
-        weights = np.cos(np.deg2rad(da.lat))
-        da = da.weighted(weights)
-
-    if grpdim == '':
-        da_avg = da.mean(dims, skipna=True)
-        da_std = da.std(dims, skipna=True, ddof=1)
-        da_n = da.count(dims)
-    else:
-        # Calculate statistics over dimension(s)
-        da_avg = da.groupby(grpdim).mean(dims, skipna=True)
-        da_std = da.groupby(grpdim).std(dims, skipna=True, ddof=1)
-        da_n = da.groupby(grpdim).count(dims)
+    if weights is None and 'lat' in dims:
+        weights = LatWeights(da.lat)
 
-    da_avg.compute()
-    da_std.compute()
-    da_n.compute()
+    # Calculate statistics over dimension(s), mean/std/count share one read of each chunk
+    da_avg, da_std, da_n = CalcMoments(da, dims, grpdim, weights)
 
     return da_avg, da_std, da_n
 
+@profile_stage
+def CalcTrendforDim(da: xr.DataArray, by: str='', dim: str='time', scale: float=10., return_resid: bool=False) -> xr.Dataset:
+    '''
+    Calculates linear trends (x = 1, 2, ..., n) in closed form in one vectorized pass over the data
+    INPUT:
+    da: xarray DataArray
+    by: (optional) '' for the trend along dim, 'month' for the trend of every month at once (as CalcMonthTrd),
+        or 'year' for the trend of annual means (as CalcAnnTrd). defaults to ''
+    dim: (optional) time dimension. defaults to 'time'
+    scale: (optional) multiplier for trend & standard error (10 gives per decade for yearly steps). defaults to 10
+    return_resid: (optional) boolean for adding detrended anomalies ('resid'), on dim for '' & 'month'. default is False
+
+    OUTPUT:
+    ds_trd: Dataset of trend (slope*scale), intercept, stderr (slope standard error*scale), pvalue (two-sided,
+            i.e. for Wilks_pcrit_batch), n (count), & optionally resid
+    '''
+    if by not in ('', 'month', 'year'):
+        raise ValueError('\'by\' value  must be one of \'\', \'month\', \'year\'')
+
+    # Fit every month at once along year
+    if by == 'month':
+        da_ym = SplitYearMonth(da, dim)
+        ds_trd = CalcOLS(da_ym, 'year', return_resid)
+
+        # Map residuals back to the original time coordinate
+        if return_resid:
+            yi = pd.Index(da_ym['year'].values).get_indexer(da[dim].dt.year.values)
+            mi = pd.Index(da_ym['month'].values).get_indexer(da[dim].dt.month.values)
+            resid = ds_trd['resid'].isel(year=xr.DataArray(yi, dims=dim), month=xr.DataArray(mi, dims=dim))
+            resid = resid.drop_vars(['year', 'month']).assign_coords({dim: da[dim]}).transpose(*da.dims)
+            ds_trd = ds_trd.drop_vars('resid', errors='ignore').drop_dims('year')
+            ds_trd['resid'] = resid
+        ds_trd = ds_trd.transpose('month', ...)
+
+    # Fit annual means
+    elif by == 'year':
+        ds_trd = CalcOLS(da.groupby(dim+'.year').mean(dim), 'year', return_resid)
+
+    else:
+        ds_trd = CalcOLS(da, dim, return_resid)
+
+    ds_trd['slope'] = ds_trd['slope']*scale
+    ds_trd['stderr'] = ds_trd['stderr']*scale
+    ds_trd = ds_trd.rename({'slope': 'trend'})
+
+    return Compact(ds_trd)
 
 
+@profile_stage
+def CalcSkillforDim(mod: xr.DataArray, obs: xr.DataArray, by: str='', dim: str='time', ens_dim: str|None='ensemble_member',
+                    rmse: bool=False, return_series: bool=False) -> xr.Dataset:
+    '''
+    Skill of an ensemble against observations in one pass over the data: correlation of the ensemble mean with
+    observations for anomalies (as CalcAnom & CalcR) & detrended anomalies (as CalcDetAnom & CalcR), RMS ensemble
+    spread (time mean of CalcEnsSp squared), & optionally RMSE. Other dimensions of mod (i.e. experiments) are
+    computed at once
+    INPUT:
+    mod: DataArray of model data
+    obs: DataArray of observations on the model grid (i.e. ERA5 or GISTEMP)
+    by: (optional) '' for skill along dim, 'month' for the skill of every month at once along year,
+        or 'year' for the skill of annual means. defaults to ''
+    dim: (optional) time dimension. defaults to 'time'
+    ens_dim: (optional) ensemble member dimension of mod, None if mod has none. default is 'ensemble_member'
+    rmse: (optional) boolean for adding rmse, rmse_anom & rmse_dtrd of the ensemble mean. default is False
+    return_series: (optional) boolean for adding the (lazy) anomalies anom_mod, anom_obs & detrended anomalies
+                   dtrd_mod, dtrd_obs of the ensemble mean & observations, on dim for '' & 'month'. default is False
+
+    OUTPUT:
+    ds_skill: Dataset of r, r_dtrd, spread (with ens_dim), slope_mod, slope_obs, mean_mod, mean_obs, n,
+              & optionally rmse, rmse_anom, rmse_dtrd & series
+    '''
+    if by not in ('', 'month', 'year'):
+        raise ValueError('\'by\' value  must be one of \'\', \'month\', \'year\'')
+
+    # Same layout as CalcTrendforDim, so every month is correlated along year in one call
+    if by == 'month':
+        mod_in, obs_in, fitdim = SplitYearMonth(mod, dim), SplitYearMonth(obs, dim), 'year'
+    elif by == 'year':
+        mod_in, obs_in, fitdim = mod.groupby(dim+'.year').mean(dim), obs.groupby(dim+'.year').mean(dim), 'year'
+    else:
+        mod_in, obs_in, fitdim = mod, obs, dim
+
+    ds_skill = CalcSkill(mod_in, obs_in, fitdim, ens_dim)
+
+    # Anomalies & detrended anomalies from the fitted means & slopes (elementwise, no further reductions)
+    if return_series:
+        y = mod_in.mean(ens_dim) if ens_dim is not None and ens_dim in mod_in.dims else mod_in
+        x = xr.DataArray(np.arange(1, obs_in.sizes[fitdim]+1, dtype=np.float64), dims=fitdim)
+        series = xr.Dataset()
+        for name, da_in, key in (('mod', y, 'mod'), ('obs', obs_in, 'obs')):
+            series['anom_'+name] = da_in-ds_skill['mean_'+key]
+            series['dtrd_'+name] = series['anom_'+name]-ds_skill['slope_'+key]*(x-ds_skill['mean_x'])
+
+        # Map series back to the original time coordinate
+        if by == 'month':
+            yi = pd.Index(series['year'].values).get_indexer(obs[dim].dt.year.values)
+            mi = pd.Index(series['month'].values).get_indexer(obs[dim].dt.month.values)
+            series = series.isel(year=xr.DataArray(yi, dims=dim), month=xr.DataArray(mi, dims=dim))
+            series = series.drop_vars(['year', 'month']).assign_coords({dim: obs[dim]})
+        ds_skill = ds_skill.merge(series)
+
+    ds_skill = ds_skill.drop_vars('mean_x')
+    if not rmse:
+        ds_skill = ds_skill.drop_vars(['rmse', 'rmse_anom', 'rmse_dtrd'])
+    if by == 'month':
+        ds_skill = ds_skill.transpose('month', ...)
+
+    return Compact(ds_skill)
+
+@profile_stage
 def CalcStatbyGrpDim(da: xr.DataArray, grpdim1: str, grpdim2: str, concatdim: str, avgdim: str, avgdim2: str|List[str]) -> Tuple[xr.DataArray, xr.DataArray, xr.DataArray]:
     '''
     Calculates mean, standard deviation, n for the DataArray over dimension(s) by a grouped by dimension
@@ -215,44 +367,25 @@ def CalcStatbyGrpDim(da: xr.DataArray, grpdim1: str, grpdim2: str, concatdim: st
     da_n: DataArray count over dimension(s)
     '''
     # Check if lat is in average dimension
-    if 'lat' in avgdim:
-        weights = np.cos(np.deg2rad(da.lat))
-        da = da.weighted(weights)
-
-    # Group dataArray
-    da_grp = da.groupby(grpdim1)
-
-    # Initialize lists
-    da_avg_list = []
-    lbl_list = []
-
+    weights = LatWeights(da.lat) if 'lat' in avgdim else None
+
+    # Mean for every group1 x group2 combination in one pass (no loop over groups), kept in the precision of da.
+    # Lazy for dask inputs, so group means are only ever held a chunk at a time by the statistics over group
+    grpdims = [grpdim1, grpdim2] if grpdim2 != '' else [grpdim1]
+    parts = CalcMomentPartials(da, avgdim, grpdims, weights)
+    da_avg_grp = parts.sel(moment='M', drop=True).where(parts.sel(moment='N', drop=True) > 0)
+    da_avg_grp = da_avg_grp.astype(MomentDtype(da.dtype))
+
+    # Group1 labels become the concatenated dimension
+    if da[grpdim1].name != concatdim:
+        da_avg_grp = da_avg_grp.rename({da[grpdim1].name: concatdim})
     
-    # Loop over all groups in grouped dataArray
-    for sub, dss in da_grp:
-        if grpdim2 != '':
-            # Calculate mean for group
-            dss_avg = dss.groupby(grpdim2).mean(avgdim, skipna=True)
-        else:
-            dss_avg = dss.mean(avgdim, skipna=True)
-
-        # Add to lists
-        da_avg_list.append(dss_avg)
-        lbl_list.append(sub)
-
     # Calculate statistics over group
-    da_avg_grp = xr.concat(da_avg_list,pd.Index(lbl_list,name=concatdim))   
-    da_avg_grp.compute()
-    
-    da_avg = da_avg_grp.mean(avgdim2,skipna=True)
-    da_std = da_avg_grp.std(avgdim2,skipna=True,ddof=1)
-    da_n = da_avg_grp.count(avgdim2)
-
-    da_avg.compute()
-    da_std.compute()
-    da_n.compute()
+    da_avg, da_std, da_n = CalcMoments(da_avg_grp, avgdim2)
 
     return da_avg, da_std, da_n
     
+@profile_stage
 def Ensemble(da_list, ens_index: pd.Index, return_mean=False, stat='avg') -> xr.DataArray:
     '''
     Takes list of DataArrarys, one for each ensemble member, and turns them into a single DataArray
@@ -269,36 +402,121 @@ def Ensemble(da_list, ens_index: pd.Index, return_mean=False, stat='avg') -> xr.
     da_ens: DataArray containing ensemble
     da_ensmean: DataArray containing ensemble mean
     '''
-    # Concatenate list with pandas index of ensemble members
-    da_ens = xr.concat(da_list, ens_index)
+    # If returning ensemble mean, stream members through running accumulators instead of stacking them
+    if return_mean:
+        return EnsembleStream(da_list, ens_index, stat)
+
+    # Else only return ensemble, concatenated with pandas index of ensemble members (in the working precision)
+    da_ens = xr.concat([Compact(da) for da in da_list], ens_index)
 
     # Chunk data
     da_ens = da_ens.chunk({'ensemble_member': -1})
-    da_ens.compute()
 
-    # If returning ensemble mean
-    if return_mean:
-        # If statistic is average
-        if stat == 'avg':
-            da_ensmean = da_ens.mean('ensemble_member', skipna=True)
-        
-        # Else if statistic is standard deviation
-        elif stat == 'std':
-            num_em = da_ens.sizes['ensemble_member']
-            da_ensmean = np.sqrt((da_ens**2).sum('ensemble_member', skipna=True)/num_em)
-
-        # Else if statistic is count
-        elif stat == 'n':
-            da_ensmean = da_ens.sum('ensemble_member', skipna=True)
-        
-        # Else if stat is not the right value
+    return da_ens
+
+def _open_member(member: str|xr.DataArray|xr.Dataset|Callable, var: str|None) -> xr.DataArray:
+    '''
+    Opens one ensemble member for EnsembleStream from a DataArray, Dataset, file/zarr path, or loader function
+    '''
+    # Call loader function (i.e. a partial of xr.open_dataset)
+    if callable(member):
+        member = member()
+
+    # Open file lazily
+    if isinstance(member, str):
+        member = xr.open_zarr(member) if member.rstrip('/').endswith('.zarr') else xr.open_dataset(member, chunks={})
+
+    # Reduce to DataArray
+    if isinstance(member, xr.Dataset):
+        if var is None:
+            raise ValueError('\'var\' is required when ensemble members are Datasets or paths')
+        member = member[var]
+
+    return member
+
+def _load_member(member: str|xr.DataArray|xr.Dataset|Callable, var: str|None) -> xr.DataArray:
+    '''
+    Opens & loads one ensemble member into memory (run on backend workers by EnsembleStream)
+    '''
+    return _open_member(member, var).load()
+
+@profile_stage
+def EnsembleStream(members: Iterable, ens_index: pd.Index|None=None, stat: str='avg', var: str|None=None,
+                   zarr_path: str|None=None, zarr_group: str|None=None, backend: Backend|None=None) -> xr.DataArray:
+    '''
+    Calculates the ensemble mean of a statistic one member at a time, so memory is bounded by one member plus
+    the running accumulators. Optionally writes the stacked ensemble to zarr as it goes
+    INPUT:
+    members: iterable or generator of ensemble members, each a DataArray, Dataset, file or zarr path,
+             or function returning one of those
+    ens_index: (optional) pandas Index with name 'ensemble_member'. defaults to members numbered from 1
+    stat: (optional) string describing statistic that ensemble mean will be calculated for. default is 'avg'
+          must be one of 'avg', 'std', 'n'
+    var: (optional) variable name, required if members are Datasets or paths
+    zarr_path: (optional) zarr store to append each member to along 'ensemble_member'. default is None
+    zarr_group: (optional) group in zarr store. default is None
+    backend: (optional) started Backend loading upcoming members on its workers while the current one is
+             accumulated, at most backend.max_pending members ahead. default is None (one member at a time)
+
+    OUTPUT:
+    da_ensmean: DataArray containing ensemble mean
+    '''
+    if stat not in ('avg', 'std', 'n'):
+        raise ValueError('\'stat\' value  must be one of \'avg\', \'std\', \'n\'')
+
+    acc_sum = None
+    acc_cnt = None
+    num_em = 0
+
+    loaded = (_load_member(m, var) for m in members) if backend is None else backend.map(_load_member, members, var)
+    for i, da in enumerate(loaded):
+        # Only this member (plus any prefetched by the backend) is in memory, in its own dtype
+        vals = da.values
+        valid = ~np.isnan(vals)
+
+        # Initialize accumulators from first member, keeping only its metadata (not its data) for the output
+        if acc_sum is None:
+            template = dict(coords=dict(da.coords), dims=da.dims, attrs=da.attrs, name=da.name)
+            out_dtype = MomentDtype(vals.dtype)
+            acc_sum = np.zeros(vals.shape, dtype=ACCUM_DTYPE)
+            acc_cnt = np.zeros(vals.shape, dtype=ACCUM_DTYPE)
+        elif vals.shape != acc_sum.shape:
+            raise ValueError('Ensemble member '+str(i)+' has shape '+str(vals.shape)+', expected '+str(acc_sum.shape))
+
+        # Update running sums (NaNs skipped as in skipna=True)
+        if stat == 'std':
+            acc_sum += np.square(np.where(valid, vals, 0.0), dtype=ACCUM_DTYPE)
         else:
-            raise ValueError('\'stat\' value  must be one of \'avg\', \'std\', \'n\'')
-        
-        da_ensmean.compute()
+            acc_sum += np.where(valid, vals, 0.0)
+        acc_cnt += valid
 
-        return da_ensmean
-    
-    # Else only return ensemble
+        # Append member to stacked ensemble on disk
+        if zarr_path is not None:
+            label = ens_index[i] if ens_index is not None else i+1
+            ds_out = da.expand_dims(ensemble_member=[label]).to_dataset(name=da.name if da.name is not None else var)
+            zarr_kwargs = dict(mode='w') if num_em == 0 else dict(append_dim='ensemble_member')
+            ds_out.to_zarr(zarr_path, group=zarr_group, **zarr_kwargs)
+
+        num_em += 1
+        del da, vals, valid
+
+    if num_em == 0:
+        raise ValueError('No ensemble members given')
+
+    # If statistic is average
+    if stat == 'avg':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ensmean = np.where(acc_cnt > 0, acc_sum/acc_cnt, np.nan)
+
+    # Else if statistic is standard deviation
+    elif stat == 'std':
+        ensmean = np.sqrt(acc_sum/num_em)
+
+    # Else if statistic is count
     else:
-        return da_ens
\ No newline at end of file
+        ensmean = acc_sum
+
+    # Accumulated in float64, returned in the precision of the members
+    da_ensmean = xr.DataArray(ensmean.astype(out_dtype, copy=False), **template)
+
+    return da_ensmean
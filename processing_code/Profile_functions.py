@@ -0,0 +1,280 @@
+# Packages
+import os
+import csv
+import json
+import time
+import atexit
+import threading
+import functools
+from typing import Callable, Dict, List
+
+# Profiling is off unless EnableProfiling is called, or ARCTIC_PROFILE is set to a trace file path (.json or .csv)
+# Disabled stages cost one global lookup per call
+_TRACE = None
+_TRACE_PATHS = set()
+_CACHES = {}
+_LOCAL = threading.local()
+_T0 = time.perf_counter()
+
+TRACE_FIELDS = ('stage', 'module', 'depth', 'thread', 'start_s', 'wall_s', 'bytes_in', 'bytes_out',
+                'rss_mib', 'rss_delta_mib', 'peak_rss_mib', 'dask_tasks', 'dask_layers', 'nchunks', 'chunk_shape',
+                'cache_hits', 'cache_misses')
+
+def RegisterCache(name: str, info: Callable) -> None:
+    '''
+    Registers a cache whose hits & misses are recorded for every profiled stage
+    INPUT:
+    name: cache name
+    info: function returning an object with hits and misses (i.e. the cache_info of an lru_cache)
+    '''
+    _CACHES[name] = info
+
+def _rss_mib() -> float|None:
+    '''
+    Current resident set size of the process (Linux), None where /proc is not available
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError, ValueError):
+        return None
+
+def _peak_rss_mib() -> float|None:
+    '''
+    Peak resident set size of the process so far
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kB on Linux, bytes on macOS
+    return peak/2**20 if os.uname().sysname == 'Darwin' else peak/2**10
+
+def _cache_counts() -> tuple:
+    '''
+    Total hits & misses of registered caches
+    '''
+    hits = 0
+    misses = 0
+    for info in _CACHES.values():
+        ci = info()
+        hits += ci.hits
+        misses += ci.misses
+
+    return hits, misses
+
+def _arrays(obj, depth: int=0) -> list:
+    '''
+    Array-like objects (numpy, dask, xarray) in a function argument or output, looking one level into containers
+    '''
+    if hasattr(obj, 'nbytes'):
+        return [obj]
+    if depth == 0 and isinstance(obj, (list, tuple)):
+        return [a for o in obj for a in _arrays(o, 1)]
+    if depth == 0 and isinstance(obj, dict):
+        return [a for o in obj.values() for a in _arrays(o, 1)]
+
+    return []
+
+def _nbytes(arrays: list) -> int:
+    '''
+    Total size of arrays in bytes, without computing lazy arrays
+    '''
+    total = 0
+    for a in arrays:
+        try:
+            total += int(a.nbytes)
+        except (TypeError, ValueError):
+            pass
+
+    return total
+
+def _dask_info(arrays: list) -> dict:
+    '''
+    Task count, graph layers, and chunking of the dask arrays in a stage output
+    '''
+    import dask
+
+    collections = []
+    for a in arrays:
+        if dask.is_dask_collection(a):
+            collections.append(a)
+    if len(collections) == 0:
+        return dict(dask_tasks=0, dask_layers=0, nchunks=0, chunk_shape='')
+
+    graph = collections[0].__dask_graph__()
+    for c in collections[1:]:
+        graph = {**graph, **c.__dask_graph__()}
+
+    # Chunking of the first dask array (i.e. the output DataArray, or the first Dataset variable)
+    first = collections[0]
+    if hasattr(first, 'data_vars'):
+        first = next((v for v in first.data_vars.values() if dask.is_dask_collection(v)), first)
+    data = getattr(first, 'data', first)
+    nchunks = int(getattr(data, 'npartitions', 0))
+    chunk_shape = 'x'.join(str(c) for c in getattr(data, 'chunksize', ()))
+
+    return dict(dask_tasks=len(graph), dask_layers=len(getattr(collections[0].__dask_graph__(), 'layers', {})),
+                nchunks=nchunks, chunk_shape=chunk_shape)
+
+def profile_stage(func: Callable) -> Callable:
+    '''
+    Decorator recording wall time, bytes in/out, RSS, dask graph size, chunking, and cache hits for every call
+    of func while profiling is enabled. For lazy (dask) outputs the wall time is graph construction time and
+    the task count shows the work deferred to compute
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _TRACE is None:
+            return func(*args, **kwargs)
+
+        # Nesting depth per thread, so summaries can leave out stages called by other stages
+        depth = getattr(_LOCAL, 'depth', 0)
+        _LOCAL.depth = depth+1
+
+        arrays_in = _arrays(args)+_arrays(kwargs)
+        hits0, misses0 = _cache_counts()
+        rss0 = _rss_mib()
+        t0 = time.perf_counter()
+        try:
+            out = func(*args, **kwargs)
+        finally:
+            _LOCAL.depth = depth
+        wall = time.perf_counter()-t0
+        rss1 = _rss_mib()
+        hits1, misses1 = _cache_counts()
+
+        arrays_out = _arrays(out)
+        record = dict(stage=func.__name__, module=func.__module__, depth=depth, thread=threading.current_thread().name,
+                      start_s=t0-_T0, wall_s=wall, bytes_in=_nbytes(arrays_in), bytes_out=_nbytes(arrays_out),
+                      rss_mib=rss1, rss_delta_mib=None if rss0 is None else rss1-rss0, peak_rss_mib=_peak_rss_mib(),
+                      cache_hits=hits1-hits0, cache_misses=misses1-misses0, **_dask_info(arrays_out))
+
+        trace = _TRACE
+        if trace is not None:
+            trace.append(record)
+
+        return out
+
+    return wrapper
+
+def EnableProfiling(trace_path: str|None=None) -> None:
+    '''
+    Starts recording profiled stages, clearing any previous trace
+    INPUT:
+    trace_path: (optional) trace file (.json or .csv) written when the process exits. defaults to None (no file)
+    '''
+    global _TRACE
+    _TRACE = []
+    if trace_path is not None and trace_path not in _TRACE_PATHS:
+        _TRACE_PATHS.add(trace_path)
+        atexit.register(lambda: _TRACE is not None and WriteTrace(trace_path))
+
+def DisableProfiling() -> List[Dict]:
+    '''
+    Stops recording profiled stages
+    OUTPUT:
+    trace: list of stage records collected since profiling was enabled
+    '''
+    global _TRACE
+    trace = [] if _TRACE is None else _TRACE
+    _TRACE = None
+
+    return trace
+
+def GetTrace() -> List[Dict]:
+    '''
+    Stage records collected so far (empty if profiling is disabled)
+    '''
+    return [] if _TRACE is None else list(_TRACE)
+
+class Profiling:
+    '''
+    Context manager profiling the stages run inside it, i.e.
+    with Profiling('trace.json') as prof:
+        ...
+    print(prof.summary())
+    '''
+    def __init__(self, trace_path: str|None=None):
+        self.trace_path = trace_path
+        self.trace = []
+
+    def __enter__(self):
+        EnableProfiling()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace = DisableProfiling()
+        if self.trace_path is not None:
+            WriteTrace(self.trace_path, self.trace)
+        return False
+
+    def summary(self, nested: bool=False):
+        return SummaryTable(self.trace, nested)
+
+def WriteTrace(path: str, trace: List[Dict]|None=None) -> str:
+    '''
+    Writes stage records to a JSON or CSV file (by extension)
+    INPUT:
+    path: output file path (.json or .csv)
+    trace: (optional) list of stage records. defaults to the current trace
+
+    OUTPUT:
+    path: output file path
+    '''
+    trace = GetTrace() if trace is None else trace
+
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=TRACE_FIELDS)
+            writer.writeheader()
+            writer.writerows(trace)
+    else:
+        with open(path, 'w') as f:
+            json.dump(trace, f, indent=1)
+
+    return path
+
+def ReadTrace(path: str) -> List[Dict]:
+    '''
+    Reads stage records from a JSON or CSV trace file, i.e. to compare profiles between experiments
+    '''
+    if path.endswith('.csv'):
+        with open(path, newline='') as f:
+            return list(csv.DictReader(f))
+    with open(path) as f:
+        return json.load(f)
+
+def SummaryTable(trace: List[Dict]|None=None, nested: bool=False):
+    '''
+    Summarizes stage records by stage: calls, total/mean/max wall time, bytes in/out, largest RSS increase,
+    peak RSS, dask tasks, and cache hits, sorted by total wall time
+    INPUT:
+    trace: (optional) list of stage records. defaults to the current trace
+    nested: (optional) include stages called from other profiled stages. defaults to False
+
+    OUTPUT:
+    summary: pandas DataFrame indexed by stage
+    '''
+    import pandas as pd
+
+    df = pd.DataFrame(GetTrace() if trace is None else trace, columns=TRACE_FIELDS)
+    num_cols = [c for c in TRACE_FIELDS if c not in ('stage', 'module', 'thread', 'chunk_shape')]
+    df[num_cols] = df[num_cols].apply(pd.to_numeric, errors='coerce')
+    if not nested:
+        df = df[df['depth'] == 0]
+
+    summary = df.groupby('stage').agg(calls=('wall_s', 'size'), total_s=('wall_s', 'sum'), mean_s=('wall_s', 'mean'),
+                                      max_s=('wall_s', 'max'), mib_in=('bytes_in', 'sum'), mib_out=('bytes_out', 'sum'),
+                                      max_rss_delta_mib=('rss_delta_mib', 'max'), peak_rss_mib=('peak_rss_mib', 'max'),
+                                      dask_tasks=('dask_tasks', 'sum'), cache_hits=('cache_hits', 'sum'),
+                                      cache_misses=('cache_misses', 'sum'))
+    summary[['mib_in', 'mib_out']] = summary[['mib_in', 'mib_out']]/2**20
+
+    return summary.sort_values('total_s', ascending=False)
+
+# Opt in from the environment, i.e. for batch jobs & dask workers
+if os.environ.get('ARCTIC_PROFILE'):
+    EnableProfiling(os.environ['ARCTIC_PROFILE'])
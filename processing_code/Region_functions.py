@@ -0,0 +1,203 @@
+# Packages
+import hashlib
+import collections
+import numpy as np
+import xarray as xr
+from typing import Dict, List, Tuple
+
+# Named analysis regions: lat bounds (degrees, inclusive) and/or index slices along grid dimensions,
+# optionally restricted by a named mask (i.e. 'ocean') passed to RegionIndex
+REGIONS = {
+    'global':     dict(),
+    'arctic':     dict(lat=(70, 90)),               # Weighted averages (slice_atmwei)
+    'arctic50':   dict(lat=(50, 90)),               # Spatial & zonal plots (slice_atmspt, slice_iceobs)
+    'arctic_ice': dict(index=dict(nj=slice(250, 385))), # CICE gx1v7 Arctic subdomain (slice_icemod)
+}
+
+# Sea ice area: cells with concentration above 15% count
+SIA_THRESHOLD = 0.15
+
+# Reductions supported by RegionReduce
+REGION_OPS = ('mean', 'sum', 'sia')
+
+# Earth radius (m), as used for the ERA5 grid area in the analysis notebook
+EARTH_RADIUS = 6367.47e3
+
+def GridArea(lat: np.ndarray, lon: np.ndarray) -> xr.DataArray:
+    '''
+    Cell area (m^2) of a regular lat/lon grid, i.e. ERA5 0.25 degree (replaces CalcGridArea, which gave km^2)
+    INPUT:
+    lat, lon: 1D coordinates
+
+    OUTPUT:
+    area: DataArray (lat, lon)
+    '''
+    lat = np.asarray(lat)
+    lon = np.asarray(lon)
+    dlat = np.abs(np.median(np.diff(lat)))
+    dlon = np.abs(np.median(np.diff(lon)))
+    area = (EARTH_RADIUS*np.deg2rad(dlat))*(EARTH_RADIUS*np.deg2rad(dlon)*np.cos(np.deg2rad(lat)))[:, np.newaxis]*np.ones(len(lon))
+
+    return xr.DataArray(np.abs(area), dims=('lat', 'lon'), coords={'lat': lat, 'lon': lon}, name='area', attrs={'units': 'm^2'})
+
+# Cached cos(lat) weights, keyed by latitude values
+_LAT_WEIGHTS = {}
+
+def LatWeights(lat: xr.DataArray) -> xr.DataArray:
+    '''
+    cos(lat) weights, computed once per latitude coordinate and reused by every weighted mean
+    '''
+    key = hashlib.sha1(np.ascontiguousarray(lat.values, dtype=np.float64).tobytes()+str(lat.dims).encode()).hexdigest()
+    if key not in _LAT_WEIGHTS:
+        weights = np.cos(np.deg2rad(lat)).load()
+        weights.values.setflags(write=False)
+        _LAT_WEIGHTS[key] = weights
+
+    return _LAT_WEIGHTS[key]
+
+class RegionIndex:
+    '''
+    Precomputed spatial index of named regions on one grid: compact flat indices of the points in any region, and
+    weight matrices (points x regions) for weighted means (normalized cos(lat) or area) and area sums. Reducing
+    data to every region is then one gather & one matrix multiply per chunk
+    INPUT:
+    da: sample DataArray on the grid, with lat (1D or 2D) & optionally area/tarea coordinates
+    dims: (optional) spatial dimensions. defaults to ('lat', 'lon'), or ('nj', 'ni') if da has them
+    regions: (optional) list of names in REGIONS, or dictionary of name: spec. defaults to every region in REGIONS
+             that applies to the grid
+    area: (optional) cell area (m^2) DataArray. defaults to da['tarea'] or da['area'] if present
+    masks: (optional) dictionary of name: boolean DataArray on the grid (i.e. {'ocean': landfrac < 0.5})
+    mean_weights: (optional) 'coslat' (as CalcStatforDim) or 'area'. defaults to 'coslat'
+    '''
+    def __init__(self, da: xr.DataArray, dims: Tuple[str, str]|None=None, regions: List[str]|Dict|None=None,
+                 area: xr.DataArray|None=None, masks: Dict[str, xr.DataArray]|None=None, mean_weights: str='coslat'):
+        if dims is None:
+            dims = ('nj', 'ni') if 'nj' in da.dims else ('lat', 'lon')
+        self.dims = tuple(dims)
+        shape = tuple(da.sizes[d] for d in self.dims)
+
+        # Grid coordinates broadcast to the spatial shape
+        lat = da['lat'].broadcast_like(da.isel({d: 0 for d in da.dims if d not in self.dims})).transpose(*self.dims).values
+        if area is None:
+            area = da['tarea'] if 'tarea' in da.coords else (da['area'] if 'area' in da.coords else None)
+        self.has_area = area is not None
+        area = np.ones(shape) if area is None else area.transpose(*self.dims).values
+        if mean_weights not in ('coslat', 'area'):
+            raise ValueError('\'mean_weights\' value  must be \'coslat\' or \'area\'')
+        wmean = np.cos(np.deg2rad(lat)) if mean_weights == 'coslat' else area
+
+        # Region masks on the spatial grid
+        if regions is None:
+            regions = {k: v for k, v in REGIONS.items() if all(d in self.dims for d in v.get('index', {}))}
+        elif not isinstance(regions, dict):
+            regions = {k: REGIONS[k] for k in regions}
+        masks = dict() if masks is None else masks
+
+        region_masks = []
+        for name, spec in regions.items():
+            mask = np.isfinite(lat)
+            if 'lat' in spec:
+                mask &= (lat >= spec['lat'][0]) & (lat <= spec['lat'][1])
+            for d, sl in spec.get('index', {}).items():
+                keep = np.zeros(da.sizes[d], dtype=bool)
+                keep[sl] = True
+                mask &= np.expand_dims(keep, [i for i, dd in enumerate(self.dims) if dd != d])
+            if 'mask' in spec:
+                mask &= masks[spec['mask']].transpose(*self.dims).values.astype(bool)
+            region_masks.append(mask.ravel())
+        region_masks = np.stack(region_masks, axis=-1)
+
+        # Compact index of points in any region, so reductions only touch those points
+        self.regions = list(regions)
+        self.shape = shape
+        self.points = np.nonzero(region_masks.any(-1))[0]
+        member = region_masks[self.points].astype(np.float64)
+
+        # Normalized mean weights (points x regions) & area sums (points x regions)
+        w = wmean.ravel()[self.points, np.newaxis]*member
+        self.mean_weights = w/w.sum(0)
+        self.area_weights = area.ravel()[self.points, np.newaxis]*member
+        for arr in (self.points, self.mean_weights, self.area_weights):
+            arr.setflags(write=False)
+
+    def __repr__(self):
+        return 'RegionIndex(dims='+str(self.dims)+', regions='+str(self.regions)+', points='+str(len(self.points))+')'
+
+def _region_reduce(x: np.ndarray, points: np.ndarray, weights: np.ndarray, op: str, threshold: float) -> np.ndarray:
+    '''
+    Reduces the flattened last two axes of x to every region with one gather & one matrix multiply
+    '''
+    x = x.reshape(x.shape[:-2]+(-1,))
+    if len(points) < x.shape[-1]:
+        x = x[..., points]
+    valid = ~np.isnan(x)
+
+    if op == 'sia':
+        # Cells above threshold times area, NaN (land) counts as no ice
+        return (x > threshold).astype(np.float64) @ weights
+
+    xv = np.where(valid, x, 0.0).astype(np.float64)
+    if op == 'sum':
+        return xv @ weights
+
+    # Weighted mean skipping NaNs, normalized by the weights of valid points (as DataArray.weighted.mean)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (xv @ weights)/(valid.astype(np.float64) @ weights)
+
+def RegionReduce(ds: xr.Dataset|xr.DataArray, index: RegionIndex, ops: Dict[str, str]|str='mean',
+                 threshold: float=SIA_THRESHOLD) -> xr.Dataset|xr.DataArray:
+    '''
+    Reduces variables to every region of a RegionIndex in one pass over the data, replacing per-region slicing
+    & weighted means. Variables with the same reduction & dimensions are stacked & reduced together
+    INPUT:
+    ds: Dataset or DataArray on the grid of index
+    index: RegionIndex
+    ops: (optional) reduction for every variable, or dictionary of variable: reduction. reductions are
+         'mean' (weighted mean), 'sum' (area-weighted sum), or 'sia' (sea ice area, million km^2, area in m^2).
+         defaults to 'mean'
+    threshold: (optional) concentration threshold for 'sia'. defaults to SIA_THRESHOLD
+
+    OUTPUT:
+    ds_reg: Dataset or DataArray with the spatial dimensions replaced by 'region'
+    '''
+    is_da = isinstance(ds, xr.DataArray)
+    if is_da:
+        name = ds.name if ds.name is not None else '_da'
+        ds = ds.to_dataset(name=name)
+    ops = {v: ops for v in ds.data_vars} if isinstance(ops, str) else ops
+    for op in ops.values():
+        if op not in REGION_OPS:
+            raise ValueError('Region reduction must be one of '+str(REGION_OPS))
+        if op in ('sum', 'sia') and not index.has_area:
+            raise ValueError('\''+op+'\' needs cell areas, give RegionIndex an area or data with tarea/area coordinates')
+
+    groups = collections.defaultdict(list)
+    for v, op in ops.items():
+        groups[(op, ds[v].dims)].append(v)
+
+    reg_list = []
+    for (op, dims), names in groups.items():
+        stacked = ds[names].to_dataarray('_variable')
+        weights = index.mean_weights if op == 'mean' else index.area_weights
+        reg = xr.apply_ufunc(_region_reduce, stacked,
+                             input_core_dims=[list(index.dims)],
+                             output_core_dims=[['region']],
+                             exclude_dims=set(index.dims),
+                             kwargs=dict(points=index.points, weights=weights, op=op, threshold=threshold),
+                             dask='parallelized',
+                             output_dtypes=[np.float64],
+                             dask_gufunc_kwargs=dict(output_sizes={'region': len(index.regions)}, allow_rechunk=True))
+
+        # Sea ice area in million km^2
+        if op == 'sia':
+            reg = reg*1e-12
+        reg = reg.assign_coords(region=index.regions).to_dataset('_variable')
+        for v in names:
+            reg[v].attrs = dict(ds[v].attrs)
+            if op == 'sia':
+                reg[v].attrs.update(units='million km^2', long_name='sea ice area')
+        reg_list.append(reg)
+
+    ds_reg = xr.merge(reg_list, combine_attrs='override')[list(ops)]
+
+    return ds_reg[name] if is_da else ds_reg
@@ -0,0 +1,302 @@
+# Packages
+import os
+import hashlib
+import collections
+import numpy as np
+import xarray as xr
+import scipy.sparse
+from typing import Tuple
+from Profile_functions import RegisterCache
+
+# Default on-disk regridding weight cache, override with the ARCTIC_REGRID_CACHE environment variable
+REGRID_CACHE_DIR = os.environ.get('ARCTIC_REGRID_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'arctic-wind-contribution', 'regrid'))
+
+# Fill values for CICE grid regridding (as in the analysis notebook): ice-free for sic, not significant for p-values
+SIC_FILL = 0.000001
+PVAL_FILL = 0.99
+
+# In-process weight cache & its hit/miss counts
+_WEIGHTS = {}
+_CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'currsize'])
+_COUNTS = {'hits': 0, 'misses': 0}
+
+def RegridCacheInfo():
+    '''
+    Hits, misses and size of the in-process regridding weight cache
+    '''
+    return _CacheInfo(_COUNTS['hits'], _COUNTS['misses'], len(_WEIGHTS))
+
+RegisterCache('regrid', RegridCacheInfo)
+
+def WeightsKey(src_lat: np.ndarray, src_lon: np.ndarray, tgt_lat: np.ndarray, tgt_lon: np.ndarray, method: str) -> str:
+    '''
+    Hash of source/target grid coordinates and method identifying a set of regridding weights
+    '''
+    h = hashlib.sha1(method.encode())
+    for arr in (src_lat, src_lon, tgt_lat, tgt_lon):
+        arr = np.ascontiguousarray(arr, dtype=np.float64)
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+
+    return h.hexdigest()
+
+def _bracket_1d(src: np.ndarray, tgt: np.ndarray, periodic: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Bracketing source indices & linear weights for target points along one axis (source in any order)
+    '''
+    order = np.argsort(src)
+    s = src[order]
+    n = len(s)
+    if periodic:
+        s = np.append(s, s[0]+360.)
+        tgt = s[0]+np.mod(tgt-s[0], 360.)
+
+    k = np.clip(np.searchsorted(s, tgt, side='right')-1, 0, len(s)-2)
+    w1 = (tgt-s[k])/(s[k+1]-s[k])
+    valid = (w1 >= -1e-10) & (w1 <= 1+1e-10)
+
+    return order[k], order[(k+1) % n], np.clip(w1, 0, 1), valid
+
+def _bilinear_weights(src_lat: np.ndarray, src_lon: np.ndarray, tgt_lat: np.ndarray, tgt_lon: np.ndarray) -> scipy.sparse.csr_matrix:
+    '''
+    Bilinear weights from a rectilinear source grid to a rectilinear target grid, periodic in longitude
+    '''
+    nsx = len(src_lon)
+    periodic = abs(nsx*np.median(np.abs(np.diff(np.sort(src_lon))))-360.) < 1e-6
+
+    y0, y1, wy, vy = _bracket_1d(src_lat, tgt_lat, False)
+    x0, x1, wx, vx = _bracket_1d(src_lon, tgt_lon, periodic)
+
+    # Four corners for every target point, row-major (lat, lon) flattening on both grids
+    ty, tx = np.meshgrid(np.arange(len(tgt_lat)), np.arange(len(tgt_lon)), indexing='ij')
+    rows = ty*len(tgt_lon)+tx
+    valid = vy[ty] & vx[tx]
+    rows_l, cols_l, w_l = [], [], []
+    for yi, wyi in ((y0, 1-wy), (y1, wy)):
+        for xi, wxi in ((x0, 1-wx), (x1, wx)):
+            w = wyi[ty]*wxi[tx]
+            keep = valid & (w > 0)
+            rows_l.append(rows[keep])
+            cols_l.append(yi[ty][keep]*nsx+xi[tx][keep])
+            w_l.append(w[keep])
+
+    shape = (len(tgt_lat)*len(tgt_lon), len(src_lat)*nsx)
+    return scipy.sparse.csr_matrix((np.concatenate(w_l), (np.concatenate(rows_l), np.concatenate(cols_l))), shape=shape)
+
+def _nearest_weights(src_lat: np.ndarray, src_lon: np.ndarray, tgt_lat: np.ndarray, tgt_lon: np.ndarray) -> scipy.sparse.csr_matrix:
+    '''
+    Nearest source point (great circle) for every target point
+    '''
+    from scipy.spatial import cKDTree
+
+    def xyz(lat, lon):
+        lat, lon = np.deg2rad(lat.ravel()), np.deg2rad(lon.ravel())
+        return np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+
+    if src_lat.ndim == 1:
+        src_lat, src_lon = np.meshgrid(src_lat, src_lon, indexing='ij')
+    tgt_lat, tgt_lon = np.meshgrid(tgt_lat, tgt_lon, indexing='ij')
+
+    # Skip source points without coordinates
+    src_ok = np.nonzero(np.isfinite(src_lat.ravel()) & np.isfinite(src_lon.ravel()))[0]
+    _, ind = cKDTree(xyz(src_lat.ravel()[src_ok], src_lon.ravel()[src_ok])).query(xyz(tgt_lat, tgt_lon))
+
+    ntgt = tgt_lat.size
+    return scipy.sparse.csr_matrix((np.ones(ntgt), (np.arange(ntgt), src_ok[ind])), shape=(ntgt, src_lat.size))
+
+def _xesmf_weights(src_lat: np.ndarray, src_lon: np.ndarray, tgt_lat: np.ndarray, tgt_lon: np.ndarray, method: str) -> scipy.sparse.csr_matrix:
+    '''
+    Weights from xesmf for methods without a native builder (i.e. conservative, patch, curvilinear bilinear)
+    '''
+    import xesmf as xe
+
+    sdims = ('lat', 'lon') if src_lat.ndim == 1 else (('y', 'x'), ('y', 'x'))
+    src = xr.Dataset(coords={'lat': (sdims[0], src_lat), 'lon': (sdims[1], src_lon)})
+    tgt = xr.Dataset(coords={'lat': ('lat', tgt_lat), 'lon': ('lon', tgt_lon)})
+    weights = xe.Regridder(src, tgt, method, reuse_weights=False).weights
+
+    # xesmf >= 0.6 wraps a sparse.COO matrix in a DataArray
+    weights = getattr(weights, 'data', weights)
+
+    return scipy.sparse.csr_matrix(weights.tocsr() if hasattr(weights, 'tocsr') else weights)
+
+def BuildWeights(src_lat: np.ndarray, src_lon: np.ndarray, tgt_lat: np.ndarray, tgt_lon: np.ndarray, method: str) -> scipy.sparse.csr_matrix:
+    '''
+    Builds sparse regridding weights (target points x source points, both flattened row-major)
+    INPUT:
+    src_lat, src_lon: source coordinates, 1D (rectilinear, i.e. ERA5) or 2D (curvilinear, i.e. CICE TLAT/TLONG)
+    tgt_lat, tgt_lon: 1D target coordinates (i.e. CAM f09)
+    method: 'nearest_s2d', 'bilinear', or any other xesmf method. nearest_s2d & bilinear from 1D grids need no xesmf
+
+    OUTPUT:
+    weights: scipy CSR matrix
+    '''
+    if method == 'nearest_s2d':
+        return _nearest_weights(src_lat, src_lon, tgt_lat, tgt_lon)
+    if method == 'bilinear' and src_lat.ndim == 1:
+        return _bilinear_weights(src_lat, src_lon, tgt_lat, tgt_lon)
+
+    return _xesmf_weights(src_lat, src_lon, tgt_lat, tgt_lon, method)
+
+def RegridWeights(src_lat: np.ndarray, src_lon: np.ndarray, tgt_lat: np.ndarray, tgt_lon: np.ndarray, method: str,
+                  cache_dir: str|None=None) -> scipy.sparse.csr_matrix:
+    '''
+    Loads regridding weights from the in-process cache, then the on-disk cache, then builds & caches them
+    INPUT:
+    src_lat, src_lon: source coordinates, 1D or 2D
+    tgt_lat, tgt_lon: 1D target coordinates
+    method: regridding method
+    cache_dir: (optional) cache directory. defaults to REGRID_CACHE_DIR
+
+    OUTPUT:
+    weights: read-only scipy CSR matrix
+    '''
+    cache_dir = REGRID_CACHE_DIR if cache_dir is None else cache_dir
+    key = WeightsKey(src_lat, src_lon, tgt_lat, tgt_lon, method)
+
+    if key in _WEIGHTS:
+        _COUNTS['hits'] += 1
+        return _WEIGHTS[key]
+    _COUNTS['misses'] += 1
+
+    path = os.path.join(cache_dir, method+'_'+key+'.npz')
+    if os.path.isfile(path):
+        with np.load(path) as npz:
+            weights = scipy.sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+    else:
+        weights = BuildWeights(np.asarray(src_lat), np.asarray(src_lon), np.asarray(tgt_lat), np.asarray(tgt_lon), method)
+
+        # Write to temporary file & rename so concurrent workers never read a partial file
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path+'.'+str(os.getpid())+'.tmp.npz'
+        np.savez(tmp_path, data=weights.data, indices=weights.indices, indptr=weights.indptr, shape=np.array(weights.shape))
+        os.replace(tmp_path, path)
+
+    # Weights are shared by reference between calls, so make them read only
+    for arr in (weights.data, weights.indices, weights.indptr):
+        arr.setflags(write=False)
+    _WEIGHTS[key] = weights
+
+    return weights
+
+def ClearRegridCache() -> None:
+    '''
+    Clears the in-process regridding weight cache (the on-disk cache is left alone)
+    '''
+    _WEIGHTS.clear()
+
+def _apply_weights(x: np.ndarray, weights: scipy.sparse.csr_matrix, mapped: np.ndarray, tgt_shape: Tuple[int, int]) -> np.ndarray:
+    '''
+    Regrids the last two axes of x with one sparse matrix multiply over all leading axes
+    '''
+    lead = x.shape[:-2]
+    cols = x.reshape(-1, x.shape[-2]*x.shape[-1]).T
+
+    # NaN sources propagate to every target they contribute to, unmapped targets are NaN
+    out = np.asarray(weights @ cols).T
+    out[:, ~mapped] = np.nan
+    dtype = x.dtype if np.issubdtype(x.dtype, np.floating) else np.float64
+
+    return out.reshape(lead+tgt_shape).astype(dtype, copy=False)
+
+class CachedRegridder:
+    '''
+    Regridder from a source grid to a rectilinear target grid with cached sparse weights, called like an xesmf
+    Regridder. Regridding a Dataset stacks all variables on the source grid into one matrix multiply per chunk,
+    and dask arrays stay lazy. Output dimensions are 'lat' & 'lon' with the target coordinates
+    INPUT:
+    src_lat, src_lon: source coordinate DataArrays, 1D (i.e. ERA5 latE/lonE) or 2D (i.e. CICE lat/lon on nj/ni)
+    tgt_lat, tgt_lon: 1D target coordinates (i.e. CAM f09 lats & lons)
+    method: (optional) regridding method. defaults to 'bilinear'
+    cache_dir: (optional) weight cache directory. defaults to REGRID_CACHE_DIR
+    '''
+    def __init__(self, src_lat: xr.DataArray, src_lon: xr.DataArray, tgt_lat: np.ndarray, tgt_lon: np.ndarray,
+                 method: str='bilinear', cache_dir: str|None=None):
+        self.src_dims = src_lat.dims if src_lat.ndim == 2 else src_lat.dims+src_lon.dims
+        self.tgt_lat = np.asarray(tgt_lat)
+        self.tgt_lon = np.asarray(tgt_lon)
+        self.method = method
+        self.weights = RegridWeights(src_lat.values, src_lon.values, self.tgt_lat, self.tgt_lon, method, cache_dir)
+        self.mapped = np.diff(self.weights.indptr) > 0
+
+    def _regrid(self, da: xr.DataArray) -> xr.DataArray:
+        tgt_shape = (len(self.tgt_lat), len(self.tgt_lon))
+        da_re = xr.apply_ufunc(_apply_weights, da,
+                               input_core_dims=[list(self.src_dims)],
+                               output_core_dims=[['lat', 'lon']],
+                               exclude_dims=set(self.src_dims),
+                               kwargs=dict(weights=self.weights, mapped=self.mapped, tgt_shape=tgt_shape),
+                               dask='parallelized',
+                               output_dtypes=[da.dtype if np.issubdtype(da.dtype, np.floating) else np.float64],
+                               dask_gufunc_kwargs=dict(output_sizes={'lat': tgt_shape[0], 'lon': tgt_shape[1]},
+                                                       allow_rechunk=True),
+                               keep_attrs=True)
+
+        return da_re.assign_coords(lat=self.tgt_lat, lon=self.tgt_lon)
+
+    def __call__(self, obj: xr.DataArray|xr.Dataset) -> xr.DataArray|xr.Dataset:
+        if isinstance(obj, xr.DataArray):
+            return self._regrid(obj)
+
+        # Variables on the source grid with the same dimensions are stacked & regridded together
+        groups = collections.defaultdict(list)
+        for name, da in obj.data_vars.items():
+            if set(self.src_dims) <= set(da.dims):
+                groups[da.dims].append(name)
+
+        regrid_list = []
+        for names in groups.values():
+            stacked = obj[names].to_dataarray('_variable')
+            regrid_list.append(self._regrid(stacked).to_dataset('_variable'))
+        ds_re = xr.merge(regrid_list, combine_attrs='override')
+
+        return ds_re[[n for n in obj.data_vars if n in ds_re]]
+
+def Regrid(ds: xr.Dataset|xr.DataArray, regridder: CachedRegridder, regrid_type: str, pvals: bool=False,
+           era_name: str='ERA5') -> xr.Dataset|xr.DataArray:
+    '''
+    Regrids analysis datasets to the ATM grid, keeping the fill rules of the analysis notebook:
+    'sic': every dataset except ERA5 (already on the ATM grid) is regridded from the CICE grid and NaNs are filled
+           with 0.99 for p-values or 1e-6 otherwise. ERA5 NaNs are filled too, ERA5 is left out for p-values
+    'era': only ERA5 is regridded, other datasets get the exact target coordinates
+    p-critical variables (' pcrit' in the name) are never regridded. All regridded variables share one pass
+    INPUT:
+    ds: Dataset of datasets (i.e. 'ERA5', 'PiC_UVnudge1', ...), or ERA5 DataArray for 'era'
+    regridder: CachedRegridder from the CICE grid ('sic') or ERA5 grid ('era') to the ATM grid
+    regrid_type: 'sic' or 'era'
+    pvals: (optional) boolean for ds holding p-values. default is False
+    era_name: (optional) name of the ERA5 variable. default is 'ERA5'
+
+    OUTPUT:
+    ds_regrid: regridded Dataset (or DataArray)
+    '''
+    if regrid_type not in ('sic', 'era'):
+        raise ValueError('\'regrid_type\' value  must be \'sic\' or \'era\'')
+    sic_cond = (regrid_type == 'sic')
+    nval = PVAL_FILL if pvals else SIC_FILL
+
+    # ERA5 DataArray
+    if isinstance(ds, xr.DataArray):
+        return regridder(ds).rename(era_name)
+
+    # Split variables into regridded & passed through
+    regrid_names = [n for n in ds.data_vars if ' pcrit' not in n and ((n != era_name) if sic_cond else (n == era_name))]
+    pass_names = [n for n in ds.data_vars if n not in regrid_names]
+
+    ds_re = regridder(ds[regrid_names])
+    regrid_list = [ds_re.fillna(nval) if sic_cond else ds_re]
+
+    for n in pass_names:
+        # ERA5 p-values are not on the CICE grid & are left out
+        if sic_cond and n == era_name and pvals:
+            continue
+        da = ds[n]
+        if not sic_cond and set(('lat', 'lon')) <= set(da.dims):
+            da = da.assign_coords({'lon': regridder.tgt_lon, 'lat': regridder.tgt_lat})
+        if sic_cond and n == era_name and not pvals:
+            da = da.fillna(nval)
+        regrid_list.append(da.rename(n))
+
+    ds_regrid = xr.merge(regrid_list, join='left')
+
+    return ds_regrid
@@ -0,0 +1,132 @@
+# Packages
+import numpy as np
+import xarray as xr
+
+# Outputs of the skill kernel, stored along the last axis
+# r: correlation of (raw) anomalies, r_dtrd: correlation of detrended anomalies, slope/mean: linear fit of each series
+# (x = 1, 2, ..., n), spread: RMS ensemble spread, rmse*: ensemble mean vs observations, n: count
+SKILL_FIELDS = ('r', 'r_dtrd', 'slope_mod', 'slope_obs', 'mean_mod', 'mean_obs', 'mean_x', 'spread',
+                'rmse', 'rmse_anom', 'rmse_dtrd', 'n')
+
+# Time steps accumulated at once, bounds the temporaries of the kernel for long (daily) series
+SKILL_BLOCK = 366
+
+def _skill_core(mod: np.ndarray, obs: np.ndarray, x: np.ndarray, block: int=SKILL_BLOCK) -> np.ndarray:
+    '''
+    Skill of an ensemble against observations along the last axis from one pass of running sums
+    INPUT:
+    mod: numpy array (..., ensemble member, time)
+    obs: numpy array (..., time)
+    x: 1D numpy array of x values (time)
+    block: (optional) time steps accumulated at once. defaults to SKILL_BLOCK
+
+    OUTPUT:
+    skill: numpy array with SKILL_FIELDS along the last axis
+    '''
+    shape = np.broadcast_shapes(mod.shape[:-2], obs.shape[:-1])
+    ntime = obs.shape[-1]
+    xc = x-x.mean()
+
+    # Sums are taken about a per point reference (first block of observations), so squares stay small for
+    # values like temperatures ~ 250 K
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ref = np.nanmean(obs[..., :min(block, ntime)], axis=-1)
+    ref = np.broadcast_to(np.where(np.isfinite(ref), ref, 0.0), shape)[..., np.newaxis]
+
+    names = ('n', 'sx', 'sxx', 'sy', 'syy', 'sz', 'szz', 'syz', 'sxy', 'sxz', 'svar', 'nvar')
+    acc = {k: np.zeros(shape) for k in names}
+    for t0 in range(0, ntime, block):
+        sl = slice(t0, min(t0+block, ntime))
+        xb = xc[sl]
+
+        # Ensemble mean & variance over members (NaN members skipped)
+        m = mod[..., sl]
+        valid_m = ~np.isnan(m)
+        cnt = valid_m.sum(-2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            y = np.where(valid_m, m, 0.0).sum(-2)/cnt
+            var = np.where(valid_m, (m-y[..., np.newaxis, :])**2, 0.0).sum(-2)/cnt
+        y = y-ref
+        z = obs[..., sl]-ref
+
+        # Points missing from either series are dropped from both (as xr.corr)
+        valid = np.isfinite(y) & np.isfinite(z)
+        w = valid.astype(np.float64)
+        y = np.where(valid, y, 0.0)
+        z = np.where(valid, z, 0.0)
+        acc['n'] += w.sum(-1)
+        acc['sx'] += w @ xb
+        acc['sxx'] += w @ xb**2
+        acc['sy'] += y.sum(-1)
+        acc['syy'] += np.einsum('...i,...i->...', y, y)
+        acc['sz'] += z.sum(-1)
+        acc['szz'] += np.einsum('...i,...i->...', z, z)
+        acc['syz'] += np.einsum('...i,...i->...', y, z)
+        acc['sxy'] += y @ xb
+        acc['sxz'] += z @ xb
+        acc['svar'] += np.where(np.isfinite(var), var, 0.0).sum(-1)
+        acc['nvar'] += np.isfinite(var).sum(-1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n = acc['n']
+        mx, my, mz = acc['sx']/n, acc['sy']/n, acc['sz']/n
+
+        # Centered (co)variances, then those of the residuals from the linear fits (detrended anomalies)
+        cxx = acc['sxx']-n*mx**2
+        cyy = acc['syy']-n*my**2
+        czz = acc['szz']-n*mz**2
+        cyz = acc['syz']-n*my*mz
+        cxy = acc['sxy']-n*mx*my
+        cxz = acc['sxz']-n*mx*mz
+        ryy = cyy-cxy**2/cxx
+        rzz = czz-cxz**2/cxx
+        ryz = cyz-cxy*cxz/cxx
+
+        r = cyz/np.sqrt(cyy*czz)
+        r_dtrd = ryz/np.sqrt(ryy*rzz)
+        rmse = np.sqrt(np.maximum(acc['syy']-2*acc['syz']+acc['szz'], 0.0)/n)
+        rmse_anom = np.sqrt(np.maximum(cyy-2*cyz+czz, 0.0)/n)
+        rmse_dtrd = np.sqrt(np.maximum(ryy-2*ryz+rzz, 0.0)/n)
+        spread = np.sqrt(acc['svar']/acc['nvar'])
+
+    ref = ref[..., 0]
+    skill = np.stack([r, r_dtrd, cxy/cxx, cxz/cxx, my+ref, mz+ref, mx+x.mean(), spread, rmse, rmse_anom, rmse_dtrd, n],
+                     axis=-1)
+
+    return skill
+
+def CalcSkill(mod: xr.DataArray, obs: xr.DataArray, dim: str, ens_dim: str|None='ensemble_member',
+              block: int=SKILL_BLOCK) -> xr.Dataset:
+    '''
+    Correlation (raw & detrended anomalies), ensemble spread & RMSE of an ensemble against observations at every
+    point in one pass, with x = 1, 2, ..., n. Works chunk by chunk over space (other dimensions of mod, i.e.
+    experiments, broadcast against obs); dim & ens_dim are gathered into one chunk
+    INPUT:
+    mod: DataArray of model data (with ens_dim, or a single run/ensemble mean)
+    obs: DataArray of observations (i.e. ERA5 or GISTEMP on the model grid)
+    dim: dimension to correlate along
+    ens_dim: (optional) ensemble member dimension of mod, None if mod has none. default is 'ensemble_member'
+    block: (optional) time steps accumulated at once. defaults to SKILL_BLOCK
+
+    OUTPUT:
+    ds_skill: Dataset of SKILL_FIELDS
+    '''
+    if ens_dim is None or ens_dim not in mod.dims:
+        ens_dim = '_member'
+        mod = mod.expand_dims(ens_dim)
+    x = np.arange(1, mod.sizes[dim]+1, dtype=np.float64)
+
+    skill = xr.apply_ufunc(_skill_core, mod, obs,
+                           input_core_dims=[[ens_dim, dim], [dim]],
+                           output_core_dims=[['_skill']],
+                           kwargs=dict(x=x, block=block),
+                           dask='parallelized',
+                           output_dtypes=[np.float64],
+                           dask_gufunc_kwargs=dict(output_sizes={'_skill': len(SKILL_FIELDS)}, allow_rechunk=True))
+    ds_skill = xr.Dataset({f: skill.isel(_skill=i, drop=True) for i, f in enumerate(SKILL_FIELDS)})
+
+    # Spread is undefined for a single run
+    if ens_dim == '_member':
+        ds_skill = ds_skill.drop_vars('spread')
+
+    return ds_skill
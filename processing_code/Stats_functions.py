@@ -0,0 +1,403 @@
+# Packages
+import numpy as np
+import xarray as xr
+import pandas as pd
+from typing import List, Tuple
+from Precision_functions import WorkDtype
+
+# Fields of a moment partial, stored along the last axis
+# W: sum of weights, M: weighted mean, S: weighted sum of squared deviations from M,
+# N: count of non-NaN values, W2: sum of squared weights
+MOMENT_FIELDS = ('W', 'M', 'S', 'N', 'W2')
+
+# Largest block of partials merged by group in one task
+REGROUP_BYTES = 16*2**20
+
+# Attribute of moment partials recording the dtype of the moments (see MomentDtype)
+MOMENT_DTYPE_ATTR = 'moment_dtype'
+
+def _moments_chunk(x: np.ndarray, w: np.ndarray, codes: np.ndarray, nkeep: int, ngroup: int|None=None) -> np.ndarray:
+    '''
+    Calculates moment partials for one block of data in a single pass, only for the groups found in the block
+    INPUT:
+    x: numpy array with kept axes first, then the group axis, then any other reduced axes
+    w: numpy array of weights broadcastable to x
+    codes: numpy array of integer group codes along the group axis
+    nkeep: number of kept (not reduced) axes
+    ngroup: (optional) total number of groups, to place partials on the full group axis. default is None
+
+    OUTPUT:
+    parts: numpy array of shape kept + (number of groups in the block,) + (1,)*(other reduced axes) + (5,),
+           groups in the order of np.unique(codes), or kept + (1,)*(reduced axes) + (ngroup, 5) if ngroup is given
+           (zero partials for groups not in the block)
+    '''
+    shape = x.shape
+    kept = shape[:nkeep]
+    nreduce = len(shape)-nkeep
+
+    # Flatten reduced axes after the group axis so data is (kept, group axis, rest)
+    x = x.reshape(kept+(shape[nkeep], -1)).astype(np.float64)
+    w = np.broadcast_to(w, shape).reshape(x.shape)
+
+    # Missing values get zero weight and are not counted
+    valid = ~np.isnan(x)
+    wv = np.where(valid, w, 0.0)
+    xv = np.where(valid, x, 0.0)
+
+    # Group axis sorted by code, so every group is one run summed with reduceat (no dense group matrix)
+    order = np.argsort(codes, kind='stable')
+    local, starts = np.unique(codes[order], return_index=True)
+    inverse = np.searchsorted(local, codes)
+
+    def group_sum(a: np.ndarray) -> np.ndarray:
+        return np.add.reduceat(a.sum(-1)[..., order], starts, axis=-1)
+
+    # Weighted sums by group
+    W = group_sum(wv)
+    N = group_sum(valid.astype(np.float64))
+    W2 = group_sum(wv**2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        M = np.where(W > 0, group_sum(wv*xv)/W, 0.0)
+
+    # Sum of squared deviations from each group mean (two-pass within the block for accuracy)
+    dev = np.where(valid, xv-M[..., inverse][..., np.newaxis], 0.0)
+    S = group_sum(wv*dev**2)
+
+    parts = np.stack([W, M, S, N, W2], axis=-1)
+    if ngroup is not None:
+        dense = np.zeros(kept+(ngroup, len(MOMENT_FIELDS)))
+        dense[..., local, :] = parts
+        return dense.reshape(kept+(1,)*nreduce+dense.shape[-2:])
+
+    return parts.reshape(kept+(local.size,)+(1,)*(nreduce-1)+(len(MOMENT_FIELDS),))
+
+def _moments_regroup(parts: np.ndarray, codes: np.ndarray, ngroup: int) -> np.ndarray:
+    '''
+    Merges partials of the same group (i.e. one year split across two blocks) & places them on the full group axis
+    INPUT:
+    parts: numpy array of moment partials, kept + (partials,) + (5,)
+    codes: numpy array of the group code of every partial
+    ngroup: total number of groups
+
+    OUTPUT:
+    merged: numpy array of shape kept + (ngroup, 5), zero partials for groups without data
+    '''
+    order = np.argsort(codes, kind='stable')
+    groups, starts = np.unique(codes[order], return_index=True)
+    run = np.repeat(np.arange(groups.size), np.diff(np.append(starts, codes.size)))
+    W, M, S, N, W2 = [parts[..., order, i] for i in range(len(MOMENT_FIELDS))]
+
+    # Parallel (Chan et al.) update within every run of the same group
+    W_m = np.add.reduceat(W, starts, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        M_m = np.where(W_m > 0, np.add.reduceat(W*M, starts, axis=-1)/W_m, 0.0)
+    S_m = np.add.reduceat(S+W*(M-M_m[..., run])**2, starts, axis=-1)
+    N_m = np.add.reduceat(N, starts, axis=-1)
+    W2_m = np.add.reduceat(W2, starts, axis=-1)
+
+    merged = np.zeros(parts.shape[:-2]+(ngroup, len(MOMENT_FIELDS)))
+    merged[..., groups, :] = np.stack([W_m, M_m, S_m, N_m, W2_m], axis=-1)
+
+    return merged
+
+def _moments_merge(parts: np.ndarray, axis: int|Tuple[int, ...]|None=None, keepdims: bool=False, **kwargs) -> np.ndarray:
+    '''
+    Merges moment partials along axis with the parallel (Chan et al.) update
+    INPUT:
+    parts: numpy array of moment partials, fields along the last axis
+    axis: axis or axes to merge over
+    keepdims: keep merged axes with size 1
+
+    OUTPUT:
+    merged: numpy array of merged moment partials
+    '''
+    # dask calls this on empty arrays to infer output type
+    if parts.shape[-1] != len(MOMENT_FIELDS):
+        return parts
+
+    W, M, S, N, W2 = [parts[..., i] for i in range(len(MOMENT_FIELDS))]
+
+    # Merged weights, counts, & weighted mean
+    W_m = W.sum(axis=axis, keepdims=True)
+    N_m = N.sum(axis=axis, keepdims=True)
+    W2_m = W2.sum(axis=axis, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        M_m = np.where(W_m > 0, (W*M).sum(axis=axis, keepdims=True)/W_m, 0.0)
+
+    # Merged sum of squared deviations, including spread between partial means
+    S_m = (S + W*(M-M_m)**2).sum(axis=axis, keepdims=True)
+
+    merged = np.stack([W_m, M_m, S_m, N_m, W2_m], axis=-1)
+    if not keepdims:
+        merged = merged.squeeze(axis=axis)
+
+    return merged
+
+def _moments_identity(parts: np.ndarray, axis: int|Tuple[int, ...]|None=None, keepdims: bool=False, **kwargs) -> np.ndarray:
+    '''
+    Chunk step for the dask tree reduction, partials are already computed per block
+    '''
+    return parts
+
+def FinalizeMoments(parts: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Converts moment partials into mean, unbiased standard deviation (ddof=1), and count
+    INPUT:
+    parts: numpy array of moment partials, fields along the last axis
+
+    OUTPUT:
+    avg: weighted mean (NaN if no data)
+    std: weighted standard deviation with ddof=1 (reliability weights, reduces to sample std for equal weights)
+    n: count of non-NaN values
+    '''
+    W, M, S, N, W2 = [parts[..., i] for i in range(len(MOMENT_FIELDS))]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg = np.where(N > 0, M, np.nan)
+        denom = W-W2/W
+        std = np.where((N > 1) & (denom > 0), np.sqrt(S/denom), np.nan)
+
+    return avg, std, N.astype(np.int64)
+
+def MomentDtype(dtype: np.dtype|str) -> np.dtype:
+    '''
+    dtype of means & standard deviations of data of dtype: floats keep their own precision (integers give float64),
+    narrowed by the precision policy (WorkDtype). Moments are accumulated in float64 either way
+    '''
+    dtype = np.dtype(dtype)
+
+    return WorkDtype(dtype if np.issubdtype(dtype, np.floating) else np.float64)
+
+def FactorizeGroups(da: xr.DataArray, grpdim: str|List[str]) -> Tuple[str, np.ndarray, List[str], List[np.ndarray]]:
+    '''
+    Factorizes one or more group variables along the same dimension into a single integer code per element,
+    so multi-key groups (i.e. year x month) are reduced in one pass instead of a loop over groups
+    INPUT:
+    da: xarray DataArray
+    grpdim: variable or list of variables to group by (i.e. 'time.month' or ['time.year', 'time.season'])
+
+    OUTPUT:
+    gdim: dimension the group variables lie along
+    codes: numpy array of combined group codes along gdim
+    names: list of group names (i.e. ['year', 'season'])
+    labels: list of sorted unique labels for each group variable
+    '''
+    grpdim = [grpdim] if isinstance(grpdim, str) else list(grpdim)
+
+    code_list = []
+    names = []
+    labels = []
+    gdims = set()
+    for g in grpdim:
+        grp = da[g]
+        gdims.add(grp.dims[0])
+        code, label = pd.factorize(grp.values, sort=True)
+        code_list.append(code)
+        names.append(grp.name)
+        labels.append(np.asarray(label))
+
+    if len(gdims) > 1:
+        raise ValueError('Group variables must all lie along the same dimension')
+
+    # Combined code, last group variable varies fastest
+    codes = np.ravel_multi_index(code_list, [len(l) for l in labels])
+
+    return gdims.pop(), codes, names, labels
+
+def CalcMomentPartials(da: xr.DataArray, dims: str|List[str], grpdim: str|List[str]='', weights: xr.DataArray|None=None) -> xr.DataArray:
+    '''
+    Calculates moment partials over dimension(s), optionally by group, reading every chunk of da only once.
+    Partials are calculated per chunk and group, then merged across chunks with the parallel variance update.
+    Partials of later data can be merged in with MergeMomentPartials (see CalcMoments for arguments). Lazy for
+    dask inputs, so a following reduction (i.e. of group means) runs in the same pass
+
+    OUTPUT:
+    da_parts: DataArray of moment partials, MOMENT_FIELDS along the last dimension 'moment'
+    '''
+    dims = [dims] if isinstance(dims, str) else list(dims)
+    grouped = len(grpdim) > 0
+
+    # Factorize group labels into integer codes along the grouped dimension
+    if grouped:
+        gdim, codes, names, labels = FactorizeGroups(da, grpdim)
+        if gdim not in dims:
+            raise ValueError('\'dims\' must include the dimension of \''+str(grpdim)+'\'')
+    else:
+        gdim = dims[0]
+        codes, names, labels = np.zeros(da.sizes[gdim], dtype=np.intp), [], []
+    ngroup = int(np.prod([len(l) for l in labels]))
+
+    # Output keeps the input dimension order, with group labels where the grouped dimension was
+    out_dims = []
+    for d in da.dims:
+        if d == gdim:
+            out_dims += names
+        elif d not in dims:
+            out_dims.append(d)
+
+    # Order axes as kept dims, grouped dim, other reduced dims
+    red_dims = [gdim]+[d for d in dims if d != gdim]
+    keep_dims = [d for d in da.dims if d not in red_dims]
+    da = da.transpose(*keep_dims, *red_dims)
+    nkeep = len(keep_dims)
+
+    # Weights keep their own dims, other dims are size 1 & broadcast inside each block
+    weights = xr.DataArray(1.0) if weights is None else weights
+    weights = weights.expand_dims([d for d in da.dims if d not in weights.dims]).transpose(*da.dims)
+
+    # dask.array is imported only for dask inputs, keeping the module quick to import on workers
+    if hasattr(da.data, '__dask_graph__'):
+        import dask.array
+
+        x = da.data
+        w = dask.array.asarray(weights.data)
+        w = w.rechunk(tuple(c if s > 1 else (1,) for c, s in zip(x.chunks, w.shape)))
+
+        # Positions along the grouped dimension no group spans (group edges for i.e. years or year x season)
+        first = np.unique(codes, return_index=True)[1]
+        last = codes.size-1-np.unique(codes[::-1], return_index=True)[1]
+        spans = np.zeros(codes.size+1, dtype=np.intp)
+        np.add.at(spans, first+1, 1)
+        np.add.at(spans, last+1, -1)
+        splits = np.flatnonzero(np.cumsum(spans) == 0)
+
+        # Groups split by chunk edges: edges move to the next split, so every group lies in a single block. Only if
+        # blocks grow by less than a block, or, when there are more groups than fit a block, stay under the dask
+        # chunk size. Neighbouring chunks only are rechunked
+        bounds = np.cumsum((0,)+x.chunks[nkeep])
+        block_len = max(x.chunks[nkeep])
+        step_bytes = x.dtype.itemsize*np.prod([max(ch) for i, ch in enumerate(x.chunks) if i != nkeep])
+        max_len = dask.utils.parse_bytes(dask.config.get('array.chunk-size'))//step_bytes
+        grow = np.diff(splits).max()
+        if not np.all(np.isin(bounds, splits)) and (grow <= block_len or (ngroup > block_len and grow <= max_len)):
+            bounds = np.unique(splits[np.searchsorted(splits, bounds)])
+            x = x.rechunk({nkeep: tuple(np.diff(bounds))})
+            if w.shape[nkeep] > 1:
+                w = w.rechunk({nkeep: x.chunks[nkeep]})
+        c = dask.array.from_array(codes, chunks=(x.chunks[nkeep],))
+
+        # Groups found in every block along the grouped dimension, known before computing
+        block_codes = [np.unique(codes[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+        all_codes = np.concatenate(block_codes)
+        ind = tuple(range(x.ndim))
+        nfield = len(MOMENT_FIELDS)
+
+        if all_codes.size > np.unique(all_codes).size and ngroup <= max(x.chunks[nkeep]):
+            # Few groups shared by blocks (i.e. months, or no grouping): partials of all groups per block are no
+            # larger than the block, merged with a tree reduction over the blocks
+            adjust = {i: 1 for i in ind[nkeep:]}
+            parts = dask.array.blockwise(_moments_chunk, ind+(x.ndim, x.ndim+1),
+                                         x, ind, w, ind, c, (nkeep,),
+                                         new_axes={x.ndim: ngroup, x.ndim+1: nfield},
+                                         adjust_chunks=adjust, nkeep=nkeep, ngroup=ngroup, dtype=np.float64,
+                                         meta=np.empty((0,)*(x.ndim+2), dtype=np.float64))
+            parts = dask.array.reduction(parts, _moments_identity, _moments_merge, combine=_moments_merge,
+                                         axis=tuple(ind[nkeep:]), dtype=np.float64, concatenate=True)
+        else:
+            # Partials for every block in one pass, only for its own groups (the group axis shrinks to those),
+            # other reduced axes shrink to one entry per block
+            adjust = {i: 1 for i in ind[nkeep+1:]}
+            adjust[nkeep] = tuple(bc.size for bc in block_codes)
+            parts = dask.array.blockwise(_moments_chunk, ind+(x.ndim,),
+                                         x, ind, w, ind, c, (nkeep,),
+                                         new_axes={x.ndim: nfield},
+                                         adjust_chunks=adjust, nkeep=nkeep, dtype=np.float64,
+                                         meta=np.empty((0,)*(x.ndim+1), dtype=np.float64))
+
+            # Tree merge of block partials across the other reduced axes
+            if x.ndim > nkeep+1:
+                parts = dask.array.reduction(parts, _moments_identity, _moments_merge, combine=_moments_merge,
+                                             axis=tuple(ind[nkeep+1:]), dtype=np.float64, concatenate=True)
+
+            if all_codes.size == np.unique(all_codes).size:
+                # Every group lies in a single block (i.e. years of yearly chunks): block partials are complete &
+                # only need placing on the full group axis, zero partials for groups without data
+                if not np.array_equal(all_codes, np.arange(ngroup)):
+                    zero = dask.array.zeros(parts.shape[:nkeep]+(1, nfield), dtype=np.float64,
+                                            chunks=parts.chunks[:nkeep]+((1,), (nfield,)))
+                    pos = np.full(ngroup, all_codes.size)
+                    pos[all_codes] = np.arange(all_codes.size)
+                    parts = dask.array.concatenate([parts, zero], axis=nkeep)[(slice(None),)*nkeep+(pos,)]
+            else:
+                # Merge groups split across blocks, each task holds about one partial per group for part of the
+                # kept points
+                parts = parts.rechunk({**{i: 'auto' for i in range(nkeep)}, nkeep: -1, nkeep+1: -1},
+                                      block_size_limit=REGROUP_BYTES)
+                parts = parts.map_blocks(_moments_regroup, codes=all_codes, ngroup=ngroup,
+                                         chunks=parts.chunks[:nkeep]+((ngroup,), (nfield,)), dtype=np.float64)
+    else:
+        parts = _moments_chunk(da.values, weights.values, codes, nkeep)
+        parts = parts.reshape(parts.shape[:nkeep+1]+parts.shape[-1:])
+        parts = _moments_regroup(parts, np.unique(codes), ngroup)
+
+    # Build output DataArray with kept coordinates & group labels
+    coords = {k: v for k, v in da.coords.items() if set(v.dims) <= set(keep_dims)}
+
+    # Unravel combined group axis into one axis per group variable
+    group_shape = tuple(len(l) for l in labels)
+    parts = parts.reshape(parts.shape[:-2]+group_shape+parts.shape[-1:])
+    calc_dims = keep_dims+names
+    for name, label in zip(names, labels):
+        coords[name] = label
+    coords['moment'] = list(MOMENT_FIELDS)
+
+    attrs = {**da.attrs, MOMENT_DTYPE_ATTR: str(MomentDtype(da.dtype))}
+    da_parts = xr.DataArray(parts, dims=calc_dims+['moment'], coords=coords, name=da.name, attrs=attrs)
+
+    return da_parts.transpose(*out_dims, 'moment')
+
+def MergeMomentPartials(parts1: xr.DataArray, parts2: xr.DataArray) -> xr.DataArray:
+    '''
+    Merges two sets of moment partials (i.e. stored ones & those of new data). Group labels found in only one
+    of them (i.e. a new year) are kept as they are
+    '''
+    # Zero partials are the identity of the merge
+    parts1, parts2 = xr.align(parts1, parts2, join='outer', fill_value=0.)
+    merged = _moments_merge(np.stack([parts1.values, parts2.transpose(*parts1.dims).values]), axis=0)
+    da_merged = parts1.copy(data=merged)
+    da_merged.attrs[MOMENT_DTYPE_ATTR] = str(np.result_type(*[p.attrs.get(MOMENT_DTYPE_ATTR, np.float64)
+                                                              for p in (parts1, parts2)]))
+
+    return da_merged
+
+def MomentsFromPartials(da_parts: xr.DataArray, dtype: np.dtype|str|None=None) -> Tuple[xr.DataArray, xr.DataArray, xr.DataArray]:
+    '''
+    Converts moment partials from CalcMomentPartials or MergeMomentPartials into mean, standard deviation (ddof=1)
+    & count DataArrays. Mean & standard deviation are returned as dtype, by default the MomentDtype of the data the
+    partials were calculated from (float64 for partials without it)
+    '''
+    # Partials are small (output size x 5), compute once so the three outputs share one pass
+    da_parts = da_parts.transpose(..., 'moment').compute()
+    avg, std, n = FinalizeMoments(da_parts.values)
+
+    # Moments are accumulated in float64, results are returned in the precision of the input
+    dtype = da_parts.attrs.get(MOMENT_DTYPE_ATTR, np.float64) if dtype is None else dtype
+    avg, std = [a.astype(dtype, copy=False) for a in (avg, std)]
+
+    template = da_parts.isel(moment=0, drop=True)
+    template.attrs = {k: v for k, v in template.attrs.items() if k != MOMENT_DTYPE_ATTR}
+    da_avg = template.copy(data=avg)
+    da_std = template.copy(data=std)
+    da_n = template.copy(data=n)
+    da_n.attrs = {}
+
+    return da_avg, da_std, da_n
+
+def CalcMoments(da: xr.DataArray, dims: str|List[str], grpdim: str|List[str]='', weights: xr.DataArray|None=None) -> Tuple[xr.DataArray, xr.DataArray, xr.DataArray]:
+    '''
+    Calculates weighted mean, unbiased standard deviation (ddof=1), and count over dimension(s), optionally
+    by group (i.e. 'time.month', 'time.season', 'time.year', or a list for multi-key groups), reading every chunk
+    of da only once. Partials are calculated per chunk and group, then merged across chunks with the parallel
+    variance update
+    INPUT:
+    da: xarray DataArray
+    dims: dimension(s) to calculate statistics over. must include the grouped dimension if grouping
+    grpdim: (optional) variable or list of variables to group by. defaults to '' (no grouping)
+    weights: (optional) DataArray of weights broadcastable to da. defaults to equal weights
+
+    OUTPUT:
+    da_avg: DataArray mean over dimension(s)
+    da_std: DataArray standard deviation over dimension(s)
+    da_n: DataArray count over dimension(s)
+    '''
+    return MomentsFromPartials(CalcMomentPartials(da, dims, grpdim, weights))
@@ -0,0 +1,194 @@
+# Packages
+import math
+import numpy as np
+import xarray as xr
+from typing import Dict, List, Tuple
+from Precision_functions import PackedRanges, PackEncoding, ClipPacked
+
+# Access patterns a store is laid out for: full time series at a point/region ('timeseries'), full maps at a
+# time ('maps'), or both about equally ('balanced')
+ACCESS_PATTERNS = ('timeseries', 'maps', 'balanced')
+
+# Uncompressed bytes per chunk, large enough to amortize per-chunk overhead & small enough for dask tasks
+TARGET_CHUNK_BYTES = 16*2**20
+
+# Chunks over this many bytes are split even along the dimensions an access pattern wants whole
+MAX_CHUNK_BYTES = 4*TARGET_CHUNK_BYTES
+
+# Time-like dimensions (i.e. after SplitYearMonth or groupby) & sample dimensions, everything else is space
+TIME_DIMS = ('time', 'year', 'month', 'season')
+SAMPLE_DIMS = ('ensemble_member',)
+
+# Blosc zstd level, level 3 compresses about as well as zlib level 5 at several times the speed
+CLEVEL = 3
+
+def _fill(sizes: Dict[str, int], chunks: Dict[str, int], dims: List[str], budget: int) -> None:
+    '''
+    Grows chunks along dims by the same fraction of each dimension length, as far as budget elements per chunk allow
+    '''
+    dims = [d for d in dims if chunks[d] < sizes[d]]
+    if len(dims) == 0:
+        return
+    fixed = math.prod(chunks[d] for d in chunks if d not in dims)
+    # Chunk lengths are evened out over the dimension (i.e. 400 rather than 475 for 1200), so edge chunks are not
+    # mostly empty
+    even = lambda n, c: math.ceil(n/math.ceil(n/c))
+    grown = lambda f: {d: even(sizes[d], max(1, min(sizes[d], math.ceil(sizes[d]*f)))) for d in dims}
+
+    # Bisection on the fraction, chunk size grows monotonically with it
+    lo, hi = 0.0, 1.0
+    if fixed*math.prod(grown(hi).values()) > budget:
+        for _ in range(40):
+            mid = (lo+hi)/2
+            if fixed*math.prod(grown(mid).values()) > budget:
+                hi = mid
+            else:
+                lo = mid
+        hi = lo
+    chunks.update(grown(hi))
+
+def PlanChunks(sizes: Dict[str, int], dtype: np.dtype|str, access: str='balanced', target_bytes: int=TARGET_CHUNK_BYTES,
+               fixed: Dict[str, int]|None=None) -> Dict[str, int]:
+    '''
+    Chunk shape for an array from its shape, dtype & access pattern
+    'timeseries': whole time axis in every chunk, spatial tiles as large as target_bytes allows
+    'maps': whole spatial fields (all levels) in every chunk, as many times as target_bytes allows
+    'balanced': every dimension cut to the same fraction of its length, so both reads touch few chunks
+    Ensemble members are only grouped once everything else is whole
+    INPUT:
+    sizes: dictionary of dimension: length (i.e. da.sizes)
+    dtype: data type
+    access: (optional) one of ACCESS_PATTERNS. default is 'balanced'
+    target_bytes: (optional) uncompressed bytes per chunk. default is TARGET_CHUNK_BYTES
+    fixed: (optional) dictionary of dimension: chunk length kept as given (i.e. {'time': 12} for yearly appends)
+
+    OUTPUT:
+    chunks: dictionary of dimension: chunk length
+    '''
+    if access not in ACCESS_PATTERNS:
+        raise ValueError('\'access\' value  must be one of '+str(ACCESS_PATTERNS))
+    sizes = dict(sizes)
+    fixed = {} if fixed is None else {d: (sizes[d] if c == -1 else min(c, sizes[d])) for d, c in fixed.items() if d in sizes}
+    budget = max(1, target_bytes//np.dtype(dtype).itemsize)
+
+    time_dims = [d for d in sizes if d in TIME_DIMS and d not in fixed]
+    sample_dims = [d for d in sizes if d in SAMPLE_DIMS and d not in fixed]
+    space_dims = [d for d in sizes if d not in TIME_DIMS+SAMPLE_DIMS and d not in fixed]
+
+    chunks = {d: 1 for d in sizes}
+    chunks.update(fixed)
+    if access == 'balanced':
+        order = [time_dims+space_dims, sample_dims]
+    else:
+        # Dimensions read whole are whole unless that exceeds MAX_CHUNK_BYTES
+        whole, rest = (time_dims, space_dims) if access == 'timeseries' else (space_dims, time_dims)
+        _fill(sizes, chunks, whole, max(budget, MAX_CHUNK_BYTES//np.dtype(dtype).itemsize))
+        order = [rest, sample_dims]
+    for dims in order:
+        _fill(sizes, chunks, dims, budget)
+
+    return chunks
+
+def _zarr_major() -> int:
+    '''
+    Major version of the installed zarr, the store format it writes by default
+    '''
+    import zarr
+    return int(zarr.__version__.split('.')[0])
+
+def Compressor(dtype: np.dtype|str, zarr_format: int|None=None, clevel: int=CLEVEL):
+    '''
+    Blosc zstd compressor with byte shuffle (bit shuffle for 1 byte types), for zarr format 2 or 3
+    '''
+    zarr_format = _zarr_major() if zarr_format is None else zarr_format
+    single_byte = np.dtype(dtype).itemsize == 1
+
+    if zarr_format >= 3:
+        from zarr.codecs import BloscCodec
+        return BloscCodec(cname='zstd', clevel=clevel, shuffle='bitshuffle' if single_byte else 'shuffle',
+                          typesize=np.dtype(dtype).itemsize)
+
+    from numcodecs import Blosc
+    return Blosc(cname='zstd', clevel=clevel, shuffle=Blosc.BITSHUFFLE if single_byte else Blosc.SHUFFLE)
+
+def PlanEncoding(ds: xr.Dataset, access: str='balanced', target_bytes: int=TARGET_CHUNK_BYTES,
+                 fixed: Dict[str, int]|None=None, engine: str='zarr', zarr_format: int|None=None,
+                 clevel: int=CLEVEL, pack: bool|Dict[str, Tuple[float, float]]=False) -> Dict[str, Dict]:
+    '''
+    Chunks & compression of every data variable of a Dataset, as the encoding argument of to_zarr or to_netcdf.
+    Optionally stores bounded variables (sea ice fraction, p-values) as scaled int16
+    INPUT:
+    ds: Dataset
+    access, target_bytes, fixed: (optional) see PlanChunks
+    engine: (optional) 'zarr' (Blosc zstd + shuffle) or 'netcdf' (zlib level 1 + shuffle, as the notebooks).
+            default is 'zarr'
+    zarr_format: (optional) zarr format 2 or 3. defaults to the installed zarr major version
+    clevel: (optional) zstd compression level. default is CLEVEL
+    pack: (optional) True to store variables named in PACKED_RANGES or PACKED_PREFIXES as scaled int16, or a
+          dictionary of variable: (min, max). values outside (min, max) must be clipped first (see ClipPacked).
+          default is False
+
+    OUTPUT:
+    encoding: dictionary of variable: encoding
+    '''
+    if engine not in ('zarr', 'netcdf'):
+        raise ValueError('\'engine\' value  must be \'zarr\' or \'netcdf\'')
+
+    zarr_format = _zarr_major() if zarr_format is None else zarr_format
+
+    ranges = PackedRanges(ds, pack)
+
+    encoding = {}
+    for v, da in ds.data_vars.items():
+        # Chunks & compressor follow the dtype on disk
+        packed = PackEncoding(*ranges[v]) if v in ranges else {}
+        dtype = packed.get('dtype', da.dtype)
+        chunks = PlanChunks(da.sizes, dtype, access, target_bytes, fixed)
+        chunk_shape = tuple(chunks[d] for d in da.dims)
+        if engine == 'netcdf':
+            encoding[v] = dict(zlib=True, complevel=1, shuffle=True, chunksizes=chunk_shape)
+        elif _zarr_major() >= 3:
+            # zarr-python 3 takes a list of compressors for both formats
+            encoding[v] = dict(chunks=chunk_shape, compressors=(Compressor(dtype, zarr_format, clevel),))
+        else:
+            encoding[v] = dict(chunks=chunk_shape, compressor=Compressor(dtype, zarr_format, clevel))
+        encoding[v].update(packed)
+
+    return encoding
+
+def WriteStore(ds: xr.Dataset|xr.DataArray, store: str, access: str='balanced', group: str|None=None,
+               target_bytes: int=TARGET_CHUNK_BYTES, fixed: Dict[str, int]|None=None, zarr_format: int|None=None,
+               clevel: int=CLEVEL, mode: str='w', compute: bool=True, pack: bool|Dict[str, Tuple[float, float]]=False):
+    '''
+    Writes a Dataset to zarr with planned chunks & compression and consolidated metadata. dask chunks are matched
+    to the store chunks, so every task writes whole chunks. Read back with xr.open_zarr(store, group=group)
+    INPUT:
+    ds: Dataset or named DataArray
+    store: zarr store path
+    access: (optional) one of ACCESS_PATTERNS. default is 'balanced'
+    group: (optional) zarr group. default is None
+    target_bytes, fixed: (optional) see PlanChunks
+    zarr_format: (optional) zarr format 2 or 3. defaults to the installed zarr major version
+    clevel: (optional) zstd compression level. default is CLEVEL
+    mode: (optional) to_zarr mode. default is 'w'
+    compute: (optional) boolean for writing now, or returning a dask delayed write. default is True
+    pack: (optional) see PlanEncoding, packed variables are clipped to their range. default is False
+
+    OUTPUT:
+    output of to_zarr (ZarrStore, or dask Delayed if compute is False)
+    '''
+    if isinstance(ds, xr.DataArray):
+        ds = ds.to_dataset()
+    encoding = PlanEncoding(ds, access, target_bytes, fixed, 'zarr', zarr_format, clevel, pack)
+    ds = ClipPacked(ds, PackedRanges(ds, pack))
+
+    # Encodings carried over from the source files would clash with the planned ones
+    ds = ds.copy()
+    for v in ds.variables:
+        ds[v].encoding = {}
+    for v in ds.data_vars:
+        ds[v] = ds[v].chunk(dict(zip(ds[v].dims, encoding[v]['chunks'])))
+
+    zarr_kwargs = {} if zarr_format is None else dict(zarr_format=zarr_format)
+
+    return ds.to_zarr(store, group=group, mode=mode, encoding=encoding, consolidated=True, compute=compute, **zarr_kwargs)
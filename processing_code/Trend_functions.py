@@ -0,0 +1,188 @@
+# Packages
+import numpy as np
+import xarray as xr
+from typing import Tuple
+
+# Outputs of the OLS kernel, stored along the last axis
+OLS_FIELDS = ('slope', 'intercept', 'stderr', 'pvalue', 'n')
+
+# Sufficient statistics of an OLS fit, stored along the last axis
+# n: count, xm/ym: means, sxx/sxy/syy: sums of (cross) products of deviations from the means
+OLS_PARTIAL_FIELDS = ('n', 'xm', 'ym', 'sxx', 'sxy', 'syy')
+
+def _ols_partials(y: np.ndarray, x: np.ndarray) -> np.ndarray:
+    '''
+    Sufficient statistics (OLS_PARTIAL_FIELDS along the last axis) of the OLS fit of y against x along the last
+    axis, skipping NaNs
+    '''
+    valid = ~np.isnan(y)
+    m = valid.astype(np.float64)
+
+    # Sums over x are matrix multiplies, x is centered so its sums stay small
+    x0 = x.mean()
+    xc = x-x0
+    n = m @ np.ones_like(xc)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xm = (m @ xc)/n
+        ym = np.where(valid, y, 0.0).astype(np.float64) @ np.ones_like(xc)/n
+
+        # Deviations from each point's mean for accuracy (i.e. temperatures ~ 250 K with trends ~ 0.01 K)
+        yc = np.where(valid, y-ym[..., np.newaxis], 0.0)
+        sxx = (m @ xc**2)-n*xm**2
+        sxy = yc @ xc
+        syy = np.einsum('...i,...i->...', yc, yc)
+
+    return np.stack([n, xm+x0, ym, sxx, sxy, syy], axis=-1)
+
+def _ols_merge(parts1: np.ndarray, parts2: np.ndarray) -> np.ndarray:
+    '''
+    Merges two sets of OLS sufficient statistics (parallel update of means & co-moments)
+    '''
+    # Partials without data are zero, the identity of the merge
+    parts1 = np.where(parts1[..., :1] > 0, parts1, 0.0)
+    parts2 = np.where(parts2[..., :1] > 0, parts2, 0.0)
+    n1, xm1, ym1, sxx1, sxy1, syy1 = [parts1[..., i] for i in range(len(OLS_PARTIAL_FIELDS))]
+    n2, xm2, ym2, sxx2, sxy2, syy2 = [parts2[..., i] for i in range(len(OLS_PARTIAL_FIELDS))]
+
+    n = n1+n2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        f2 = np.where(n > 0, n2/n, 0.0)
+    dx = xm2-xm1
+    dy = ym2-ym1
+
+    return np.stack([n, xm1+dx*f2, ym1+dy*f2, sxx1+sxx2+dx*dx*n1*f2, sxy1+sxy2+dx*dy*n1*f2, syy1+syy2+dy*dy*n1*f2],
+                    axis=-1)
+
+def _ols_finalize(parts: np.ndarray) -> np.ndarray:
+    '''
+    OLS fit (OLS_FIELDS along the last axis) from sufficient statistics, as in scipy.stats.linregress
+    '''
+    n, xm, ym, sxx, sxy, syy = [parts[..., i] for i in range(len(OLS_PARTIAL_FIELDS))]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = sxy/sxx
+        intercept = ym-slope*xm
+
+        # Slope standard error with n-2 degrees of freedom
+        sse = np.maximum(syy-slope*sxy, 0.0)
+        df = n-2
+        stderr = np.where(df > 0, np.sqrt(sse/df/sxx), np.nan)
+        tstat = slope/stderr
+    from scipy import stats
+    pvalue = np.where(df > 0, 2*stats.t.sf(np.abs(tstat), np.maximum(df, 1)), np.nan)
+
+    # Perfect fits have zero standard error, slope is significant
+    pvalue = np.where((stderr == 0) & np.isfinite(slope), 0.0, pvalue)
+
+    return np.stack([slope, intercept, stderr, pvalue, n], axis=-1)
+
+def _ols_core(y: np.ndarray, x: np.ndarray, return_resid: bool=False) -> np.ndarray|Tuple[np.ndarray, np.ndarray]:
+    '''
+    Closed-form ordinary least squares fit of y against x along the last axis, skipping NaNs
+    INPUT:
+    y: numpy array, fit along the last axis
+    x: 1D numpy array of x values
+    return_resid: (optional) also return residuals (detrended values). defaults to False
+
+    OUTPUT:
+    fit: numpy array with OLS_FIELDS along the last axis (slope, intercept, slope standard error, two-sided p-value
+         of the slope, & count), as in scipy.stats.linregress
+    resid: numpy array of residuals, same shape as y (NaN where y is NaN)
+    '''
+    fit = _ols_finalize(_ols_partials(y, x))
+    if return_resid:
+        slope, intercept = fit[..., 0], fit[..., 1]
+        resid = y-(intercept[..., np.newaxis]+slope[..., np.newaxis]*x)
+        return fit, resid
+
+    return fit
+
+def SplitYearMonth(da: xr.DataArray|xr.Dataset, dim: str='time') -> xr.DataArray|xr.Dataset:
+    '''
+    Reshapes monthly data from time to (year, month), so every month is fitted in one call. Missing months are NaN
+    INPUT:
+    da: monthly DataArray or Dataset
+    dim: (optional) time dimension. defaults to 'time'
+
+    OUTPUT:
+    da_ym: DataArray or Dataset with dim replaced by 'year' & 'month'
+    '''
+    da = da.assign_coords(year=(dim, da[dim].dt.year.values), month=(dim, da[dim].dt.month.values))
+    da = da.drop_vars(dim).set_index({dim: ['year', 'month']})
+
+    return da.unstack(dim)
+
+def CalcOLS(da: xr.DataArray, dim: str, return_resid: bool=False) -> xr.Dataset:
+    '''
+    Fits a linear trend along a dimension at every other point in one vectorized pass, with x = 1, 2, ..., n
+    (as in the analysis notebook). Works chunk by chunk on dask arrays, dim is gathered into one chunk
+    INPUT:
+    da: xarray DataArray
+    dim: dimension to fit along
+    return_resid: (optional) boolean for adding residuals ('resid', the detrended anomalies). defaults to False
+
+    OUTPUT:
+    ds_fit: Dataset of slope, intercept, stderr (slope standard error), pvalue (two-sided t-test of the slope),
+            n (count), & optionally resid
+    '''
+    x = np.arange(1, da.sizes[dim]+1, dtype=np.float64)
+
+    # Fit & residuals come from the same sufficient statistics, so the data is read once either way
+    out = xr.apply_ufunc(_ols_core, da,
+                         input_core_dims=[[dim]],
+                         output_core_dims=[['_ols'], [dim]] if return_resid else [['_ols']],
+                         kwargs=dict(x=x, return_resid=return_resid),
+                         dask='parallelized',
+                         output_dtypes=[np.float64, np.float64] if return_resid else [np.float64],
+                         dask_gufunc_kwargs=dict(output_sizes={'_ols': len(OLS_FIELDS)}, allow_rechunk=True))
+    fit, resid = out if return_resid else (out, None)
+    ds_fit = xr.Dataset({f: fit.isel(_ols=i, drop=True) for i, f in enumerate(OLS_FIELDS)})
+
+    if return_resid:
+        ds_fit['resid'] = resid.transpose(*da.dims)
+
+    return ds_fit
+
+def CalcOLSPartials(da: xr.DataArray, dim: str, x: np.ndarray|None=None) -> xr.DataArray:
+    '''
+    Sufficient statistics of the linear fit along a dimension at every other point, so the fit can be extended
+    with later data (MergeOLSPartials) without the earlier data. Works chunk by chunk on dask arrays
+    INPUT:
+    da: xarray DataArray
+    dim: dimension to fit along
+    x: (optional) numpy array of x values along dim. defaults to 1, 2, ..., n (as CalcOLS)
+
+    OUTPUT:
+    da_parts: DataArray of OLS_PARTIAL_FIELDS along the last dimension 'ols'
+    '''
+    x = np.arange(1, da.sizes[dim]+1, dtype=np.float64) if x is None else np.asarray(x, dtype=np.float64)
+
+    parts = xr.apply_ufunc(_ols_partials, da,
+                           input_core_dims=[[dim]],
+                           output_core_dims=[['ols']],
+                           kwargs=dict(x=x),
+                           dask='parallelized',
+                           output_dtypes=[np.float64],
+                           dask_gufunc_kwargs=dict(output_sizes={'ols': len(OLS_PARTIAL_FIELDS)}, allow_rechunk=True))
+
+    return parts.assign_coords(ols=list(OLS_PARTIAL_FIELDS))
+
+def MergeOLSPartials(parts1: xr.DataArray, parts2: xr.DataArray) -> xr.DataArray:
+    '''
+    Merges two sets of OLS sufficient statistics (i.e. stored ones & those of new data), labels found in only one
+    of them (i.e. a new month) are kept as they are
+    '''
+    # Zero partials are the identity of the merge
+    parts1, parts2 = xr.align(parts1, parts2, join='outer', fill_value=0.)
+    parts1 = parts1.transpose(..., 'ols')
+    merged = _ols_merge(parts1.values, parts2.transpose(*parts1.dims).values)
+
+    return parts1.copy(data=merged)
+
+def OLSFromPartials(da_parts: xr.DataArray) -> xr.Dataset:
+    '''
+    Linear fit from sufficient statistics, as returned by CalcOLS (slope, intercept, stderr, pvalue, n)
+    '''
+    fit = _ols_finalize(da_parts.transpose(..., 'ols').values)
+    template = da_parts.transpose(..., 'ols').isel(ols=0, drop=True)
+
+    return xr.Dataset({f: template.copy(data=fit[..., i]) for i, f in enumerate(OLS_FIELDS)})